@@ -40,11 +40,15 @@
 
     // --- 状态变量 ---
     let currentTask = null;
-    const TAB_ID = `${Date.now()}-${Math.random()}`;
+    // 【新】TAB_ID 同时作为该标签页的 worker 标识，与 History Forger 共用并在页面刷新后保留
+    const WORKER_ID_KEY = 'AISTUDIO_WORKER_ID';
+    const TAB_ID = sessionStorage.getItem(WORKER_ID_KEY) || `${Date.now()}-${Math.random()}`;
+    sessionStorage.setItem(WORKER_ID_KEY, TAB_ID);
     let isMaster = false;
     let mainLoopInterval = null;
     let isRequesting = false;
     let interceptorActive = false;
+    let activeStreamXhr = null; // 【新】当前正在接收流的请求，用于在任务被取消时中止生成
 
     // --- 【【【核心升级：网络拦截器 v2.2 - 签名检测版】】】 ---
     const originalXhrOpen = window.XMLHttpRequest.prototype.open;
@@ -58,6 +62,18 @@
             url: `${LOCAL_SERVER_URL}/stream_chunk`,
             headers: { "Content-Type": "application/json" },
             data: JSON.stringify({ task_id: currentTask.task_id, chunk: chunk }),
+            onload: (res) => {
+                try {
+                    const data = JSON.parse(res.responseText);
+                    // 【新】客户端已断开或超过截止时间，中止浏览器中的生成，释放标签页
+                    if (data.status === 'cancelled' && activeStreamXhr) {
+                        console.log("...[Stream] 🛑 任务已被网关取消，中止当前生成。");
+                        const xhrToAbort = activeStreamXhr;
+                        activeStreamXhr = null;
+                        xhrToAbort.abort();
+                    }
+                } catch (e) {}
+            },
             onerror: (err) => { console.error("...[Stream] 块发送失败:", err); }
         });
     }
@@ -78,6 +94,7 @@
             if (this._url && this._url.toString().includes(TARGET_URL_PART)) {
                 console.log(`...🎯 [XHR Stream] 拦截到目标请求，准备接收流式数据...`);
                 clearTimeout(overallTimeout);
+                activeStreamXhr = this;
 
                 let lastSentLength = 0;
                 let fullResponseText = "";
@@ -87,6 +104,7 @@
                 const finalizeStream = () => {
                     if (streamEnded) return;
                     streamEnded = true;
+                    activeStreamXhr = null;
                     console.log('...[Stream] 判定流已结束。');
                     clearTimeout(finalizationTimer);
 
@@ -146,6 +164,45 @@
         }
     }
 
+    // --- 【新】大负载下载 ---
+    // 网关会把较大的消息内容 / 工具返回结果替换为 {"$blob": 摘要, "compressed_bytes": ...} 引用，
+    // 压缩数据按块 (Range 请求) 下载，边下载边用 DecompressionStream 解压。
+    const BLOB_FETCH_CHUNK_BYTES = 1 << 20;
+
+    function fetchBlobRange(digest, start, end) {
+        return new Promise((resolve, reject) => {
+            GM_xmlhttpRequest({
+                method: "GET",
+                url: `${LOCAL_SERVER_URL}/blobs/${digest}`,
+                headers: { "Range": `bytes=${start}-${end}` },
+                responseType: "arraybuffer",
+                onload: (res) => (res.status === 206 || res.status === 200) ? resolve(res.response) : reject(new Error(`下载负载失败: HTTP ${res.status}`)),
+                onerror: (err) => reject(new Error(`下载负载失败: ${err && err.error || err}`))
+            });
+        });
+    }
+
+    async function fetchBlobText(ref) {
+        const decompressor = new DecompressionStream('gzip');
+        const writer = decompressor.writable.getWriter();
+        const textPromise = new Response(decompressor.readable).text();
+        for (let start = 0; start < ref.compressed_bytes; start += BLOB_FETCH_CHUNK_BYTES) {
+            const end = Math.min(start + BLOB_FETCH_CHUNK_BYTES, ref.compressed_bytes) - 1;
+            const chunk = await fetchBlobRange(ref.$blob, start, end);
+            await writer.write(new Uint8Array(chunk));
+        }
+        await writer.close();
+        return textPromise;
+    }
+
+    async function resolveBlob(value) {
+        if (value && typeof value === 'object' && typeof value.$blob === 'string') {
+            console.log(`📦 正在下载负载 ${value.$blob.slice(0, 12)} (${value.compressed_bytes} 字节 gzip -> ${value.bytes} 字节)...`);
+            return fetchBlobText(value);
+        }
+        return value;
+    }
+
     // --- 任务处理与服务器通信 (升级以处理工具结果) ---
     async function handlePromptTask(promptText) {
         console.log(`...[Automator] 开始处理新【对话】: "${promptText}"`);
@@ -242,14 +299,16 @@
         // 优先检查工具返回任务
         GM_xmlhttpRequest({
             method: "GET",
-            url: `${LOCAL_SERVER_URL}/get_tool_result_job`,
+            url: `${LOCAL_SERVER_URL}/get_tool_result_job?worker_id=${encodeURIComponent(TAB_ID)}`,
             onload: (res) => {
                 try {
                     const data = JSON.parse(res.responseText);
                     if (data.status === 'success' && data.job) {
                         console.log("...[Automator] 检测工具调用任务...");
                         currentTask = data.job;
-                        handleToolResultTask(currentTask.result);
+                        resolveBlob(currentTask.result)
+                            .then(handleToolResultTask)
+                            .catch(e => reportTaskResult("failed", `获取工具返回结果失败: ${e}`));
                         isRequesting = false; // 任务已找到，可以结束请求链
                     } else {
                         // 如果没有工具任务，则检查普通对话任务
@@ -270,14 +329,16 @@
         // 这个函数现在是 pollForJobs 的一部分，所以不需要重复设置 isRequesting
         GM_xmlhttpRequest({
             method: "GET",
-            url: `${LOCAL_SERVER_URL}/get_prompt_job`,
+            url: `${LOCAL_SERVER_URL}/get_prompt_job?worker_id=${encodeURIComponent(TAB_ID)}`,
             onload: (res) => {
                 try {
                     const data = JSON.parse(res.responseText);
                     console.log("...[Automator] 检测普通对话任务："+res.responseText);
                     if (data.status === 'success' && data.job) {
                         currentTask = data.job;
-                        handlePromptTask(currentTask.prompt);
+                        resolveBlob(currentTask.prompt)
+                            .then(handlePromptTask)
+                            .catch(e => reportTaskResult("failed", `获取提示词失败: ${e}`));
                     }
                 } catch (e) {}
             },
@@ -340,6 +401,8 @@
             GM_xmlhttpRequest({
                 method: "POST",
                 url: `${OPENAI_GATEWAY_URL}/reset_state`,
+                headers: { "Content-Type": "application/json" },
+                data: JSON.stringify({ worker_id: TAB_ID }),
                 onload: () => console.log('✔️ [Automator] 状态重置信号已成功发送。'),
                 onerror: (err) => console.error('❌ [Automator] 发送状态重置信号失败:', err)
             });
@@ -20,38 +20,105 @@
     // --- 配置和常量 ---
     const TARGET_URL_PART = "MakerSuiteService/ResolveDriveResource";
     const LOCAL_SERVER_URL = "http://192.168.232.25:5101";
-    const OPENAI_GATEWAY_URL = "http://192.168.232.25:5100"; // 【新】定义网关服务器地址
     const POLLING_INTERVAL = 1000;
     const ACTION_KEY = 'AISTUDIO_FORGE_ACTION';
     const DATA_KEY = 'AISTUDIO_FORGE_DATA';
+    // 【新】同一标签页中的 History Forger 与 Automator 共用一个 worker 标识 (sessionStorage 在刷新后保留)
+    const WORKER_ID_KEY = 'AISTUDIO_WORKER_ID';
+    const WORKER_ID = sessionStorage.getItem(WORKER_ID_KEY) || `${Date.now()}-${Math.random()}`;
+    sessionStorage.setItem(WORKER_ID_KEY, WORKER_ID);
+    const AUTOMATOR_MASTER_KEY = 'aistudio_automator_master_tab';
     const TOOL_STATE_KEYS = {
         googleSearch: 'AISTUDIO_DESIRED_GOOGLE_SEARCH',
         codeExecution: 'AISTUDIO_DESIRED_CODE_EXECUTION',
         urlContext: 'AISTUDIO_DESIRED_URL_CONTEXT'
     };
 
+    // --- 【新】大负载下载 ---
+    // 网关会把较大的消息内容 / 工具返回结果替换为 {"$blob": 摘要, "compressed_bytes": ...} 引用，
+    // 压缩数据按块 (Range 请求) 下载，边下载边用 DecompressionStream 解压。
+    const BLOB_FETCH_CHUNK_BYTES = 1 << 20;
+
+    function fetchBlobRange(digest, start, end) {
+        return new Promise((resolve, reject) => {
+            GM_xmlhttpRequest({
+                method: "GET",
+                url: `${LOCAL_SERVER_URL}/blobs/${digest}`,
+                headers: { "Range": `bytes=${start}-${end}` },
+                responseType: "arraybuffer",
+                onload: (res) => (res.status === 206 || res.status === 200) ? resolve(res.response) : reject(new Error(`下载负载失败: HTTP ${res.status}`)),
+                onerror: (err) => reject(new Error(`下载负载失败: ${err && err.error || err}`))
+            });
+        });
+    }
+
+    async function fetchBlobText(ref) {
+        const decompressor = new DecompressionStream('gzip');
+        const writer = decompressor.writable.getWriter();
+        const textPromise = new Response(decompressor.readable).text();
+        for (let start = 0; start < ref.compressed_bytes; start += BLOB_FETCH_CHUNK_BYTES) {
+            const end = Math.min(start + BLOB_FETCH_CHUNK_BYTES, ref.compressed_bytes) - 1;
+            const chunk = await fetchBlobRange(ref.$blob, start, end);
+            await writer.write(new Uint8Array(chunk));
+        }
+        await writer.close();
+        return textPromise;
+    }
+
+    async function resolveBlob(value) {
+        if (value && typeof value === 'object' && typeof value.$blob === 'string') {
+            console.log(`📦 正在下载负载 ${value.$blob.slice(0, 12)} (${value.compressed_bytes} 字节 gzip -> ${value.bytes} 字节)...`);
+            return fetchBlobText(value);
+        }
+        return value;
+    }
+
     // --- 任务轮询 ---
+    function isAutomatorMasterTab() {
+        // 只有 Automator 主标签页会处理后续对话，注入必须发生在同一个标签页中
+        const masterInfo = JSON.parse(localStorage.getItem(AUTOMATOR_MASTER_KEY) || '{}');
+        return masterInfo.id === WORKER_ID;
+    }
+
     function pollForJob() {
         // 如果页面正在刷新以应用注入，则不轮询
         if (sessionStorage.getItem(ACTION_KEY)) return;
+        if (!isAutomatorMasterTab()) return;
         GM_xmlhttpRequest({
             method: "GET",
-            url: `${LOCAL_SERVER_URL}/get_injection_job`,
-            onload: function(response) {
+            url: `${LOCAL_SERVER_URL}/get_injection_job?worker_id=${encodeURIComponent(WORKER_ID)}`,
+            onload: async function(response) {
+                let res;
                 try {
-                    const res = JSON.parse(response.responseText);
-                    if (res.status === 'success' && res.job) {
-                        console.log("🚚 新任务已获取，准备注入...");
-                        sessionStorage.setItem(DATA_KEY, JSON.stringify(res.job));
-                        sessionStorage.setItem(ACTION_KEY, 'APPLY_INJECTION');
-                        location.reload(); // 刷新页面以触发拦截器
-                    }
-                } catch (e) { /* 静默处理 */ }
+                    res = JSON.parse(response.responseText);
+                } catch (e) { return; /* 静默处理 */ }
+                if (res.status !== 'success' || !res.job) return;
+                console.log("🚚 新任务已获取，准备注入...");
+                try {
+                    // 【新】先取回被替换为负载引用的大段消息内容
+                    res.job.messages = await Promise.all((res.job.messages || []).map(async m => ({ ...m, content: await resolveBlob(m.content) })));
+                } catch (e) {
+                    console.error("❌ History Forger: 获取注入内容失败:", e);
+                    reportInjectionFailed(res.job.task_id);
+                    return;
+                }
+                sessionStorage.setItem(DATA_KEY, JSON.stringify(res.job));
+                sessionStorage.setItem(ACTION_KEY, 'APPLY_INJECTION');
+                location.reload(); // 刷新页面以触发拦截器
             },
             onerror: function(err) { /* 静默处理连接错误 */ }
         });
     }
 
+    function reportInjectionFailed(taskId) {
+        GM_xmlhttpRequest({
+            method: "POST",
+            url: `${LOCAL_SERVER_URL}/report_injection_complete`,
+            headers: { "Content-Type": "application/json" },
+            data: JSON.stringify({ status: "failed", task_id: taskId, worker_id: WORKER_ID })
+        });
+    }
+
     // --- 数据转换器 ---
 
     // 将标准 JSON Schema 转换为 AI Studio 内部数组格式
@@ -335,13 +402,13 @@
                         console.log('✅ History Forger: 注入完成，设置本地对话就绪信标 (AUTOMATION_READY)。');
                         sessionStorage.setItem('AUTOMATION_READY', 'true');
 
-                        // 2. 通过 API 通知 OpenAI 网关服务器，解除其阻塞
-                        console.log('...[History Forger] 正在向 OpenAI 网关发送注入完成信号...');
+                        // 2. 通过 API 通知任务代理服务器 (所有网关实例都从这里读取注入状态)，并报告本标签页的 worker 标识
+                        console.log('...[History Forger] 正在向本地服务器发送注入完成信号...');
                         GM_xmlhttpRequest({
                             method: "POST",
-                            url: `${OPENAI_GATEWAY_URL}/report_injection_complete`,
+                            url: `${LOCAL_SERVER_URL}/report_injection_complete`,
                             headers: { "Content-Type": "application/json" },
-                            data: JSON.stringify({ status: "completed" }), // 数据内容不重要，主要是为了触发
+                            data: JSON.stringify({ status: "completed", task_id: jobData.task_id, worker_id: WORKER_ID }),
                             onload: () => console.log('✔️ History Forger: 注入完成信号已成功发送。'),
                             onerror: (err) => console.error("❌ History Forger: 发送注入完成信号失败:", err)
                         });
@@ -0,0 +1,164 @@
+# batch_store.py - 离线批处理的文件与任务存储
+#
+# 上传的 JSONL 文件、批处理任务的元数据和结果文件都保存在磁盘目录中：
+#   <root>/files/<file_id>.jsonl      文件内容 (输入文件和结果文件)
+#   <root>/files/<file_id>.json       文件元数据
+#   <root>/batches/<batch_id>.json    批处理任务元数据 (状态、进度)
+# 结果逐行追加并 fsync，网关重启后根据已写入的 custom_id 跳过已完成的请求，从断点继续。
+# 上传的文件分块写入磁盘，不会整个读入内存；元数据的读-改-写由每个批处理各自的锁保护。
+
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+# 尚未结束的批处理状态，网关重启后需要继续执行
+ACTIVE_BATCH_STATUSES = ("validating", "in_progress", "finalizing", "cancelling")
+FILE_CHUNK_BYTES = 1 << 20 # 上传文件时每次读取的字节数
+
+
+class FileTooLargeError(ValueError):
+    """上传的文件超过大小限制"""
+
+
+class BatchStore:
+    def __init__(self, root: str):
+        self.root = root
+        self.files_dir = os.path.join(root, "files")
+        self.batches_dir = os.path.join(root, "batches")
+        os.makedirs(self.files_dir, exist_ok=True)
+        os.makedirs(self.batches_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._batch_locks = {} # batch_id -> threading.Lock
+
+    # --- 文件 ---
+
+    def create_file(self, stream, filename: str, purpose: str, owner: str, max_bytes: int = None) -> dict:
+        """
+        从 stream 分块读取内容写入新文件。
+        超过 max_bytes 时删除已写入的部分并抛出 FileTooLargeError。
+        """
+        file_id = f"file-{uuid.uuid4().hex}"
+        path, size = self.file_path(file_id), 0
+        try:
+            with open(path, "wb") as f:
+                while True:
+                    data = stream.read(FILE_CHUNK_BYTES)
+                    if not data:
+                        break
+                    size += len(data)
+                    if max_bytes is not None and size > max_bytes:
+                        raise FileTooLargeError(f"文件超过 {max_bytes} 字节。")
+                    f.write(data)
+        except BaseException:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        return self._save_file_meta({"id": file_id, "object": "file", "bytes": size, "created_at": int(time.time()),
+                                     "filename": filename, "purpose": purpose, "owner": owner})
+
+    def create_empty_file(self, filename: str, purpose: str, owner: str) -> dict:
+        """创建一个空的结果文件，之后通过 append_line 逐行写入"""
+        file_id = f"file-{uuid.uuid4().hex}"
+        open(self.file_path(file_id), "wb").close()
+        return self._save_file_meta({"id": file_id, "object": "file", "bytes": 0, "created_at": int(time.time()),
+                                     "filename": filename, "purpose": purpose, "owner": owner})
+
+    def get_file(self, file_id: str):
+        return self._read_json(self._file_meta_path(file_id))
+
+    def file_path(self, file_id: str) -> str:
+        return os.path.join(self.files_dir, f"{os.path.basename(file_id)}.jsonl")
+
+    def _file_meta_path(self, file_id: str) -> str:
+        return os.path.join(self.files_dir, f"{os.path.basename(file_id)}.json")
+
+    def _save_file_meta(self, meta: dict) -> dict:
+        self._write_json(self._file_meta_path(meta["id"]), meta)
+        return meta
+
+    def append_line(self, file_id: str, record: dict):
+        """向结果文件追加一行并落盘，同时更新文件大小"""
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock:
+            with open(self.file_path(file_id), "ab") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            meta = self.get_file(file_id)
+            if meta:
+                meta["bytes"] += len(line)
+                self._save_file_meta(meta)
+
+    def read_lines(self, file_id: str):
+        """逐行读取 JSONL 文件，返回 (行号, 解析结果或 None)。无法解析的行返回 None。"""
+        path = self.file_path(file_id)
+        if not os.path.exists(path):
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            for line_number, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield line_number, json.loads(line)
+                except json.JSONDecodeError:
+                    yield line_number, None
+
+    # --- 批处理任务 ---
+
+    def create_batch(self, batch: dict) -> dict:
+        batch = {"id": f"batch_{uuid.uuid4().hex}", "object": "batch", "created_at": int(time.time()), **batch}
+        return self.save_batch(batch)
+
+    def get_batch(self, batch_id: str):
+        return self._read_json(os.path.join(self.batches_dir, f"{os.path.basename(batch_id)}.json"))
+
+    def batch_lock(self, batch_id: str) -> threading.Lock:
+        """读取、修改并保存批处理元数据时持有 (执行线、取消接口与收尾会并发写同一个文件)"""
+        with self._lock:
+            return self._batch_locks.setdefault(batch_id, threading.Lock())
+
+    def save_batch(self, batch: dict) -> dict:
+        self._write_json(os.path.join(self.batches_dir, f"{batch['id']}.json"), batch)
+        return batch
+
+    def list_batches(self, owner: str = None) -> list:
+        batches = []
+        for name in os.listdir(self.batches_dir):
+            if name.endswith(".json"):
+                batch = self._read_json(os.path.join(self.batches_dir, name))
+                if batch and (owner is None or batch.get("owner") == owner):
+                    batches.append(batch)
+        return sorted(batches, key=lambda batch: batch["created_at"], reverse=True)
+
+    def result_custom_ids(self, file_id: str) -> set:
+        """结果文件中已写入的请求 (重启后不再重复执行)"""
+        return {record["custom_id"] for _, record in self.read_lines(file_id) if record and record.get("custom_id") is not None}
+
+    # --- 辅助函数 ---
+
+    @staticmethod
+    def _read_json(path: str):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    @staticmethod
+    def _write_json(path: str, data: dict):
+        """
+        原子写入 (先写临时文件再替换)，进程崩溃时不会留下半个文件。
+        每次写入使用独立的临时文件，并发写同一路径时不会互相覆盖临时文件。
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
@@ -0,0 +1,66 @@
+# benchmark_tool_args.py - 函数调用参数解码的微基准测试
+#
+# 用法: python benchmark_tool_args.py [重复次数]
+# 分别测量按 Schema 解码与按结构猜测 (无 Schema) 两种方式在大参数、长数组、多字段和深层嵌套下的耗时。
+
+import sys
+import timeit
+
+from openai_compatible_server import decode_google_args
+
+# Google Value 的数组形式: [null_value, number_value, string_value, bool_value, struct_value, list_value]
+def _string(value): return [None, None, value]
+def _number(value): return [None, value]
+def _bool(value): return [None, None, None, value]
+def _struct(fields): return [None, None, None, None, [fields]]
+def _list(values): return [None, None, None, None, None, [values]]
+
+
+def large_string_case():
+    """写文件类工具: 1 MB 的文件内容"""
+    args = [["path", _string("/tmp/output.txt")], ["content", _string("x" * (1 << 20))], ["append", _bool(0)]]
+    schema = {"type": "object", "properties": {"path": {"type": "string"}, "content": {"type": "string"}, "append": {"type": "boolean"}}}
+    return args, schema
+
+def long_array_case():
+    """20000 个整数组成的数组"""
+    args = [["values", _list([_number(i) for i in range(20000)])]]
+    schema = {"type": "object", "properties": {"values": {"type": "array", "items": {"type": "integer"}}}}
+    return args, schema
+
+def wide_object_case():
+    """包含 2000 个字段的对象"""
+    fields = [[f"field_{i}", _string(f"value_{i}")] for i in range(2000)]
+    args = [["record", _struct(fields)]]
+    schema = {"type": "object", "properties": {"record": {"type": "object", "properties": {f"field_{i}": {"type": "string"} for i in range(2000)}}}}
+    return args, schema
+
+def deep_nesting_case(depth: int = 800):
+    """嵌套 800 层的对象 (json 模块本身的递归限制约为 1000 层)"""
+    value, schema = _string("leaf"), {"type": "string"}
+    for _ in range(depth):
+        value = _struct([["child", value], ["depth", _number(1)]])
+        schema = {"type": "object", "properties": {"child": schema, "depth": {"type": "integer"}}}
+    return [["tree", value]], {"type": "object", "properties": {"tree": schema}}
+
+
+CASES = {
+    "大字符串 (1 MB)": large_string_case,
+    "长数组 (20000 项)": long_array_case,
+    "多字段对象 (2000 个字段)": wide_object_case,
+    "深层嵌套 (800 层)": deep_nesting_case,
+}
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    print(f"{'场景':<24}{'按 Schema (ms)':>16}{'无 Schema (ms)':>16}")
+    for name, build in CASES.items():
+        args, schema = build()
+        with_schema = min(timeit.repeat(lambda: decode_google_args(args, schema), number=1, repeat=repeat)) * 1000
+        without_schema = min(timeit.repeat(lambda: decode_google_args(args), number=1, repeat=repeat)) * 1000
+        print(f"{name:<24}{with_schema:>16.3f}{without_schema:>16.3f}")
+
+
+if __name__ == "__main__":
+    main()
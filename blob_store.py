@@ -0,0 +1,130 @@
+# blob_store.py - 大负载 (注入历史中的长消息、工具返回结果) 的内容寻址存储
+#
+# 网关把超过阈值的文本按 SHA-256 摘要以 gzip 压缩的形式上传到任务代理服务器，任务中只携带一个引用：
+#   {"$blob": "<sha256>", "bytes": 原始字节数, "compressed_bytes": 压缩后字节数, "encoding": "gzip"}
+# 相同的内容只上传一次 (同一段工具输出在之后每次完整注入时都会重复出现)。
+# 浏览器脚本用 Range 请求分块下载压缩数据，边下载边解压 (DecompressionStream)。
+# 磁盘布局: <root>/<摘要前两位>/<摘要>.gz
+
+import hashlib
+import os
+import re
+import time
+import uuid
+import zlib
+
+BLOB_CHUNK_BYTES = 1 << 20 # 上传、校验与下载的分块大小
+BLOB_COMPRESS_LEVEL = 6
+MAX_BLOB_BYTES = 512 << 20 # 单个负载解压后的最大字节数
+BLOB_TTL_SECONDS = 24 * 3600 # 超过该时长未被引用的负载会被清理
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+DIGEST_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+class BlobError(ValueError):
+    """上传的内容与摘要不符、格式错误或超过大小限制"""
+
+
+# --- 网关端 ---
+
+def iter_utf8(text: str, chunk_chars: int = BLOB_CHUNK_BYTES):
+    """按片段编码字符串，避免为大文本一次性生成完整的 bytes 副本"""
+    for start in range(0, len(text), chunk_chars):
+        yield text[start:start + chunk_chars].encode("utf-8")
+
+def digest_text(text: str):
+    """返回 (sha256 十六进制摘要, UTF-8 字节数)"""
+    sha, size = hashlib.sha256(), 0
+    for piece in iter_utf8(text):
+        sha.update(piece)
+        size += len(piece)
+    return sha.hexdigest(), size
+
+def gzip_chunks(text: str):
+    """流式压缩文本，逐块产出 gzip 数据 (用于分块传输的上传请求体)"""
+    compressor = zlib.compressobj(BLOB_COMPRESS_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+    for piece in iter_utf8(text):
+        compressed = compressor.compress(piece)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def blob_reference(digest: str, size: int, compressed_size: int) -> dict:
+    return {"$blob": digest, "bytes": size, "compressed_bytes": compressed_size, "encoding": "gzip"}
+
+def is_blob_reference(value) -> bool:
+    return isinstance(value, dict) and isinstance(value.get("$blob"), str)
+
+
+# --- 任务代理服务器端 ---
+
+class BlobStore:
+    def __init__(self, root: str):
+        self.root = root # 目录在第一次写入时创建
+
+    def path(self, digest: str) -> str:
+        if not DIGEST_PATTERN.match(digest or ""):
+            raise BlobError(f"无效的摘要: {digest!r}")
+        return os.path.join(self.root, digest[:2], f"{digest}.gz")
+
+    def stat(self, digest: str):
+        """返回压缩后的字节数 (不存在时返回 None)，并刷新最近引用时间"""
+        path = self.path(digest)
+        try:
+            os.utime(path)
+            return os.path.getsize(path)
+        except FileNotFoundError:
+            return None
+
+    def put_stream(self, digest: str, stream) -> int:
+        """
+        从 stream 分块读取 gzip 数据写入磁盘，同时流式解压计算摘要，校验通过后原子地放到最终位置。
+        返回压缩后的字节数。内容与摘要不符时抛出 BlobError。
+        """
+        path = self.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        decompressor = zlib.decompressobj(GZIP_WBITS)
+        sha, size, compressed_size = hashlib.sha256(), 0, 0
+        try:
+            with open(tmp_path, "wb") as f:
+                while True:
+                    data = stream.read(BLOB_CHUNK_BYTES)
+                    if not data:
+                        break
+                    f.write(data)
+                    compressed_size += len(data)
+                    # 限制每次解压的输出大小，高压缩比的数据不会一次性展开到内存中
+                    while data:
+                        try:
+                            plain = decompressor.decompress(data, BLOB_CHUNK_BYTES)
+                        except zlib.error as e:
+                            raise BlobError(f"无法解压: {e}")
+                        sha.update(plain)
+                        size += len(plain)
+                        if size > MAX_BLOB_BYTES:
+                            raise BlobError(f"负载超过 {MAX_BLOB_BYTES} 字节。")
+                        data = decompressor.unconsumed_tail
+            if not decompressor.eof:
+                raise BlobError("gzip 数据不完整。")
+            if sha.hexdigest() != digest:
+                raise BlobError("内容与摘要不符。")
+            os.replace(tmp_path, path)
+            return compressed_size
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def cleanup(self, ttl: float = BLOB_TTL_SECONDS) -> int:
+        """删除超过 ttl 秒未被引用的负载，返回删除的数量"""
+        cutoff, removed = time.time() - ttl, 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
@@ -0,0 +1,683 @@
+# broker_backend.py - 任务队列、流数据与会话状态的可插拔存储后端
+#
+# local_history_server 的所有状态都通过这里读写：
+#   - MemoryBrokerBackend: 默认，进程内存储，单机部署时性能最好。
+#   - SQLiteBrokerBackend: 同一台主机上的多个代理服务器进程共享同一个数据库文件，可在滚动重启或多进程部署时共享任务。
+#     (不支持跨主机共享，见类说明)
+# 通过环境变量 BROKER_BACKEND=memory|sqlite 和 BROKER_SQLITE_PATH 选择。
+# 内存后端默认把状态变更写入 BROKER_JOURNAL_PATH 指定的任务日志 (设为空字符串可关闭)，重启后自动恢复。
+
+import hashlib
+import json
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from queue import Empty
+
+from fair_queue import FairQueue, DEFAULT_CLIENT_ID
+from job_journal import JobJournal
+
+# 任务终止状态：这些状态下不再接收新的数据块，网关轮询时视为流已结束
+FINISHED_STATUSES = ('completed', 'failed', 'cancelled', 'expired')
+# 浏览器 (worker) 超过该时间没有任何请求即视为离线，其非强制亲和的任务可由其他 worker 接管
+WORKER_TIMEOUT_SECONDS = 30
+# 已结束任务的数据块保留时间
+TASK_RETENTION_SECONDS = 600
+# 【新】指定了模型的注入任务优先等待已选中该模型的 worker，超过该时间后任何 worker 都可领取
+MODEL_AFFINITY_WAIT_SECONDS = 3
+# 【新】会话签名只覆盖最后几条消息 (快速通道只比较对话末尾，以提高效率和容错性)
+SIGNATURE_MESSAGES = 5
+
+
+def conversation_signature(messages: list, model=None, tools=None) -> str:
+    """
+    【新】worker 页面中对话状态的摘要：最后 SIGNATURE_MESSAGES 条消息 + 模型 + 工具定义。
+    代理服务器只保存和下发该摘要，网关用同样的方法计算请求历史的摘要进行比较，无需传输完整历史。
+    """
+    payload = {"model": model, "tools": tools, "messages": (messages or [])[-SIGNATURE_MESSAGES:]}
+    encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+def conversation_summary(messages: list, model=None, tools=None) -> dict:
+    """【新】保存在 conversation:<worker_id> 会话中的对话状态"""
+    return {"model": model, "signature": conversation_signature(messages, model, tools), "message_count": len(messages or [])}
+
+def worker_is_healthy(info: dict) -> bool:
+    """【新】网关发现某个 worker 的生成卡住时会将其标记为不健康 (unhealthy_until)，冷却期内不再给它分配新任务"""
+    return info.get("unhealthy_until", 0) <= time.time()
+
+def job_is_eligible(job: dict, worker_id, live_workers) -> bool:
+    """
+    判断某个 worker 能否领取该任务 (worker 亲和性)。
+    - 未指定 worker_id 的任务任何 worker 都可领取；
+    - 指定了 worker_id 的任务优先由该 worker 领取；若其已离线且任务不是 strict_affinity，则允许其他 worker 接管 (故障转移)。
+    - 【新】指定了 model 的任务优先由当前已选中该模型的在线 worker 领取，免去页面切换模型的操作；
+      没有这样的 worker，或任务已等待超过 MODEL_AFFINITY_WAIT_SECONDS 时，任何 worker 都可领取。
+    - 【新】avoid_workers 中的 worker 不能领取该任务 (重新分派卡住的生成时排除原来的 worker)；
+      不健康的 worker 只能领取明确指定给它的任务，也不会被当作故障转移或模型亲和的目标。
+    """
+    if worker_id and worker_id in (job.get("avoid_workers") or ()):
+        return False
+    healthy_workers = {other_id: info for other_id, info in live_workers.items() if worker_is_healthy(info)}
+    preferred = job.get("worker_id")
+    if preferred and preferred != worker_id:
+        if job.get("strict_affinity") or worker_id in live_workers and worker_id not in healthy_workers:
+            return False
+        return preferred not in healthy_workers
+    if not preferred and worker_id in live_workers and worker_id not in healthy_workers:
+        return False
+    model = job.get("model")
+    if preferred or not model or live_workers.get(worker_id, {}).get("model") == model:
+        return True
+    if time.time() - job.get("submitted_at", 0) > MODEL_AFFINITY_WAIT_SECONDS:
+        return True
+    return not any(info.get("model") == model for other_id, info in healthy_workers.items() if other_id != worker_id)
+
+
+class BrokerBackend(ABC):
+    """存储后端接口。所有方法都必须是线程安全的。"""
+
+    replayed_task_ids = () # 【新】重启时从持久化状态中恢复的未完成任务
+
+    # --- 任务队列 ---
+    @abstractmethod
+    def put_job(self, queue_name: str, job: dict): ...
+    @abstractmethod
+    def take_job(self, queue_name: str, worker_id: str = None): ...
+    @abstractmethod
+    def peek_job(self, queue_name: str): ...
+    @abstractmethod
+    def queue_size(self, queue_name: str) -> int: ...
+    @abstractmethod
+    def queue_stats(self, queue_name: str) -> dict: ...
+
+    # --- 任务状态与流数据 ---
+    @abstractmethod
+    def create_task(self, task_id: str, **fields): ...
+    @abstractmethod
+    def get_task(self, task_id: str): ...
+    @abstractmethod
+    def update_task(self, task_id: str, **fields) -> bool: ...
+    @abstractmethod
+    def append_chunk(self, task_id: str, chunk: str) -> int: ... # 任务不存在时抛出 KeyError
+    @abstractmethod
+    def read_chunks(self, task_id: str, offset: int) -> list: ...
+
+    # --- 会话状态 ---
+    @abstractmethod
+    def get_session(self, key: str): ...
+    @abstractmethod
+    def set_session(self, key: str, value): ...
+    @abstractmethod
+    def delete_session(self, key: str): ...
+    @abstractmethod
+    def list_sessions(self, prefix: str = "") -> dict: ...
+
+    # --- worker 注册 ---
+    @abstractmethod
+    def touch_worker(self, worker_id: str, **info): ...
+    @abstractmethod
+    def update_worker(self, worker_id: str, **info) -> bool: ... # 只更新信息，不刷新心跳
+    @abstractmethod
+    def list_workers(self) -> dict: ...
+
+    def live_workers(self) -> dict:
+        now = time.time()
+        return {worker_id: info for worker_id, info in self.list_workers().items()
+                if now - info["last_seen"] <= WORKER_TIMEOUT_SECONDS}
+
+    @abstractmethod
+    def cleanup(self, retention_seconds: float = TASK_RETENTION_SECONDS): ...
+
+
+class MemoryBrokerBackend(BrokerBackend):
+    """进程内存储。任务队列使用 FairQueue 按客户端做 DRR 调度。"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._queues = {}
+        self._tasks = {}
+        self._sessions = {}
+        self._workers = {}
+
+    def _queue(self, queue_name: str) -> FairQueue:
+        with self._lock:
+            if queue_name not in self._queues:
+                self._queues[queue_name] = FairQueue(on_expired=lambda job: self._expire_job(queue_name, job))
+            return self._queues[queue_name]
+
+    def _job_dropped(self, queue_name: str, job: dict):
+        """【新】任务未被交给 worker 就离开了队列 (过期或已取消)，供带日志的子类记录"""
+
+    def _expire_job(self, queue_name: str, job: dict):
+        task_id = job.get("task_id")
+        with self._lock:
+            self._job_dropped(queue_name, job)
+            if task_id:
+                self.update_task(task_id, status="expired")
+        label = task_id[:8] if task_id else "未知"
+        print(f"⌛ 任务 {label} 在被取走前已超过截止时间，已丢弃。")
+
+    def put_job(self, queue_name: str, job: dict):
+        self._queue(queue_name).put(job)
+
+    def take_job(self, queue_name: str, worker_id: str = None):
+        live_workers = self.live_workers()
+        accept = lambda job: job_is_eligible(job, worker_id, live_workers)
+        while True:
+            try:
+                job = self._queue(queue_name).get_nowait(accept)
+            except Empty:
+                return None
+            task = self.get_task(job["task_id"]) if job.get("task_id") else None
+            if task and task["status"] in FINISHED_STATUSES:
+                print(f"⏭️ 跳过已取消的任务 (ID: {job['task_id'][:8]})。")
+                self._job_dropped(queue_name, job)
+                continue
+            return job
+
+    def peek_job(self, queue_name: str):
+        return self._queue(queue_name).peek()
+
+    def queue_size(self, queue_name: str) -> int:
+        return self._queue(queue_name).qsize()
+
+    def queue_stats(self, queue_name: str) -> dict:
+        return self._queue(queue_name).stats()
+
+    def create_task(self, task_id: str, **fields):
+        now = time.time()
+        with self._lock:
+            self._tasks[task_id] = {"task_id": task_id, "status": "pending", "full_response": None,
+                                    "worker_id": None, "created_at": now, "updated_at": now,
+                                    **fields, "chunks": [], "cursor": 0}
+
+    def get_task(self, task_id: str):
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None:
+                return None
+            info = {k: v for k, v in task.items() if k != "chunks"}
+            info["chunk_count"] = len(task["chunks"])
+            return info
+
+    def update_task(self, task_id: str, **fields) -> bool:
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None:
+                return False
+            task.update(fields)
+            task["updated_at"] = time.time()
+            return True
+
+    def append_chunk(self, task_id: str, chunk: str) -> int:
+        with self._lock:
+            task = self._tasks[task_id]
+            task["chunks"].append(chunk)
+            task["updated_at"] = time.time()
+            return len(task["chunks"])
+
+    def read_chunks(self, task_id: str, offset: int) -> list:
+        with self._lock:
+            task = self._tasks.get(task_id)
+            return task["chunks"][offset:] if task else []
+
+    def get_session(self, key: str):
+        with self._lock:
+            return self._sessions.get(key)
+
+    def set_session(self, key: str, value):
+        with self._lock:
+            self._sessions[key] = value
+
+    def delete_session(self, key: str):
+        with self._lock:
+            self._sessions.pop(key, None)
+
+    def list_sessions(self, prefix: str = "") -> dict:
+        with self._lock:
+            return {k: v for k, v in self._sessions.items() if k.startswith(prefix)}
+
+    def touch_worker(self, worker_id: str, **info):
+        with self._lock:
+            worker = self._workers.setdefault(worker_id, {})
+            worker.update(info)
+            worker["last_seen"] = time.time()
+
+    def update_worker(self, worker_id: str, **info) -> bool:
+        with self._lock:
+            worker = self._workers.get(worker_id)
+            if worker is None:
+                return False
+            worker.update(info)
+            return True
+
+    def list_workers(self) -> dict:
+        with self._lock:
+            return {worker_id: dict(info) for worker_id, info in self._workers.items()}
+
+    def cleanup(self, retention_seconds: float = TASK_RETENTION_SECONDS):
+        cutoff = time.time() - retention_seconds
+        with self._lock:
+            stale = [task_id for task_id, task in self._tasks.items()
+                     if task["status"] in FINISHED_STATUSES and task["updated_at"] < cutoff]
+            for task_id in stale:
+                self._delete_task(task_id)
+            worker_cutoff = time.time() - max(retention_seconds, WORKER_TIMEOUT_SECONDS)
+            for worker_id in [w for w, info in self._workers.items() if info["last_seen"] < worker_cutoff]:
+                del self._workers[worker_id]
+        return len(stale)
+
+
+    def _delete_task(self, task_id: str):
+        del self._tasks[task_id]
+
+
+class JournaledMemoryBackend(MemoryBrokerBackend):
+    """
+    在内存后端的基础上，把所有状态变更追加到 JobJournal，启动时重放日志恢复
+    排队中的任务、任务状态、已收到的数据块和会话状态。
+    - 提交任务、创建任务会等待日志落盘后才返回 (低频)；
+    - 数据块和状态更新只进入组提交缓冲区，不阻塞流式传输的热路径。
+    - 【新】每次变更都在持有后端锁的情况下写日志并修改内存，日志顺序与实际生效顺序一致；
+      等待落盘在锁外进行。日志增长过大时由后台线程用当前状态的快照替换，只有取快照时持有后端锁。
+    """
+
+    def __init__(self, journal_path: str):
+        super().__init__()
+        self._journal = None
+        self._compactor = None # 正在运行的压缩线程
+        self._replay(journal_path)
+        self._journal = JobJournal(journal_path)
+
+    def _log(self, event: dict) -> int:
+        """追加事件并返回其序号。调用方必须持有 self._lock 且已修改完内存状态 (快照会包含该事件的效果)"""
+        if not self._journal:
+            return 0
+        seq = self._journal.append(event)
+        if self._compactor is None and self._journal.needs_compaction():
+            self._compactor = threading.Thread(target=self._compact, name="job-journal-compactor", daemon=True)
+            self._compactor.start()
+        return seq
+
+    def _wait(self, seq: int):
+        """在锁外等待事件落盘"""
+        if self._journal and seq:
+            self._journal.wait_for(seq)
+
+    def _compact(self):
+        """在后台线程中压缩日志：持有后端锁只为取得快照，序列化和写文件在锁外进行"""
+        try:
+            with self._lock:
+                if not self._journal.start_compaction():
+                    return
+                pending_jobs = [(queue_name, job) for queue_name, queue in self._queues.items() for job in queue.jobs()]
+                events = self._snapshot_events(pending_jobs)
+            # 快照引用的任务、会话等对象只会被整体替换，不会被原地修改，可以在锁外序列化
+            self._journal.finish_compaction(events)
+            print(f"📜 [Journal] 日志已压缩为 {len(events)} 条快照事件。")
+        except Exception as e:
+            print(f"🚨 [Journal] 压缩任务日志失败，继续使用原日志: {type(e).__name__}: {e}")
+        finally:
+            with self._lock:
+                self._compactor = None
+
+    def _replay(self, path: str):
+        pending_jobs = {} # (queue, task_id) -> job，保持入队顺序
+        event_count = 0
+        for event in JobJournal.read_events(path):
+            event_count += 1
+            op = event.get("op")
+            if op == "put_job":
+                pending_jobs[(event["queue"], event["job"].get("task_id"))] = event["job"]
+            elif op in ("take_job", "drop_job"):
+                pending_jobs.pop((event["queue"], event["task_id"]), None)
+            elif op == "create_task":
+                super().create_task(event["task_id"], **event["fields"])
+            elif op == "update_task":
+                super().update_task(event["task_id"], **event["fields"])
+            elif op == "chunk":
+                if event["task_id"] in self._tasks:
+                    super().append_chunk(event["task_id"], event["chunk"])
+            elif op == "delete_task":
+                self._tasks.pop(event["task_id"], None)
+            elif op == "set_session":
+                super().set_session(event["key"], event["value"])
+            elif op == "delete_session":
+                super().delete_session(event["key"])
+
+        for (queue_name, _), job in pending_jobs.items():
+            super().put_job(queue_name, job)
+        self.replayed_task_ids = [task_id for task_id, task in self._tasks.items() if task["status"] not in FINISHED_STATUSES]
+
+        if event_count:
+            unfinished = sum(1 for task in self._tasks.values() if task["status"] not in FINISHED_STATUSES)
+            print(f"📜 [Journal] 已重放 {event_count} 条日志事件：恢复 {len(pending_jobs)} 个排队任务、{unfinished} 个未完成任务。")
+            # 用当前状态的快照替换日志，防止日志无限增长
+            JobJournal.write_snapshot(path, self._snapshot_events([(queue_name, job) for (queue_name, _), job in pending_jobs.items()]))
+
+    def _snapshot_events(self, pending_jobs: list) -> list:
+        """pending_jobs: [(队列名, 任务)]"""
+        events = []
+        for task_id, task in self._tasks.items():
+            fields = {k: v for k, v in task.items() if k not in ("task_id", "chunks")}
+            events.append({"op": "create_task", "task_id": task_id, "fields": fields})
+            events.extend({"op": "chunk", "task_id": task_id, "chunk": chunk} for chunk in task["chunks"])
+        for queue_name, job in pending_jobs:
+            events.append({"op": "put_job", "queue": queue_name, "job": job})
+        for key, value in self._sessions.items():
+            events.append({"op": "set_session", "key": key, "value": value})
+        return events
+
+    def put_job(self, queue_name: str, job: dict):
+        with self._lock:
+            super().put_job(queue_name, job)
+            seq = self._log({"op": "put_job", "queue": queue_name, "job": job})
+        self._wait(seq)
+
+    def take_job(self, queue_name: str, worker_id: str = None):
+        with self._lock:
+            job = super().take_job(queue_name, worker_id)
+            if job is not None:
+                self._log({"op": "take_job", "queue": queue_name, "task_id": job.get("task_id")})
+            return job
+
+    def _job_dropped(self, queue_name: str, job: dict):
+        self._log({"op": "drop_job", "queue": queue_name, "task_id": job.get("task_id")})
+
+    def create_task(self, task_id: str, **fields):
+        with self._lock:
+            super().create_task(task_id, **fields)
+            seq = self._log({"op": "create_task", "task_id": task_id, "fields": fields})
+        self._wait(seq)
+
+    def update_task(self, task_id: str, **fields) -> bool:
+        with self._lock:
+            updated = super().update_task(task_id, **fields)
+            if updated:
+                self._log({"op": "update_task", "task_id": task_id, "fields": fields})
+            return updated
+
+    def append_chunk(self, task_id: str, chunk: str) -> int:
+        with self._lock:
+            count = super().append_chunk(task_id, chunk)
+            self._log({"op": "chunk", "task_id": task_id, "chunk": chunk})
+            return count
+
+    def set_session(self, key: str, value):
+        with self._lock:
+            super().set_session(key, value)
+            self._log({"op": "set_session", "key": key, "value": value})
+
+    def delete_session(self, key: str):
+        with self._lock:
+            super().delete_session(key)
+            self._log({"op": "delete_session", "key": key})
+
+    def _delete_task(self, task_id: str):
+        super()._delete_task(task_id)
+        self._log({"op": "delete_task", "task_id": task_id})
+
+
+class SQLiteBrokerBackend(BrokerBackend):
+    """
+    基于 SQLite (WAL 模式) 的共享存储，同一台主机上的多个代理服务器进程可指向同一个数据库文件。
+    WAL 依赖共享内存，不能跨主机或放在网络文件系统上使用，因此不支持多主机部署。
+    公平调度使用按权重的虚拟时间 (Start-time Fair Queuing)，与内存后端的 DRR 分配比例一致。
+    """
+
+    VIRTUAL_CLOCK_KEY = "__clock__"
+    SCAN_LIMIT = 1000 # 每次领取任务时最多检查的排队任务数
+
+    def __init__(self, path: str):
+        self._path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                queue TEXT NOT NULL,
+                client_id TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                task_id TEXT
+            );
+            CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (queue, id);
+            CREATE TABLE IF NOT EXISTS client_vtime (
+                queue TEXT NOT NULL,
+                client_id TEXT NOT NULL,
+                vtime REAL NOT NULL,
+                PRIMARY KEY (queue, client_id)
+            );
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS chunks (
+                task_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                chunk TEXT NOT NULL,
+                PRIMARY KEY (task_id, seq)
+            );
+            CREATE TABLE IF NOT EXISTS sessions (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS workers (
+                worker_id TEXT PRIMARY KEY,
+                info TEXT NOT NULL,
+                last_seen REAL NOT NULL
+            );
+        """)
+        # 旧版数据库的 jobs 表没有 task_id 列
+        if "task_id" not in [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]:
+            with self._transaction() as conn:
+                conn.execute("ALTER TABLE jobs ADD COLUMN task_id TEXT")
+                conn.execute("UPDATE jobs SET task_id = json_extract(payload, '$.task_id')")
+
+    def _conn(self) -> "sqlite3.Connection":
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # isolation_level=None: 自动提交，需要原子性的地方显式 BEGIN IMMEDIATE
+            import sqlite3 # 只有选择 SQLite 后端时才需要
+            conn = sqlite3.connect(self._path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """BEGIN IMMEDIATE ... COMMIT，出错时回滚，连接不会停留在事务中阻塞其他写入者"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+
+    # --- 任务队列 ---
+
+    def put_job(self, queue_name: str, job: dict):
+        client_id = job.get("client_id") or DEFAULT_CLIENT_ID
+        self._conn().execute("INSERT INTO jobs (queue, client_id, payload, task_id) VALUES (?, ?, ?, ?)",
+                             (queue_name, client_id, json.dumps(job, ensure_ascii=False), job.get("task_id")))
+
+    def take_job(self, queue_name: str, worker_id: str = None):
+        live_workers = self.live_workers()
+        expired_task_ids = []
+        try:
+            with self._transaction() as conn:
+                # 一次查询同时取出任务状态，已结束 (例如已取消) 的任务直接删除
+                rows = conn.execute(
+                    "SELECT j.id, j.client_id, j.payload, t.status FROM jobs j LEFT JOIN tasks t ON t.task_id = j.task_id "
+                    "WHERE j.queue = ? ORDER BY j.id LIMIT ?", (queue_name, self.SCAN_LIMIT)).fetchall()
+                now = time.time()
+                candidates = {} # client_id -> (row_id, job)，每个客户端最早的可领取任务
+                for row_id, client_id, payload, status in rows:
+                    job = json.loads(payload)
+                    task_id = job.get("task_id")
+                    if job.get("deadline") and job["deadline"] < now:
+                        conn.execute("DELETE FROM jobs WHERE id = ?", (row_id,))
+                        if task_id: expired_task_ids.append(task_id)
+                        continue
+                    if status in FINISHED_STATUSES:
+                        conn.execute("DELETE FROM jobs WHERE id = ?", (row_id,))
+                        print(f"⏭️ 跳过已取消的任务 (ID: {task_id[:8]})。")
+                        continue
+                    if client_id not in candidates and job_is_eligible(job, worker_id, live_workers):
+                        candidates[client_id] = (row_id, job)
+
+                if not candidates:
+                    return None
+
+                vtimes = dict(conn.execute("SELECT client_id, vtime FROM client_vtime WHERE queue = ?", (queue_name,)).fetchall())
+                clock = vtimes.get(self.VIRTUAL_CLOCK_KEY, 0.0)
+                start_tag = lambda cid: max(clock, vtimes.get(cid, 0.0))
+                client_id = min(candidates, key=lambda cid: (start_tag(cid), candidates[cid][0]))
+                row_id, job = candidates[client_id]
+                start = start_tag(client_id)
+                weight = max(float(job.get("client_weight") or 1.0), 0.01)
+
+                conn.execute("DELETE FROM jobs WHERE id = ?", (row_id,))
+                conn.executemany("INSERT OR REPLACE INTO client_vtime (queue, client_id, vtime) VALUES (?, ?, ?)",
+                                 [(queue_name, client_id, start + 1.0 / weight),
+                                  (queue_name, self.VIRTUAL_CLOCK_KEY, start)])
+                return job
+        finally:
+            for task_id in expired_task_ids:
+                self.update_task(task_id, status="expired")
+                print(f"⌛ 任务 {task_id[:8]} 在被取走前已超过截止时间，已丢弃。")
+
+    def peek_job(self, queue_name: str):
+        row = self._conn().execute("SELECT payload FROM jobs WHERE queue = ? ORDER BY id LIMIT 1", (queue_name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def queue_size(self, queue_name: str) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM jobs WHERE queue = ?", (queue_name,)).fetchone()[0]
+
+    def queue_stats(self, queue_name: str) -> dict:
+        rows = self._conn().execute(
+            "SELECT j.client_id, COUNT(*), v.vtime FROM jobs j LEFT JOIN client_vtime v "
+            "ON v.queue = j.queue AND v.client_id = j.client_id WHERE j.queue = ? GROUP BY j.client_id",
+            (queue_name,)).fetchall()
+        return {client_id: {"queued": count, "vtime": round(vtime or 0.0, 3)} for client_id, count, vtime in rows}
+
+    # --- 任务状态与流数据 ---
+
+    def create_task(self, task_id: str, **fields):
+        now = time.time()
+        task = {"task_id": task_id, "status": "pending", "full_response": None,
+                "worker_id": None, "created_at": now, "updated_at": now, "cursor": 0, **fields}
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM chunks WHERE task_id = ?", (task_id,))
+            conn.execute("INSERT OR REPLACE INTO tasks (task_id, status, data, updated_at) VALUES (?, ?, ?, ?)",
+                         (task_id, task["status"], json.dumps(task, ensure_ascii=False), now))
+
+    def get_task(self, task_id: str):
+        conn = self._conn()
+        row = conn.execute("SELECT data FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        if row is None:
+            return None
+        task = json.loads(row[0])
+        task["chunk_count"] = conn.execute("SELECT COUNT(*) FROM chunks WHERE task_id = ?", (task_id,)).fetchone()[0]
+        return task
+
+    def update_task(self, task_id: str, **fields) -> bool:
+        with self._transaction() as conn:
+            row = conn.execute("SELECT data FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+            if row is None:
+                return False
+            task = json.loads(row[0])
+            task.update(fields)
+            task["updated_at"] = time.time()
+            conn.execute("UPDATE tasks SET status = ?, data = ?, updated_at = ? WHERE task_id = ?",
+                         (task["status"], json.dumps(task, ensure_ascii=False), task["updated_at"], task_id))
+            return True
+
+    def append_chunk(self, task_id: str, chunk: str) -> int:
+        with self._transaction() as conn:
+            # 与内存后端一致，不为不存在的任务保存数据块
+            if conn.execute("UPDATE tasks SET updated_at = ? WHERE task_id = ?", (time.time(), task_id)).rowcount == 0:
+                raise KeyError(task_id)
+            seq = conn.execute("SELECT COUNT(*) FROM chunks WHERE task_id = ?", (task_id,)).fetchone()[0]
+            conn.execute("INSERT INTO chunks (task_id, seq, chunk) VALUES (?, ?, ?)", (task_id, seq, chunk))
+            return seq + 1
+
+    def read_chunks(self, task_id: str, offset: int) -> list:
+        rows = self._conn().execute("SELECT chunk FROM chunks WHERE task_id = ? AND seq >= ? ORDER BY seq",
+                                    (task_id, offset)).fetchall()
+        return [row[0] for row in rows]
+
+    # --- 会话状态 ---
+
+    def get_session(self, key: str):
+        row = self._conn().execute("SELECT value FROM sessions WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_session(self, key: str, value):
+        self._conn().execute("INSERT OR REPLACE INTO sessions (key, value) VALUES (?, ?)",
+                             (key, json.dumps(value, ensure_ascii=False)))
+
+    def delete_session(self, key: str):
+        self._conn().execute("DELETE FROM sessions WHERE key = ?", (key,))
+
+    def list_sessions(self, prefix: str = "") -> dict:
+        rows = self._conn().execute("SELECT key, value FROM sessions WHERE substr(key, 1, ?) = ?",
+                                    (len(prefix), prefix)).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    # --- worker 注册 ---
+
+    def touch_worker(self, worker_id: str, **info):
+        with self._transaction() as conn:
+            row = conn.execute("SELECT info FROM workers WHERE worker_id = ?", (worker_id,)).fetchone()
+            merged = {**(json.loads(row[0]) if row else {}), **info}
+            conn.execute("INSERT OR REPLACE INTO workers (worker_id, info, last_seen) VALUES (?, ?, ?)",
+                         (worker_id, json.dumps(merged, ensure_ascii=False), time.time()))
+
+    def update_worker(self, worker_id: str, **info) -> bool:
+        with self._transaction() as conn:
+            row = conn.execute("SELECT info FROM workers WHERE worker_id = ?", (worker_id,)).fetchone()
+            if row:
+                conn.execute("UPDATE workers SET info = ? WHERE worker_id = ?",
+                             (json.dumps({**json.loads(row[0]), **info}, ensure_ascii=False), worker_id))
+        return row is not None
+
+    def list_workers(self) -> dict:
+        rows = self._conn().execute("SELECT worker_id, info, last_seen FROM workers").fetchall()
+        return {worker_id: {**json.loads(info), "last_seen": last_seen} for worker_id, info, last_seen in rows}
+
+    def cleanup(self, retention_seconds: float = TASK_RETENTION_SECONDS):
+        cutoff = time.time() - retention_seconds
+        placeholders = ",".join("?" * len(FINISHED_STATUSES))
+        with self._transaction() as conn:
+            stale = [row[0] for row in conn.execute(
+                f"SELECT task_id FROM tasks WHERE status IN ({placeholders}) AND updated_at < ?",
+                (*FINISHED_STATUSES, cutoff)).fetchall()]
+            conn.executemany("DELETE FROM chunks WHERE task_id = ?", [(t,) for t in stale])
+            conn.executemany("DELETE FROM tasks WHERE task_id = ?", [(t,) for t in stale])
+            conn.execute("DELETE FROM workers WHERE last_seen < ?", (time.time() - max(retention_seconds, WORKER_TIMEOUT_SECONDS),))
+        return len(stale)
+
+
+def create_backend() -> BrokerBackend:
+    """根据环境变量创建存储后端"""
+    kind = os.environ.get("BROKER_BACKEND", "memory").lower()
+    if kind == "sqlite":
+        path = os.environ.get("BROKER_SQLITE_PATH", "broker_state.sqlite3")
+        print(f"🗄️ 使用 SQLite 共享存储后端: {path}")
+        return SQLiteBrokerBackend(path)
+    if kind != "memory":
+        print(f"⚠️ 未知的 BROKER_BACKEND '{kind}'，改用内存后端。")
+    journal_path = os.environ.get("BROKER_JOURNAL_PATH", "broker_journal.jsonl")
+    if journal_path:
+        print(f"📜 内存后端已启用任务日志: {journal_path}")
+        return JournaledMemoryBackend(journal_path)
+    return MemoryBrokerBackend()
@@ -0,0 +1,99 @@
+# conftest.py - 测试共用的环境与夹具
+#
+# 测试在导入服务器模块之前把任务日志、负载和批处理目录指向临时目录，不会在仓库中留下文件。
+# `broker` 夹具在随机端口上启动真实的任务代理服务器 (网关通过 HTTP 与其通信)，
+# `workers` 夹具模拟油猴脚本 (history_forger + automator) 领取和完成任务。
+
+import os
+import tempfile
+import threading
+import time
+
+import pytest
+
+TEST_DATA_DIR = tempfile.mkdtemp(prefix="aistudio-proxy-tests-")
+os.environ["BROKER_JOURNAL_PATH"] = ""
+os.environ["BROKER_BLOB_DIR"] = os.path.join(TEST_DATA_DIR, "broker_blobs")
+os.environ["BATCH_DATA_DIR"] = os.path.join(TEST_DATA_DIR, "batch_data")
+os.environ["BLOB_THRESHOLD_BYTES"] = "0"
+
+END_OF_STREAM = "__END_OF_STREAM__"
+
+
+@pytest.fixture(scope="session")
+def broker_server():
+    from werkzeug.serving import make_server
+    import local_history_server
+    import openai_compatible_server
+
+    local_history_server.start_backend()
+    server = make_server("127.0.0.1", 0, local_history_server.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    openai_compatible_server.INTERNAL_SERVER_URL = f"http://127.0.0.1:{server.server_port}"
+    assert local_history_server.BACKEND_READY.wait(timeout=10)
+    yield local_history_server
+    server.shutdown()
+
+
+@pytest.fixture
+def broker(broker_server, monkeypatch):
+    """每个测试使用一个全新的内存后端"""
+    from broker_backend import MemoryBrokerBackend
+    import openai_compatible_server
+
+    monkeypatch.setattr(broker_server, "BACKEND", MemoryBrokerBackend())
+    broker_server.MODEL_DEMAND.clear()
+    openai_compatible_server.LIVENESS_SAMPLES["first_chunk"].clear()
+    openai_compatible_server.LIVENESS_SAMPLES["gap"].clear()
+    return broker_server
+
+
+class FakeWorker:
+    """模拟一个浏览器标签页。chunks=None 时领取任务后不再产出任何数据块 (卡住)。"""
+
+    def __init__(self, client, worker_id, chunks=('[[null,"Hello "]]', '[[null,"world"]]'), delay=0.0):
+        self.client = client
+        self.worker_id = worker_id
+        self.chunks = chunks
+        self.delay = delay
+        self.taken = []
+        self.stop = threading.Event()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while not self.stop.is_set():
+            res = self.client.get(f"/get_injection_job?worker_id={self.worker_id}").json
+            if res.get("status") == "success":
+                self.client.post("/report_injection_complete", json={"status": "completed", "task_id": res["job"]["task_id"], "worker_id": self.worker_id})
+            for path in ("/get_prompt_job", "/get_tool_result_job"):
+                res = self.client.get(f"{path}?worker_id={self.worker_id}").json
+                if res.get("status") == "success":
+                    self._generate(res["job"]["task_id"])
+            time.sleep(0.02)
+
+    def _generate(self, task_id):
+        self.taken.append(task_id)
+        if self.chunks is None:
+            return
+        for chunk in self.chunks:
+            if self.client.post("/stream_chunk", json={"task_id": task_id, "chunk": chunk}).json.get("status") == "cancelled":
+                return
+            time.sleep(self.delay)
+        self.client.post("/stream_chunk", json={"task_id": task_id, "chunk": END_OF_STREAM})
+        self.client.post("/report_result", json={"task_id": task_id, "status": "completed", "content": ""})
+
+
+@pytest.fixture
+def workers(broker):
+    """返回 start(worker_id, chunks=..., delay=...)，测试结束时停止所有模拟的标签页"""
+    started = []
+    client = broker.app.test_client()
+
+    def start(worker_id, **kwargs):
+        worker = FakeWorker(client, worker_id, **kwargs)
+        started.append(worker)
+        return worker
+
+    yield start
+    for worker in started:
+        worker.stop.set()
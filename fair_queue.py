@@ -0,0 +1,131 @@
+# fair_queue.py - 按客户端公平调度的任务队列 (Deficit Round Robin)
+
+import threading
+import time
+from collections import deque
+from queue import Empty
+
+DEFAULT_CLIENT_ID = "anonymous"
+JOB_COST = 1.0 # 每个任务消耗的额度，浏览器一次只处理一个任务，因此按任务计费
+
+
+class FairQueue:
+    """
+    与 queue.Queue 接口兼容 (put / get_nowait / qsize / empty) 的公平队列。
+
+    任务按其 `client_id` 字段归入各自的子队列，出队时使用赤字轮询 (DRR)：
+    每次轮到某个客户端时为其增加 `quantum * client_weight` 的额度，每取出一个任务消耗 JOB_COST。
+    这样单个批量客户端无法独占浏览器，各客户端按权重分享处理能力。
+
+    带有 `deadline` 字段 (Unix 时间戳) 的任务若在出队前已过期，会被直接丢弃并交给 `on_expired` 回调。
+    """
+
+    def __init__(self, quantum: float = 1.0, on_expired=None):
+        self._lock = threading.Lock()
+        self._quantum = quantum
+        self._on_expired = on_expired
+        self._queues = {}     # client_id -> deque[job]
+        self._deficits = {}   # client_id -> 剩余额度
+        self._weights = {}    # client_id -> 权重 (以最近一次入队的任务为准)
+        self._active = deque() # 有待处理任务的客户端，按轮询顺序排列
+        self._size = 0
+
+    def put(self, job: dict):
+        client_id = job.get("client_id") or DEFAULT_CLIENT_ID
+        weight = job.get("client_weight") or 1.0
+        with self._lock:
+            if client_id not in self._queues:
+                self._queues[client_id] = deque()
+                self._deficits[client_id] = 0.0
+                self._active.append(client_id)
+            self._queues[client_id].append(job)
+            self._weights[client_id] = max(float(weight), 0.01)
+            self._size += 1
+
+    def get_nowait(self, accept=None) -> dict:
+        """
+        按 DRR 顺序取出下一个任务。
+        `accept(job)` 可选，返回 False 的任务保留在队列中 (例如指定了其他浏览器的任务)，
+        该客户端本轮被跳过且不消耗额度。
+        """
+        expired_jobs = []
+        try:
+            with self._lock:
+                while True:
+                    job = self._pop_next(accept)
+                    deadline = job.get("deadline")
+                    if deadline and deadline < time.time():
+                        expired_jobs.append(job)
+                        continue
+                    return job
+        finally:
+            # 回调可能涉及 I/O，放在锁外执行
+            if self._on_expired:
+                for job in expired_jobs:
+                    self._on_expired(job)
+
+    def _pop_next(self, accept=None) -> dict:
+        skipped = 0 # 连续跳过的客户端数，全部被跳过说明没有可取的任务
+        while self._active and skipped < len(self._active):
+            client_id = self._active[0]
+            client_queue = self._queues[client_id]
+            index = 0 if accept is None else next((i for i, job in enumerate(client_queue) if accept(job)), None)
+            if index is None:
+                self._active.rotate(-1)
+                skipped += 1
+                continue
+            skipped = 0
+
+            if self._deficits[client_id] < JOB_COST:
+                self._deficits[client_id] += self._quantum * self._weights[client_id]
+                if self._deficits[client_id] < JOB_COST:
+                    # 低权重客户端需要多轮累积额度
+                    self._active.rotate(-1)
+                    continue
+
+            job = client_queue[index]
+            del client_queue[index]
+            self._deficits[client_id] -= JOB_COST
+            self._size -= 1
+
+            if not client_queue:
+                # 队列清空后额度归零，避免空闲客户端囤积额度
+                self._active.popleft()
+                del self._queues[client_id]
+                del self._deficits[client_id]
+                del self._weights[client_id]
+            elif self._deficits[client_id] < JOB_COST:
+                self._active.rotate(-1)
+            return job
+        raise Empty
+
+    def peek(self):
+        """返回 DRR 顺序中下一个客户端的队首任务 (不取出)，队列为空时返回 None"""
+        with self._lock:
+            if not self._active:
+                return None
+            return self._queues[self._active[0]][0]
+
+    def jobs(self) -> list:
+        """【新】返回所有排队中的任务 (同一客户端内保持入队顺序)，用于生成任务日志快照"""
+        with self._lock:
+            return [job for client_id in self._active for job in self._queues[client_id]]
+
+    def qsize(self) -> int:
+        with self._lock:
+            return self._size
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def stats(self) -> dict:
+        """返回每个客户端当前排队的任务数和额度，用于监控。"""
+        with self._lock:
+            return {
+                client_id: {
+                    "queued": len(self._queues[client_id]),
+                    "deficit": round(self._deficits[client_id], 3),
+                    "weight": self._weights[client_id]
+                }
+                for client_id in self._active
+            }
@@ -0,0 +1,204 @@
+# job_journal.py - 追加写入的任务事件日志 (组提交)
+#
+# 内存后端的所有状态变更都以 JSON 行的形式追加到磁盘文件中，进程重启后按顺序重放即可恢复
+# 排队中的任务、任务状态和已收到的流数据块。
+# 写入由后台线程批量完成：数据块等高频事件只需放入内存缓冲区即可返回，
+# 每批事件合并为一次 write + fsync (组提交)；提交任务等低频事件可以选择等待落盘后再返回。
+# 日志增长到上次快照的数倍 (或事件数过多) 时，由后端用当前状态的快照替换日志：
+# start_compaction() 与取快照在后端锁内同时进行，finish_compaction() 在锁外写文件，
+# 再补上期间追加的事件后替换旧日志，压缩过程不阻塞后端的其他操作。
+
+import json
+import os
+import threading
+import time
+
+FLUSH_INTERVAL_SECONDS = 0.05 # 组提交的最长等待时间
+MAX_BATCH_EVENTS = 1024
+# 自上次快照以来写入的字节数超过 max(COMPACT_MIN_BYTES, 快照大小 x COMPACT_GROWTH_RATIO)，
+# 或事件数超过 COMPACT_MAX_EVENTS 时需要压缩
+COMPACT_MIN_BYTES = 64 << 20
+COMPACT_GROWTH_RATIO = 2
+COMPACT_MAX_EVENTS = 500_000
+
+
+class JournalError(RuntimeError):
+    """日志写入线程因 I/O 错误退出，之后的写入都会失败"""
+
+
+class JobJournal:
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8")
+        self._cond = threading.Condition()
+        self._pending = []       # 等待写入的事件行
+        self._appended_seq = 0   # 已放入缓冲区的事件序号
+        self._committed_seq = 0  # 已 fsync 的事件序号
+        self._waiters = 0        # 正在等待落盘的调用方数量，有等待者时立即提交
+        self._writing = False    # 写入线程正在锁外写盘
+        self._closed = False
+        self._error = None       # 写入线程退出的原因
+        self._tail = None        # 压缩期间追加的事件行 (位于快照之后)，不在压缩时为 None
+        self._snapshot_bytes = os.path.getsize(path)
+        self._bytes_since_compact = 0
+        self._events_since_compact = 0
+        self._writer = threading.Thread(target=self._writer_loop, name="job-journal-writer", daemon=True)
+        self._writer.start()
+
+    def _check_error(self):
+        if self._error is not None:
+            raise JournalError(f"任务日志写入失败: {self._error}")
+
+    def append(self, event: dict, wait: bool = False) -> int:
+        """追加一个事件，返回其序号。wait=True 时阻塞直到该事件所在的批次已落盘。"""
+        line = json.dumps(event, ensure_ascii=False, separators=(",", ":"))
+        with self._cond:
+            self._check_error()
+            self._pending.append(line)
+            if self._tail is not None:
+                self._tail.append(line)
+            self._appended_seq += 1
+            self._bytes_since_compact += len(line) + 1
+            self._events_since_compact += 1
+            seq = self._appended_seq
+            self._cond.notify_all()
+        if wait:
+            self.wait_for(seq)
+        return seq
+
+    def wait_for(self, seq: int):
+        """阻塞直到序号 seq 之前的事件都已落盘。写入线程已退出时抛出 JournalError。"""
+        with self._cond:
+            self._waiters += 1
+            self._cond.notify_all()
+            try:
+                while self._committed_seq < seq and not self._closed and self._error is None:
+                    self._cond.wait()
+                if self._committed_seq < seq:
+                    self._check_error()
+            finally:
+                self._waiters -= 1
+
+    def needs_compaction(self) -> bool:
+        with self._cond:
+            return (self._bytes_since_compact > max(COMPACT_MIN_BYTES, self._snapshot_bytes * COMPACT_GROWTH_RATIO)
+                    or self._events_since_compact > COMPACT_MAX_EVENTS)
+
+    def start_compaction(self) -> bool:
+        """
+        开始压缩，此后追加的事件会另外保留一份。调用方应在持有后端锁、取得状态快照的同时调用，
+        使快照恰好包含此前所有事件的效果。已有压缩在进行或日志已关闭时返回 False。
+        """
+        with self._cond:
+            if self._tail is not None or self._closed or self._error is not None:
+                return False
+            self._tail = []
+            return True
+
+    def finish_compaction(self, events: list):
+        """写入快照事件 (不持有任何锁)，再补上压缩期间追加的事件，原子地替换日志文件"""
+        tmp_path = f"{self.path}.compact.tmp"
+        try:
+            f = open(tmp_path, "w", encoding="utf-8")
+            try:
+                for event in events:
+                    f.write(json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n")
+                with self._cond:
+                    # 等写入线程写完当前批次；缓冲区中尚未写入的事件要么已体现在快照中，要么在 tail 中
+                    while self._writing and self._error is None:
+                        self._cond.wait()
+                    self._check_error()
+                    f.write("".join(line + "\n" for line in self._tail))
+                    f.flush()
+                    os.fsync(f.fileno())
+                    f.close()
+                    os.replace(tmp_path, self.path)
+                    self._file.close()
+                    self._file = open(self.path, "a", encoding="utf-8")
+                    self._pending = []
+                    self._snapshot_bytes = os.path.getsize(self.path)
+                    self._bytes_since_compact = 0
+                    self._events_since_compact = 0
+                    self._committed_seq = self._appended_seq
+                    self._tail = None
+                    self._cond.notify_all()
+            finally:
+                f.close()
+        finally:
+            with self._cond:
+                if self._tail is not None: # 压缩失败，继续使用原日志
+                    self._tail = None
+                    self._cond.notify_all()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _writer_loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending and self._closed:
+                    return
+                # 稍等片刻，让更多事件进入同一批次；有调用方在等待落盘时立即提交
+                flush_at = time.monotonic() + FLUSH_INTERVAL_SECONDS
+                while len(self._pending) < MAX_BATCH_EVENTS and not self._waiters and not self._closed:
+                    remaining = flush_at - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(timeout=remaining)
+                batch, self._pending = self._pending, []
+                batch_seq = self._appended_seq
+                self._writing = True
+
+            try:
+                self._file.write("\n".join(batch) + "\n")
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            except Exception as e:
+                print(f"🚨 [Journal] 写入任务日志失败，停止记录: {type(e).__name__}: {e}")
+                with self._cond:
+                    self._error = e
+                    self._writing = False
+                    self._cond.notify_all()
+                return
+
+            with self._cond:
+                self._committed_seq = batch_seq
+                self._writing = False
+                self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            # 等待进行中的压缩完成
+            while self._tail is not None:
+                self._cond.wait()
+            self._closed = True
+            self._cond.notify_all()
+        self._writer.join()
+        self._file.close()
+
+    @staticmethod
+    def read_events(path: str):
+        """按顺序读取日志中的事件。进程崩溃可能留下不完整的最后一行，直接忽略。"""
+        if not os.path.exists(path):
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"⚠️ [Journal] 跳过损坏的日志行: {line[:80]}")
+
+    @staticmethod
+    def write_snapshot(path: str, events: list):
+        """用一组快照事件原子地替换日志文件 (启动时压缩日志)"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for event in events:
+                f.write(json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
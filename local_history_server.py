@@ -1,29 +1,238 @@
 # local_history_server.py
 
-from flask import Flask, request, jsonify
-from queue import Queue, Empty
+from flask import Flask, request, jsonify, send_file
+import ipaddress
 import logging
-import uuid
+import os
 import threading
+import uuid
+import time
+from collections import Counter, deque
+from broker_backend import create_backend, worker_is_healthy, conversation_summary, FINISHED_STATUSES, WORKER_TIMEOUT_SECONDS
+from blob_store import BlobStore, BlobError
+from sampling_profiler import sample_stacks, format_folded, ProfilerBusy, DEFAULT_INTERVAL_SECONDS, MAX_PROFILE_SECONDS
 
 # --- 配置 ---
 log = logging.getLogger('werkzeug')
 log.setLevel(logging.ERROR)
 app = Flask(__name__)
 
+CLEANUP_INTERVAL_SECONDS = 60 # 清理已结束任务的最小间隔
+BACKEND_STARTUP_WAIT_SECONDS = 30 # 后端尚未就绪时，普通请求最多等待的时长
+# 【新】按模型调度浏览器。每个 worker 当前选中的模型记录在 worker 信息中 (model 字段)，
+# 空闲的 worker 会按最近的模型需求被预热到需求不足的模型上。
+MODEL_DEMAND_WINDOW_SECONDS = 600 # 统计模型需求的时间窗口
+WARMUP_IDLE_SECONDS = 30 # worker 空闲超过该时长后才会被切换模型
+# 【新】重放任务日志后，恢复的未完成任务若在该时长内没有网关来读取 (客户端已随旧进程离开)，会被取消
+REPLAY_CLAIM_SECONDS = 15
+PROBE_PATHS = ('/', '/healthz', '/readyz') # 不需要等待后端就绪的探针路径
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN") # 诊断接口 (/debug/profile) 的口令，与网关使用同一个环境变量，留空时只允许本机访问
+BLOB_DIR = os.environ.get("BROKER_BLOB_DIR", "broker_blobs") # 【新】大负载的内容寻址存储目录 (见 blob_store.py)
+
 # --- 数据存储 ---
-INJECTION_JOBS = Queue()
-PROMPT_JOBS = Queue()
-TOOL_RESULT_JOBS = Queue()
-MODEL_FETCH_JOBS = Queue() # 【新】为获取模型列表创建的队列
-# RESULTS 现在为每个任务存储一个包含状态和流数据队列的字典
-RESULTS = {}
-# 【新】用于缓存从油猴脚本获取的模型数据
-REPORTED_MODELS_CACHE = {
-    "data": None,
-    "timestamp": 0,
-    "event": threading.Event() # 用于通知等待方数据已到达
-}
+# 【新】所有任务队列、流数据块和会话状态都保存在可插拔的存储后端中 (见 broker_backend.py)。
+# 注入/对话/工具任务队列按 client_id 公平调度，并支持指定由哪个浏览器 (worker) 处理。
+# 【新】后端在后台线程中创建 (内存后端需要先重放任务日志)，服务器可以立即开始监听，
+# 就绪前 /readyz 返回 503。导入本模块没有副作用，由 start_backend() (启动时或第一个请求到达时) 开始创建。
+BACKEND = None
+BACKEND_READY = threading.Event()
+BACKEND_STATUS = {"error": None, "started_at": None, "ready_at": None}
+INJECTION_QUEUE = "injection"
+PROMPT_QUEUE = "prompt"
+TOOL_RESULT_QUEUE = "tool_result"
+MODEL_FETCH_QUEUE = "model_fetch" # 【新】为获取模型列表创建的队列
+REPORTED_MODELS_KEY = "reported_models" # 【新】用于缓存从油猴脚本获取的模型数据
+CONVERSATION_KEY_PREFIX = "conversation:" # 每个 worker 页面中当前的对话状态
+LEGACY_WORKER_ID = "default" # 未上报 worker_id 的旧版脚本共用的标识
+LAST_CLEANUP = {"timestamp": 0}
+UNCLAIMED_TASKS = set() # 重放后尚未被网关读取过的任务
+MODEL_DEMAND = deque() # (时间, 模型)，最近的模型请求记录
+MODEL_DEMAND_LOCK = threading.Lock()
+BLOBS = BlobStore(BLOB_DIR)
+
+
+# --- 启动 ---
+
+def _init_backend():
+    global BACKEND
+    try:
+        BACKEND = create_backend()
+    except Exception as e:
+        BACKEND_STATUS["error"] = f"{type(e).__name__}: {e}"
+        print(f"❌ 存储后端初始化失败: {BACKEND_STATUS['error']}")
+        return
+    BACKEND_STATUS["ready_at"] = time.time()
+    if BACKEND.replayed_task_ids:
+        UNCLAIMED_TASKS.update(BACKEND.replayed_task_ids)
+        timer = threading.Timer(REPLAY_CLAIM_SECONDS, _abandon_unclaimed_tasks)
+        timer.daemon = True
+        timer.start()
+    BACKEND_READY.set()
+    print(f"✅ 存储后端已就绪 (耗时 {BACKEND_STATUS['ready_at'] - BACKEND_STATUS['started_at']:.2f} 秒)。")
+
+def _abandon_unclaimed_tasks():
+    """取消重放后一直没有网关读取的任务，排队中的不再交给浏览器，生成中的在下一个数据块时中止"""
+    abandoned = 0
+    for task_id in list(UNCLAIMED_TASKS):
+        UNCLAIMED_TASKS.discard(task_id)
+        task = BACKEND.get_task(task_id)
+        if task and task['status'] not in FINISHED_STATUSES:
+            BACKEND.update_task(task_id, status='cancelled', cancel_reason='abandoned')
+            abandoned += 1
+    if abandoned:
+        print(f"🧹 已取消 {abandoned} 个重启后无人认领的任务。")
+
+BACKEND_START_LOCK = threading.Lock()
+
+def start_backend():
+    """在后台线程中创建存储后端 (可重复调用，只会启动一次)"""
+    with BACKEND_START_LOCK:
+        if BACKEND_STATUS["started_at"] is not None:
+            return
+        BACKEND_STATUS["started_at"] = time.time()
+    threading.Thread(target=_init_backend, name="broker-backend-init", daemon=True).start()
+
+@app.before_request
+def _wait_for_backend():
+    """后端就绪前到达的请求稍作等待，超时返回 503 (探针请求除外)"""
+    start_backend() # 通过其他 WSGI 服务器加载 app 时，由第一个请求触发创建
+    if request.path in PROBE_PATHS or BACKEND_READY.is_set():
+        return None
+    if not BACKEND_READY.wait(timeout=BACKEND_STARTUP_WAIT_SECONDS):
+        return jsonify({"status": "error", "message": "存储后端尚未就绪。"}), 503
+    return None
+
+
+# --- 辅助函数 ---
+
+def _worker_id(role: str = None):
+    """读取请求中携带的 worker_id (浏览器标签页标识)，并刷新该 worker 的心跳"""
+    worker_id = request.args.get('worker_id')
+    if not worker_id and request.is_json:
+        worker_id = (request.get_json(silent=True) or {}).get('worker_id')
+    if worker_id:
+        BACKEND.touch_worker(worker_id, **({f"last_{role}_poll": time.time()} if role else {}))
+    return worker_id
+
+def _maybe_cleanup():
+    """定期清理已结束的任务，避免流数据无限增长"""
+    now = time.time()
+    if now - LAST_CLEANUP["timestamp"] < CLEANUP_INTERVAL_SECONDS:
+        return
+    LAST_CLEANUP["timestamp"] = now
+    removed = BACKEND.cleanup()
+    if removed:
+        print(f"🧹 已清理 {removed} 个过期任务。")
+    removed_blobs = BLOBS.cleanup()
+    if removed_blobs:
+        print(f"🧹 已清理 {removed_blobs} 个过期负载。")
+
+def _affinity_fields(data: dict) -> dict:
+    """网关可以指定任务必须/优先由哪个 worker 处理 (例如对话必须在完成注入的那个标签页中继续)"""
+    return {"worker_id": data.get('worker_id'), "strict_affinity": bool(data.get('strict_affinity'))}
+
+def _take_job(queue_name: str, worker_id: str):
+    """为 worker 领取任务，并记录任务由谁处理"""
+    job = BACKEND.take_job(queue_name, worker_id)
+    if job and job.get('task_id'):
+        BACKEND.update_task(job['task_id'], status="running", worker_id=worker_id, picked_at=time.time())
+    if job and worker_id:
+        BACKEND.touch_worker(worker_id, last_job_at=time.time(), current_task_id=job.get('task_id'))
+    return job
+
+# --- 【新】模型需求与预热 ---
+
+def _record_model_demand(model: str):
+    if not model:
+        return
+    with MODEL_DEMAND_LOCK:
+        MODEL_DEMAND.append((time.time(), model))
+
+def _model_demand() -> Counter:
+    cutoff = time.time() - MODEL_DEMAND_WINDOW_SECONDS
+    with MODEL_DEMAND_LOCK:
+        while MODEL_DEMAND and MODEL_DEMAND[0][0] < cutoff:
+            MODEL_DEMAND.popleft()
+        return Counter(model for _, model in MODEL_DEMAND)
+
+def _worker_model(info: dict):
+    """worker 当前 (或正在预热到) 的模型"""
+    return info.get("warming_model") or info.get("model")
+
+def _warm_targets(worker_count: int, demand: Counter) -> dict:
+    """按需求比例 (最大余数法) 把 worker 分配给各个模型；worker 足够时每个有需求的模型至少一个"""
+    total = sum(demand.values())
+    if not worker_count or not total:
+        return {}
+    ranked = demand.most_common()
+    targets = {model: 1 for model, _ in ranked[:worker_count]}
+    spare = worker_count - len(targets)
+    shares = {model: count * spare / total for model, count in ranked if model in targets}
+    for model, share in shares.items():
+        targets[model] += int(share)
+    leftover = worker_count - sum(targets.values())
+    for model in sorted(shares, key=lambda m: shares[m] - int(shares[m]), reverse=True)[:leftover]:
+        targets[model] += 1
+    return targets
+
+def _model_mix() -> dict:
+    """当前各模型的需求、目标 worker 数和实际 worker 数"""
+    live_workers = BACKEND.live_workers()
+    demand = _model_demand()
+    return {
+        "demand": dict(demand),
+        "targets": _warm_targets(len(live_workers), demand),
+        "workers": dict(Counter(_worker_model(info) or "unknown" for info in live_workers.values()))
+    }
+
+def _conversation_summary(state: dict) -> dict:
+    """兼容旧版网关保存的完整对话状态 (带 messages)，统一转换为摘要"""
+    if "messages" in state:
+        return conversation_summary(state["messages"], state.get("model"), state.get("tools"))
+    return state
+
+def _has_conversation(worker_id: str) -> bool:
+    """worker 页面中是否保留着可以走快速通道的对话"""
+    state = BACKEND.get_session(f"{CONVERSATION_KEY_PREFIX}{worker_id}")
+    return bool(state and _conversation_summary(state).get("message_count"))
+
+def _is_busy(info: dict) -> bool:
+    """【新】worker 最近领取的任务是否仍在进行 (长时间的生成不会因 last_job_at 过期而被当作空闲)"""
+    task = BACKEND.get_task(info["current_task_id"]) if info.get("current_task_id") else None
+    return bool(task and task["status"] not in FINISHED_STATUSES)
+
+def _warmup_job_for(worker_id: str):
+    """
+    该 worker 空闲且其模型已超出目标配比时，返回一个把它切换到需求不足的模型的预热注入任务 (空对话)。
+    预热完成后该页面即可直接承接该模型的新对话，无需再注入。
+    页面中还保留着对话的 worker 不会被预热，以免丢掉可以继续走快速通道的对话。
+    """
+    live_workers = BACKEND.live_workers()
+    info = live_workers.get(worker_id) if worker_id else None
+    if not info or not worker_is_healthy(info) or time.time() - info.get("last_job_at", 0) < WARMUP_IDLE_SECONDS:
+        return None
+    if _is_busy(info):
+        return None
+    demand = _model_demand()
+    targets = _warm_targets(len(live_workers), demand)
+    current = Counter(_worker_model(worker) for worker in live_workers.values())
+    own_model = _worker_model(info)
+    if own_model in targets and current[own_model] <= targets[own_model]:
+        return None
+    if _has_conversation(worker_id):
+        return None
+    shortages = sorted((model for model in targets if current[model] < targets[model]), key=lambda m: -demand[m])
+    if not shortages:
+        return None
+
+    model = shortages[0]
+    # 先让网关看不到该页面的旧状态 (预热期间 /conversation_states 也会跳过它)，再交出预热任务
+    BACKEND.touch_worker(worker_id, warming_model=model, last_job_at=time.time())
+    BACKEND.delete_session(f"{CONVERSATION_KEY_PREFIX}{worker_id}")
+    task_id = str(uuid.uuid4())
+    BACKEND.create_task(task_id, kind="injection", model=model, warmup=True, status="running", worker_id=worker_id, picked_at=time.time())
+    print(f"🔥 预热: worker {worker_id} 从 {own_model or '未知模型'} 切换到 {model} (目标配比: {targets})。")
+    return {"task_id": task_id, "model": model, "messages": [], "warmup": True}
 
 
 # --- API 端点 ---
@@ -32,22 +241,85 @@ REPORTED_MODELS_CACHE = {
 def index():
     return "历史编辑代理服务器 v6.0 (Model Fetcher Ready) 正在运行。"
 
-# --- 注入 API (无变化) ---
+# --- 【新】健康检查 ---
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """存活探针：进程能响应请求即可"""
+    return jsonify({"status": "ok"}), 200
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """就绪探针：存储后端可用时返回 200，并附带在线 worker 数和各队列长度"""
+    if not BACKEND_READY.is_set():
+        return jsonify({"status": "starting" if not BACKEND_STATUS["error"] else "error", "error": BACKEND_STATUS["error"]}), 503
+    try:
+        live_workers = BACKEND.live_workers()
+        queues = {name: BACKEND.queue_size(name) for name in (INJECTION_QUEUE, PROMPT_QUEUE, TOOL_RESULT_QUEUE, MODEL_FETCH_QUEUE)}
+    except Exception as e:
+        return jsonify({"status": "error", "error": f"{type(e).__name__}: {e}"}), 503
+    return jsonify({
+        "status": "ready",
+        "backend": type(BACKEND).__name__,
+        "workers": len(live_workers),
+        "queues": queues,
+        "startup_seconds": round(BACKEND_STATUS["ready_at"] - BACKEND_STATUS["started_at"], 3),
+        "pid": os.getpid()
+    }), 200
+
+# --- 注入 API ---
 @app.route('/submit_injection_job', methods=['POST'])
 def submit_injection_job():
     job_data = request.json
-    INJECTION_JOBS.put(job_data)
-    print(f"✅ 已接收到新的【注入任务】。注入队列现有任务: {INJECTION_JOBS.qsize()}。")
-    return jsonify({"status": "success", "message": "Injection job submitted"}), 200
+    # 旧版网关不提供 task_id，这里补上以便跟踪注入状态
+    task_id = job_data.setdefault('task_id', str(uuid.uuid4()))
+    job_data.setdefault('submitted_at', time.time())
+    BACKEND.create_task(task_id, kind="injection", model=job_data.get('model'))
+    BACKEND.put_job(INJECTION_QUEUE, job_data)
+    _record_model_demand(job_data.get('model'))
+    _maybe_cleanup()
+    print(f"✅ 已接收到新的【注入任务】(ID: {task_id[:8]})。注入队列现有任务: {BACKEND.queue_size(INJECTION_QUEUE)}。")
+    return jsonify({"status": "success", "message": "Injection job submitted", "task_id": task_id}), 200
 
 @app.route('/get_injection_job', methods=['GET'])
 def get_injection_job():
-    try:
-        job = INJECTION_JOBS.get_nowait()
-        print(f"🚀 History Forger 已取走注入任务。队列剩余: {INJECTION_JOBS.qsize()}。")
-        return jsonify({"status": "success", "job": job}), 200
-    except Empty:
+    worker_id = _worker_id("history_forger")
+    job = _take_job(INJECTION_QUEUE, worker_id) or _warmup_job_for(worker_id)
+    if job is None:
         return jsonify({"status": "empty"}), 200
+    print(f"🚀 History Forger 已取走注入任务 (ID: {job['task_id'][:8]})。队列剩余: {BACKEND.queue_size(INJECTION_QUEUE)}。")
+    return jsonify({"status": "success", "job": job}), 200
+
+@app.route('/report_injection_complete', methods=['POST'])
+def report_injection_complete():
+    """【新】由 historyforger.js 在注入完成后调用，记录完成注入的 worker，网关据此把后续对话发给同一个标签页"""
+    data = request.json or {}
+    task_id = data.get('task_id')
+    worker_id = _worker_id("history_forger")
+    status = data.get('status', 'completed')
+    if task_id and BACKEND.update_task(task_id, status=status, worker_id=worker_id):
+        task = BACKEND.get_task(task_id)
+        model = data.get('model') or task.get('model')
+        if worker_id and status == 'completed':
+            # 注入会把页面切换到任务指定的模型
+            BACKEND.touch_worker(worker_id, model=model or _worker_model(BACKEND.list_workers().get(worker_id, {})), warming_model=None)
+            if task.get('warmup'):
+                # 预热后的页面是该模型下的空对话，网关可以直接把新对话发给它
+                BACKEND.set_session(f"{CONVERSATION_KEY_PREFIX}{worker_id}", conversation_summary([], model))
+        elif worker_id and task.get('warmup'):
+            # 预热失败，页面处于未知状态，不再按预热目标计算其模型
+            BACKEND.touch_worker(worker_id, warming_model=None)
+        print(f"✔️ 注入任务 {task_id[:8]} 已由 worker {worker_id or LEGACY_WORKER_ID} 完成 (模型: {model or '未指定'})。")
+        return jsonify({"status": "success"}), 200
+    return jsonify({"status": "error", "message": "无效的任务 ID。"}), 404
+
+@app.route('/task/<task_id>', methods=['GET'])
+def get_task(task_id):
+    """查询任务状态 (不含数据块内容)"""
+    UNCLAIMED_TASKS.discard(task_id)
+    task = BACKEND.get_task(task_id)
+    if task is None:
+        return jsonify({"status": "not_found"}), 404
+    return jsonify({"status": "success", "task": task}), 200
 
 # --- 交互式对话 API (升级以支持流式传输) ---
 
@@ -56,27 +328,31 @@ def submit_prompt():
     data = request.json
     if not data or 'prompt' not in data:
         return jsonify({"status": "error", "message": "需要 'prompt' 字段。"}), 400
-    
+
     task_id = str(uuid.uuid4())
-    job = {"task_id": task_id, "prompt": data['prompt']}
-    PROMPT_JOBS.put(job)
-    # 为新任务初始化结果存储，包括一个专用的流队列
-    RESULTS[task_id] = {
-        "status": "pending",
-        "stream_queue": Queue(),
-        "full_response": None
+    job = {
+        "task_id": task_id,
+        "prompt": data['prompt'],
+        "client_id": data.get('client_id'),
+        "client_weight": data.get('client_weight'),
+        "deadline": data.get('deadline'),
+        **_affinity_fields(data)
     }
-    print(f"✅ 已接收到新的【对话任务】(ID: {task_id[:8]})。对话队列现有任务: {PROMPT_JOBS.qsize()}。")
+    # 先为新任务初始化结果存储，再入队，避免 worker 取走任务时状态尚未建立
+    BACKEND.create_task(task_id, kind="prompt")
+    BACKEND.put_job(PROMPT_QUEUE, job)
+    _record_model_demand(_worker_model(BACKEND.list_workers().get(job.get('worker_id'), {})))
+    _maybe_cleanup()
+    print(f"✅ 已接收到新的【对话任务】(ID: {task_id[:8]})。对话队列现有任务: {BACKEND.queue_size(PROMPT_QUEUE)}。")
     return jsonify({"status": "success", "task_id": task_id}), 200
 
 @app.route('/get_prompt_job', methods=['GET'])
 def get_prompt_job():
-    try:
-        job = PROMPT_JOBS.get_nowait()
-        print(f"🚀 Automator 已取走对话任务 (ID: {job['task_id'][:8]})。队列剩余: {PROMPT_JOBS.qsize()}。")
-        return jsonify({"status": "success", "job": job}), 200
-    except Empty:
+    job = _take_job(PROMPT_QUEUE, _worker_id("automator"))
+    if job is None:
         return jsonify({"status": "empty"}), 200
+    print(f"🚀 Automator 已取走对话任务 (ID: {job['task_id'][:8]})。队列剩余: {BACKEND.queue_size(PROMPT_QUEUE)}。")
+    return jsonify({"status": "success", "job": job}), 200
 
 # --- 【【【新】】】流式数据 API ---
 
@@ -86,50 +362,86 @@ def stream_chunk():
     data = request.json
     task_id = data.get('task_id')
     chunk = data.get('chunk')
-    
+
     # 【【【调试日志】】】
     print(f"\n--- 📥 [Local Server] 收到来自 Automator 的数据块 (Task ID: {task_id[:8]}) ---")
     print(chunk)
     print("--------------------------------------------------------------------")
-    
-    if task_id in RESULTS:
-        # 将数据块（或结束信号）放入对应任务的队列中
-        RESULTS[task_id]['stream_queue'].put(chunk)
-        return jsonify({"status": "success"}), 200
-    return jsonify({"status": "error", "message": "无效的任务 ID"}), 404
+
+    task = BACKEND.get_task(task_id)
+    if task is None:
+        return jsonify({"status": "error", "message": "无效的任务 ID"}), 404
+    if task['worker_id']:
+        BACKEND.touch_worker(task['worker_id']) # 生成过程中 worker 不轮询，以数据块作为心跳
+    if task['status'] in ('cancelled', 'expired'):
+        # 通知 Automator 客户端已离开，应中止当前生成
+        return jsonify({"status": "cancelled"}), 200
+    # 追加数据块（或结束信号），网关按偏移量读取
+    try:
+        BACKEND.append_chunk(task_id, chunk)
+    except KeyError:
+        # 任务在检查之后被清理
+        return jsonify({"status": "error", "message": "无效的任务 ID"}), 404
+    return jsonify({"status": "success"}), 200
 
 @app.route('/get_chunk/<task_id>', methods=['GET'])
 def get_chunk(task_id):
-    """Python 客户端从此端点轮询数据块"""
-    if task_id in RESULTS:
-        try:
-            # 非阻塞地从队列中获取数据
-            chunk = RESULTS[task_id]['stream_queue'].get_nowait()
-            # 【【【调试日志】】】
-            print(f"\n--- 📤 [Local Server] API 网关已取走数据块 (Task ID: {task_id[:8]}) ---")
-            print(chunk)
-            print("------------------------------------------------------------------")
-            return jsonify({"status": "ok", "chunk": chunk}), 200
-        except Empty:
-            # 如果队列为空，检查任务是否已完成
-            if RESULTS[task_id]['status'] in ['completed', 'failed']:
-                return jsonify({"status": "done"}), 200
-            else:
-                return jsonify({"status": "empty"}), 200
-    return jsonify({"status": "not_found"}), 404
-    
+    """
+    Python 客户端从此端点轮询数据块。
+    - 带 offset 参数时返回从该位置开始的所有数据块 (可重复读取，支持多个网关/断点续读)；
+    - 不带 offset 时保持旧行为，每次返回一个数据块并由服务器记录读取位置。
+    """
+    UNCLAIMED_TASKS.discard(task_id) # 网关仍在等待该任务 (重启后继续读取)
+    task = BACKEND.get_task(task_id)
+    if task is None:
+        return jsonify({"status": "not_found"}), 404
+
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        chunks = BACKEND.read_chunks(task_id, task['cursor'])[:1]
+        if chunks:
+            BACKEND.update_task(task_id, cursor=task['cursor'] + 1)
+            return jsonify({"status": "ok", "chunk": chunks[0]}), 200
+    else:
+        chunks = BACKEND.read_chunks(task_id, offset)
+        if chunks:
+            # picked_at 供网关记录任务被浏览器领取的时间 (请求时间线)
+            return jsonify({"status": "ok", "chunks": chunks, "next_offset": offset + len(chunks), "picked_at": task.get('picked_at')}), 200
+
+    # 如果没有新数据，检查任务是否已完成
+    if task['status'] in FINISHED_STATUSES:
+        return jsonify({"status": "done", "task_status": task['status']}), 200
+    # 【新】网关据此判断任务是否已被领取，领取后迟迟没有数据块即视为生成卡住
+    return jsonify({"status": "empty", "picked_at": task.get('picked_at'), "worker_id": task.get('worker_id')}), 200
+
 @app.route('/report_result', methods=['POST'])
 def report_result():
     """当油猴脚本确认整个对话结束后，调用此接口来最终确定任务状态"""
     data = request.json
     task_id = data.get('task_id')
-    if task_id and task_id in RESULTS:
-        RESULTS[task_id]['status'] = data.get('status', 'completed')
-        RESULTS[task_id]['full_response'] = data.get('content', '') # 存储最终的完整响应以供调试
-        print(f"✔️ 任务 {task_id[:8]} 已完成。状态: {RESULTS[task_id]['status']}。")
+    task = BACKEND.get_task(task_id) if task_id else None
+    if task:
+        status = task['status'] if task['status'] in ('cancelled', 'expired') else data.get('status', 'completed')
+        # 存储最终的完整响应以供调试
+        BACKEND.update_task(task_id, status=status, full_response=data.get('content', ''))
+        if task.get('worker_id'):
+            # 【新】空闲时间从生成结束时算起 (见 _warmup_job_for)
+            BACKEND.update_worker(task['worker_id'], last_job_at=time.time())
+        print(f"✔️ 任务 {task_id[:8]} 已完成。状态: {status}。")
         return jsonify({"status": "success"}), 200
     return jsonify({"status": "error", "message": "无效的任务 ID。"}), 404
 
+@app.route('/cancel_task/<task_id>', methods=['POST'])
+def cancel_task(task_id):
+    """由 OpenAI 网关在客户端断开或超过截止时间时调用。排队中的任务会被跳过，进行中的生成会在下一个数据块时被中止。"""
+    task = BACKEND.get_task(task_id)
+    if task is None:
+        return jsonify({"status": "error", "message": "无效的任务 ID。"}), 404
+    if task['status'] not in FINISHED_STATUSES:
+        BACKEND.update_task(task_id, status='cancelled')
+        print(f"🛑 任务 {task_id[:8]} 已被网关取消。")
+    return jsonify({"status": "success"}), 200
+
 # --- 【【【新】】】工具函数结果 API ---
 
 @app.route('/submit_tool_result', methods=['POST'])
@@ -138,46 +450,176 @@ def submit_tool_result():
     data = request.json
     if not data or 'task_id' not in data or 'result' not in data:
         return jsonify({"status": "error", "message": "需要 'task_id' 和 'result' 字段。"}), 400
-    
-    task_id = data['task_id']
-    job = {"task_id": task_id, "result": data['result']}
-    TOOL_RESULT_JOBS.put(job)
 
-    # 【【【核心修复】】】为这个新任务初始化结果存储，否则后续的流数据将无处安放
-    RESULTS[task_id] = {
-        "status": "pending",
-        "stream_queue": Queue(),
-        "full_response": None
+    task_id = data['task_id']
+    job = {
+        "task_id": task_id,
+        "result": data['result'],
+        "client_id": data.get('client_id'),
+        "client_weight": data.get('client_weight'),
+        "deadline": data.get('deadline'),
+        **_affinity_fields(data)
     }
-    
-    print(f"✅ 已接收到新的【工具返回任务】(ID: {task_id[:8]}) 并已为其准备好流接收队列。工具队列现有任务: {TOOL_RESULT_JOBS.qsize()}。")
+    # 【【【核心修复】】】为这个新任务初始化结果存储，否则后续的流数据将无处安放
+    BACKEND.create_task(task_id, kind="tool_result")
+    BACKEND.put_job(TOOL_RESULT_QUEUE, job)
+    _record_model_demand(_worker_model(BACKEND.list_workers().get(job.get('worker_id'), {})))
+    _maybe_cleanup()
+
+    print(f"✅ 已接收到新的【工具返回任务】(ID: {task_id[:8]}) 并已为其准备好流接收队列。工具队列现有任务: {BACKEND.queue_size(TOOL_RESULT_QUEUE)}。")
     return jsonify({"status": "success"}), 200
 
 @app.route('/get_tool_result_job', methods=['GET'])
 def get_tool_result_job():
     """供 Automator 油猴脚本获取工具函数返回任务"""
-    try:
-        job = TOOL_RESULT_JOBS.get_nowait()
-        print(f"🚀 Automator 已取走工具返回任务 (ID: {job['task_id'][:8]})。队列剩余: {TOOL_RESULT_JOBS.qsize()}。")
-        return jsonify({"status": "success", "job": job}), 200
-    except Empty:
+    job = _take_job(TOOL_RESULT_QUEUE, _worker_id("automator"))
+    if job is None:
         return jsonify({"status": "empty"}), 200
+    print(f"🚀 Automator 已取走工具返回任务 (ID: {job['task_id'][:8]})。队列剩余: {BACKEND.queue_size(TOOL_RESULT_QUEUE)}。")
+    return jsonify({"status": "success", "job": job}), 200
+
+# --- 【新】大负载 API (内容寻址，gzip 压缩) ---
+
+@app.route('/blobs/<digest>', methods=['GET'])
+def get_blob(digest):
+    """
+    下载 gzip 压缩的负载。支持 Range 请求，浏览器按块下载并流式解压。
+    HEAD 请求用于网关检查负载是否已存在 (存在时无需重复上传)。
+    """
+    try:
+        size = BLOBS.stat(digest)
+    except BlobError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    if size is None:
+        return jsonify({"status": "not_found"}), 404
+    return send_file(os.path.abspath(BLOBS.path(digest)), mimetype="application/gzip", conditional=True, max_age=0)
+
+@app.route('/blobs/<digest>', methods=['PUT'])
+def put_blob(digest):
+    """网关以分块传输上传 gzip 压缩的负载，服务器边写入边校验摘要"""
+    try:
+        existing = BLOBS.stat(digest)
+        if existing is not None:
+            return jsonify({"status": "success", "compressed_bytes": existing, "deduplicated": True}), 200
+        compressed_size = BLOBS.put_stream(digest, request.stream)
+    except BlobError as e:
+        print(f"🚨 负载 {digest[:12]} 上传失败: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 400
+    print(f"📦 已接收负载 {digest[:12]} ({compressed_size} 字节，gzip)。")
+    return jsonify({"status": "success", "compressed_bytes": compressed_size, "deduplicated": False}), 201
+
+# --- 【新】调度状态与 worker API ---
+
+@app.route('/scheduler_stats', methods=['GET'])
+def scheduler_stats():
+    """查看各任务队列中每个客户端的排队情况"""
+    return jsonify({
+        "injection": BACKEND.queue_stats(INJECTION_QUEUE),
+        "prompt": BACKEND.queue_stats(PROMPT_QUEUE),
+        "tool_result": BACKEND.queue_stats(TOOL_RESULT_QUEUE),
+        "models": _model_mix()
+    }), 200
+
+@app.route('/workers', methods=['GET'])
+def list_workers():
+    """列出所有已知的浏览器 worker 及其在线状态"""
+    now = time.time()
+    workers = {
+        worker_id: {**info, "alive": now - info["last_seen"] <= WORKER_TIMEOUT_SECONDS, "healthy": worker_is_healthy(info)}
+        for worker_id, info in BACKEND.list_workers().items()
+    }
+    return jsonify({"status": "success", "workers": workers}), 200
+
+@app.route('/workers/<worker_id>/health', methods=['POST'])
+def set_worker_health(worker_id):
+    """【新】由网关在检测到生成卡住时调用，在 seconds 秒内不再给该 worker 分配新任务 (healthy=true 时立即恢复)"""
+    data = request.get_json(silent=True) or {}
+    if data.get('healthy'):
+        fields = {"unhealthy_until": 0, "unhealthy_reason": None}
+    else:
+        fields = {"unhealthy_until": time.time() + float(data.get('seconds', 60)), "unhealthy_reason": data.get('reason')}
+    if not BACKEND.update_worker(worker_id, **fields):
+        return jsonify({"status": "error", "message": "未知的 worker。"}), 404
+    if data.get('healthy'):
+        print(f"💚 worker {worker_id} 已恢复健康。")
+    else:
+        print(f"🩺 worker {worker_id} 被标记为不健康 ({data.get('seconds', 60)} 秒): {data.get('reason') or '未说明原因'}。")
+    return jsonify({"status": "success"}), 200
+
+# --- 【新】诊断 API ---
+
+def _is_admin() -> bool:
+    """设置了 ADMIN_TOKEN 时校验 X-Admin-Token 头，未设置时只接受本机发来的请求"""
+    if ADMIN_TOKEN:
+        return request.headers.get('X-Admin-Token') == ADMIN_TOKEN
+    try:
+        return ipaddress.ip_address(request.remote_addr or "").is_loopback
+    except ValueError:
+        return False
+
+@app.route('/debug/profile', methods=['GET', 'POST'])
+def debug_profile():
+    """开启采样分析器 seconds 秒，返回聚合后的调用栈 (format=folded 时返回折叠栈文本)"""
+    if not _is_admin():
+        return jsonify({"status": "error", "message": "无效的管理口令。"}), 403
+    seconds = min(request.args.get('seconds', 5, type=float), MAX_PROFILE_SECONDS)
+    try:
+        result = sample_stacks(seconds, request.args.get('interval', DEFAULT_INTERVAL_SECONDS, type=float))
+    except ProfilerBusy:
+        return jsonify({"status": "error", "message": "已有采样任务正在运行。"}), 409
+    if request.args.get('format') == 'folded':
+        return format_folded(result["stacks"]), 200, {"Content-Type": "text/plain; charset=utf-8"}
+    return jsonify({"status": "success", **result}), 200
+
+# --- 【新】会话状态 API (多个网关实例共享) ---
+
+@app.route('/conversation_states', methods=['GET'])
+def get_conversation_states():
+    """
+    返回在线 worker 页面中的对话摘要 {worker_id: {model, signature, message_count}}，网关据此判断能否走快速通道。
+    【新】带 signature 参数时只返回摘要与之相同的 worker。
+    """
+    signature = request.args.get('signature')
+    live_workers = BACKEND.live_workers()
+    states = {}
+    for key, state in BACKEND.list_sessions(CONVERSATION_KEY_PREFIX).items():
+        worker_id = key[len(CONVERSATION_KEY_PREFIX):]
+        # 不健康或正在预热的 worker 不再承接快速通道，网关会在其他 worker 上重新注入
+        if worker_id == LEGACY_WORKER_ID or (worker_id in live_workers and worker_is_healthy(live_workers[worker_id])
+                                             and not live_workers[worker_id].get("warming_model")):
+            summary = _conversation_summary(state)
+            if not signature or summary.get("signature") == signature:
+                states[worker_id] = summary
+    return jsonify({"status": "success", "states": states}), 200
+
+@app.route('/conversation_states', methods=['DELETE'])
+def clear_conversation_states():
+    for key in BACKEND.list_sessions(CONVERSATION_KEY_PREFIX):
+        BACKEND.delete_session(key)
+    return jsonify({"status": "success"}), 200
+
+@app.route('/conversation_state/<worker_id>', methods=['PUT', 'DELETE'])
+def conversation_state(worker_id):
+    key = f"{CONVERSATION_KEY_PREFIX}{worker_id}"
+    if request.method == 'DELETE':
+        BACKEND.delete_session(key)
+    else:
+        BACKEND.set_session(key, _conversation_summary(request.json or {}))
+    return jsonify({"status": "success"}), 200
 
 # --- 【【【新】】】模型获取 API ---
 
 @app.route('/submit_model_fetch_job', methods=['POST'])
 def submit_model_fetch_job():
     """由 OpenAI 网关调用，创建一个“获取模型列表”的任务"""
-    if not MODEL_FETCH_JOBS.empty():
+    if BACKEND.queue_size(MODEL_FETCH_QUEUE) > 0:
         return jsonify({"status": "success", "message": "A fetch job is already pending."}), 200
-    
+
     task_id = str(uuid.uuid4())
     job = {"task_id": task_id, "type": "FETCH_MODELS"}
-    MODEL_FETCH_JOBS.put(job)
-    
-    # 重置事件，以便新的请求可以等待
-    REPORTED_MODELS_CACHE['event'].clear()
-    REPORTED_MODELS_CACHE['data'] = None
+    # 重置缓存，以便新的请求可以等待
+    BACKEND.delete_session(REPORTED_MODELS_KEY)
+    BACKEND.put_job(MODEL_FETCH_QUEUE, job)
 
     print(f"✅ 已接收到新的【模型获取任务】(ID: {task_id[:8]})。")
     return jsonify({"status": "success", "task_id": task_id})
@@ -185,21 +627,19 @@ def submit_model_fetch_job():
 @app.route('/get_model_fetch_job', methods=['GET'])
 def get_model_fetch_job():
     """由 Model Fetcher 油猴脚本轮询，以检查是否有待处理的获取任务"""
-    try:
-        job = MODEL_FETCH_JOBS.queue[0] # 查看任务但不取出
-        return jsonify({"status": "success", "job": job}), 200
-    except IndexError:
+    job = BACKEND.peek_job(MODEL_FETCH_QUEUE) # 查看任务但不取出
+    if job is None:
         return jsonify({"status": "empty"}), 200
+    return jsonify({"status": "success", "job": job}), 200
 
 @app.route('/acknowledge_model_fetch_job', methods=['POST'])
 def acknowledge_model_fetch_job():
     """Model Fetcher 在收到任务并准备刷新页面前调用此接口，以从队列中安全地移除任务"""
-    try:
-        job = MODEL_FETCH_JOBS.get_nowait()
-        print(f"🚀 Model Fetcher 已确认并取走模型获取任务 (ID: {job['task_id'][:8]})。")
-        return jsonify({"status": "success"}), 200
-    except Empty:
+    job = BACKEND.take_job(MODEL_FETCH_QUEUE)
+    if job is None:
         return jsonify({"status": "error", "message": "No job to acknowledge."}), 400
+    print(f"🚀 Model Fetcher 已确认并取走模型获取任务 (ID: {job['task_id'][:8]})。")
+    return jsonify({"status": "success"}), 200
 
 
 @app.route('/report_models', methods=['POST'])
@@ -208,9 +648,8 @@ def report_models():
     data = request.json
     models_json = data.get('models_json')
     if models_json:
-        REPORTED_MODELS_CACHE['data'] = models_json
-        REPORTED_MODELS_CACHE['timestamp'] = uuid.uuid4().int # 使用UUID确保时间戳唯一
-        REPORTED_MODELS_CACHE['event'].set() # 通知所有等待方，数据已到达
+        # 使用UUID确保时间戳唯一
+        BACKEND.set_session(REPORTED_MODELS_KEY, {"data": models_json, "timestamp": uuid.uuid4().int})
         print(f"✔️ 成功接收并缓存了新的模型列表数据。")
         return jsonify({"status": "success"}), 200
     return jsonify({"status": "error", "message": "需要 'models_json' 字段。"}), 400
@@ -218,20 +657,21 @@ def report_models():
 @app.route('/get_reported_models', methods=['GET'])
 def get_reported_models():
     """由 OpenAI 网关调用，以获取缓存的模型数据。如果数据不存在，将等待。"""
-    # 检查是否有数据，或者等待事件被设置
-    wait_result = REPORTED_MODELS_CACHE['event'].wait(timeout=60) # 等待最多60秒
-    if not wait_result:
-        return jsonify({"status": "error", "message": "等待模型数据超时 (60 秒)。"}), 408
-
-    if REPORTED_MODELS_CACHE['data']:
-        return jsonify({
-            "status": "success",
-            "data": REPORTED_MODELS_CACHE['data'],
-            "timestamp": REPORTED_MODELS_CACHE['timestamp']
-        }), 200
-    else:
-        # 这种情况理论上不应该发生，因为事件被设置了
-        return jsonify({"status": "error", "message": "数据获取失败，即使事件已触发。"}), 500
+    # 等待数据到达。等待时间由调用方的剩余时间决定，最多60秒
+    timeout = min(request.args.get('timeout', 60, type=float), 60)
+    wait_until = time.time() + max(timeout, 0)
+    reported = BACKEND.get_session(REPORTED_MODELS_KEY)
+    while not reported and time.time() < wait_until:
+        time.sleep(0.2)
+        reported = BACKEND.get_session(REPORTED_MODELS_KEY)
+    if not reported:
+        return jsonify({"status": "error", "message": f"等待模型数据超时 ({timeout:.0f} 秒)。"}), 408
+
+    return jsonify({
+        "status": "success",
+        "data": reported['data'],
+        "timestamp": reported['timestamp']
+    }), 200
 
 
 if __name__ == '__main__':
@@ -242,6 +682,8 @@ if __name__ == '__main__':
     print("  - /submit_tool_result, /get_tool_result_job (用于返回工具结果)")
     print("  - /submit_model_fetch_job, /get_model_fetch_job (用于获取模型)")
     print("  - /stream_chunk, /get_chunk (用于流式传输)")
+    print("  - /blobs/<sha256> (大负载的分块上传与下载)")
     print("  已在 http://127.0.0.1:5101 启动")
     print("======================================================================")
-    app.run(host='0.0.0.0', port=5101, threaded=True)
\ No newline at end of file
+    start_backend()
+    app.run(host='0.0.0.0', port=5101, threaded=True)
@@ -2,20 +2,112 @@
 
 import requests
 import json
+import os
 import time
 import sys
 import re
 import uuid
-from flask import Flask, request, Response, jsonify
+import hashlib
+import ipaddress
+import math
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from flask import Flask, request, Response, jsonify, make_response, send_file, has_request_context
 from flask_cors import CORS
 from datetime import datetime, timedelta
+from blob_store import digest_text, gzip_chunks, blob_reference
+from batch_store import BatchStore, FileTooLargeError, ACTIVE_BATCH_STATUSES
+from broker_backend import conversation_signature, conversation_summary, SIGNATURE_MESSAGES
+from sampling_profiler import sample_stacks, format_folded, ProfilerBusy, DEFAULT_INTERVAL_SECONDS, MAX_PROFILE_SECONDS
 
 # --- 配置 ---
 PUBLIC_PORT = 5100
-INTERNAL_SERVER_URL = "http://127.0.0.1:5101"
+# 【新】多个网关实例可以通过环境变量指向同一个共享的任务代理服务器
+INTERNAL_SERVER_URL = os.environ.get("INTERNAL_SERVER_URL", "http://127.0.0.1:5101")
 END_OF_STREAM_SIGNAL = "__END_OF_STREAM__"
+DEADLINE_EXCEEDED_SIGNAL = "__DEADLINE_EXCEEDED__"
+STALLED_SIGNAL = "__STALLED__" # 【新】生成卡住且无法重新分派
+RESTART_SIGNAL = "__RESTART__" # 【新】已在另一个 worker 上重新生成，调用方应丢弃已收到的数据块
+ABANDONED_SIGNAL = "__ABANDONED__" # 【新】流式客户端断开后未在宽限期内重连，调用方应取消任务
 MODEL_CACHE_TTL_SECONDS = 3600 # 模型列表缓存1小时
 
+# 【新】客户端识别与限流配置
+# API Key -> 客户端配置。留空时不校验 Key，客户端按其 Key (或匿名) 区分并使用默认限额。
+# rate: 每秒补充的令牌数 (0 表示不限流)；burst: 令牌桶容量；weight: 在浏览器调度中所占的份额。
+# 通过 API_KEYS_FILE (JSON 文件路径) 或 API_KEYS (JSON 字符串) 环境变量配置，例如:
+#   {"sk-example-team-a": {"name": "team-a", "rate": 1.0, "burst": 10, "weight": 2.0}}
+def _load_api_keys() -> dict:
+    path = os.environ.get("API_KEYS_FILE")
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            keys = json.load(f)
+    else:
+        keys = json.loads(os.environ.get("API_KEYS") or "{}")
+    if not isinstance(keys, dict) or not all(isinstance(config, dict) for config in keys.values()):
+        raise ValueError("API_KEYS 必须是 {Key: {name, rate, burst, weight}} 形式的 JSON 对象。")
+    return keys
+
+API_KEYS = _load_api_keys()
+# 限流默认关闭，需要时通过 CLIENT_RATE_LIMIT (每秒请求数) 和 CLIENT_RATE_BURST 为未单独配置的客户端开启
+DEFAULT_CLIENT_LIMITS = {
+    "rate": float(os.environ.get("CLIENT_RATE_LIMIT", "0")),
+    "burst": float(os.environ.get("CLIENT_RATE_BURST", "10")),
+    "weight": 1.0
+}
+CLIENT_METRICS_WINDOW_SECONDS = 300 # 吞吐量统计窗口
+
+# 【新】截止时间配置。客户端可通过 X-Request-Timeout (秒) / X-Request-Deadline (Unix 时间戳) 请求头
+# 或请求体中的 "timeout" 字段指定自己的截止时间，网关会将其一路传递给注入、提交和流式读取环节。
+DEFAULT_REQUEST_TIMEOUT_SECONDS = 150 # 与原先 30 秒注入 + 120 秒流式读取的总时长一致
+MAX_REQUEST_TIMEOUT_SECONDS = 600
+INJECTION_TIMEOUT_SECONDS = 30
+MODEL_FETCH_TIMEOUT_SECONDS = 60
+
+# 【新】可恢复的流式响应。每个 SSE 事件带有 "id: <chatcmpl-id>:<序号>"，断线的客户端可携带 Last-Event-ID
+# 重新请求，从断点继续接收，而不必让浏览器重新生成。
+STREAM_RETENTION_SECONDS = 300 # 流结束后保留已生成事件的时长
+STREAM_RESUME_GRACE_SECONDS = 15 # 客户端断开后等待其重连的时长，超时仍无人读取则取消任务
+STREAM_KEEPALIVE_SECONDS = 10 # 长时间没有新事件时发送 SSE 注释，以便及时发现断开的连接
+
+# 【新】请求时间线与诊断。客户端发送 X-Debug-Timeline: 1 时，非流式响应会在 X-Request-Timeline 头中附带时间线；
+# 所有请求的时间线都可以通过 /debug/traces/<chatcmpl-id> 查询。
+MAX_TRACES = 500 # 保留最近的请求时间线数量
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN") # 诊断接口 (/debug/*) 的口令，留空时只允许本机访问
+
+# 【新】离线批处理 (/v1/files + /v1/batches)。批处理请求以低权重参与浏览器调度，交互请求优先。
+BATCH_DATA_DIR = os.environ.get("BATCH_DATA_DIR", "batch_data")
+BATCH_CLIENT_WEIGHT = 0.1 # 交互客户端的默认权重为 1.0
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", "4")) # 同时执行的请求数上限 (不超过在线 worker 数)
+BATCH_REQUEST_TIMEOUT_SECONDS = MAX_REQUEST_TIMEOUT_SECONDS # 低优先级请求可能排队较久
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_MAX_FILE_BYTES = int(os.environ.get("BATCH_MAX_FILE_BYTES", str(200 << 20))) # 上传文件的大小上限，分块写入磁盘时检查
+
+# 【新】大负载 (注入历史中的长消息、提示词、工具返回结果) 以 gzip 压缩、按内容寻址的形式上传到内部服务器，
+# 任务中只携带引用，浏览器分块下载并解压。相同内容只上传一次。设为 0 时关闭 (兼容旧版油猴脚本)。
+BLOB_THRESHOLD_BYTES = int(os.environ.get("BLOB_THRESHOLD_BYTES", str(256 * 1024)))
+BLOB_UPLOAD_TIMEOUT_SECONDS = 30
+
+# 【新】生成卡住检测。网关按最近的 "领取 -> 首个数据块" 耗时和数据块间隔的分布自适应地计算阈值，
+# 超过阈值仍没有新数据块时把该 worker 标记为不健康，取消任务，并在另一个健康的 worker 上重新注入历史、重新生成。
+STALL_DEFAULT_SECONDS = {"first_chunk": 30, "gap": 20} # 样本不足时的阈值，同时也是自适应阈值的上限
+STALL_MIN_SECONDS = {"first_chunk": 5, "gap": 5} # 自适应阈值的下限
+STALL_QUANTILE = 0.99
+STALL_MULTIPLIER = 3 # 阈值 = 分位数 x 倍数
+STALL_MIN_SAMPLES = 20
+LIVENESS_SAMPLE_SIZE = 500 # 每种耗时保留的最近样本数
+STALL_MAX_REDISPATCHES = 1
+WORKER_UNHEALTHY_SECONDS = 120 # 卡住的 worker 在这段时间内不再接收新任务
+# 【新】首 token 对冲。请求体携带 "hedge": true (或设置 HEDGE_BY_DEFAULT=1) 时，若首个数据块迟迟未到，
+# 在另一个 worker 上同时发起一份相同的生成，先产出数据块的一方胜出，另一方被取消。
+HEDGE_BY_DEFAULT = os.environ.get("HEDGE_BY_DEFAULT", "0") == "1"
+HEDGE_QUANTILE = 0.9 # 等待时间超过首个数据块耗时的该分位数后发起对冲
+HEDGE_DEFAULT_SECONDS = 5 # 样本不足时的对冲等待时间
+HEDGE_MIN_SECONDS = 1
+
+# 【新】启动与就绪检查
+STARTUP_TIMEOUT_SECONDS = float(os.environ.get("STARTUP_TIMEOUT_SECONDS", "30")) # 等待内部服务器就绪的最长时间
+READY_MIN_WORKERS = int(os.environ.get("READY_MIN_WORKERS", "0")) # /readyz 要求的最少在线浏览器 worker 数
+
 # 【新】为本地连接定义无代理设置，避免系统代理干扰
 LOCAL_REQUEST_PROXIES = {
     "http": None,
@@ -27,13 +119,375 @@ CORS(app)
 
 import threading
 
-LAST_CONVERSATION_STATE = None
+# 【新】会话状态保存在任务代理服务器中 (按 worker 区分)，多个网关实例共享同一份状态
+LEGACY_WORKER_ID = "default" # 未上报 worker_id 的旧版油猴脚本
 MODEL_LIST_CACHE = {
     "data": None,
-    "timestamp": 0
+    "timestamp": 0,
+    "index": {}, # 【新】模型 ID (含 "models/" 前缀的内部 ID) -> 模型条目，用于快速校验请求中的模型
+    "index_checked_at": 0 # 上次尝试从内部服务器读取模型列表的时间
 }
-# 【新】使用 Event 实现更简单的单任务注入状态同步
+# 兼容旧版 historyforger.js：它直接向网关报告注入完成，不携带任务 ID
 INJECTION_COMPLETE_EVENT = threading.Event()
+# 【新】每个客户端的令牌桶与统计数据
+CLIENT_BUCKETS = {}
+CLIENT_METRICS = {}
+CLIENT_LOCK = threading.Lock()
+# 【新】chatcmpl-id -> StreamBuffer
+STREAM_BUFFERS = {}
+STREAM_LOCK = threading.Lock()
+# 【新】批处理存储 (首次使用时创建) 与正在运行的批处理: batch_id -> 取消事件
+BATCH_STORE = None
+BATCH_LOCK = threading.Lock()
+BATCH_CANCEL_EVENTS = {}
+# 【新】最近的数据块耗时样本 (秒): first_chunk = 领取到首个数据块，gap = 相邻数据块的间隔
+LIVENESS_SAMPLES = {"first_chunk": deque(maxlen=LIVENESS_SAMPLE_SIZE), "gap": deque(maxlen=LIVENESS_SAMPLE_SIZE)}
+LIVENESS_LOCK = threading.Lock()
+# 【新】chatcmpl-id -> RequestTrace，按创建顺序淘汰
+TRACES = OrderedDict()
+TRACE_LOCK = threading.Lock()
+
+
+# --- 客户端识别、限流与统计 ---
+
+class TokenBucket:
+    """简单的线程安全令牌桶。"""
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self, cost: float = 1.0):
+        """尝试取走令牌。成功返回 (True, 0)，失败返回 (False, 需要等待的秒数)。"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= cost:
+                self.tokens -= cost
+                return True, 0.0
+            wait_seconds = (cost - self.tokens) / self.rate if self.rate > 0 else float('inf')
+            return False, wait_seconds
+
+def _extract_api_key():
+    auth_header = request.headers.get("Authorization", "")
+    if auth_header.lower().startswith("bearer "):
+        return auth_header[7:].strip() or None
+    return request.headers.get("x-api-key") or None
+
+def _identify_client():
+    """
+    根据 API Key 识别调用方。
+    返回 (client, None) 或 (None, 错误响应)。client 是包含 id 和限额配置的字典。
+    """
+    api_key = _extract_api_key()
+    if API_KEYS:
+        config = API_KEYS.get(api_key)
+        if not config:
+            return None, (jsonify({"error": {"message": "无效的 API Key。", "type": "invalid_request_error", "code": "invalid_api_key"}}), 401)
+        client_id = config.get("name") or f"key-{hashlib.sha256(api_key.encode()).hexdigest()[:12]}"
+    else:
+        config = {}
+        # 不记录原始 Key，只使用其摘要作为标识
+        client_id = f"key-{hashlib.sha256(api_key.encode()).hexdigest()[:12]}" if api_key else "anonymous"
+
+    client = {"id": client_id}
+    for field in ("rate", "burst", "weight"):
+        client[field] = config.get(field, DEFAULT_CLIENT_LIMITS[field])
+    return client, None
+
+def _get_client_metrics(client_id: str) -> dict:
+    metrics = CLIENT_METRICS.get(client_id)
+    if metrics is None:
+        metrics = {
+            "requests": 0,
+            "rate_limited": 0,
+            "completed": 0,
+            "failed": 0,
+            "latencies": deque(maxlen=500), # 最近请求的耗时 (秒)
+            "finished_at": deque()           # 窗口内完成请求的时间戳，用于计算吞吐量
+        }
+        CLIENT_METRICS[client_id] = metrics
+    return metrics
+
+def _admit_client(client: dict):
+    """对客户端执行令牌桶限流 (rate 为 0 时只做统计)。返回 None 表示放行，否则返回 429 响应。"""
+    if client["rate"] <= 0:
+        with CLIENT_LOCK:
+            CLIENT_BUCKETS.pop(client["id"], None)
+            _get_client_metrics(client["id"])["requests"] += 1
+        return None
+    with CLIENT_LOCK:
+        bucket = CLIENT_BUCKETS.get(client["id"])
+        if bucket is None or bucket.rate != client["rate"] or bucket.capacity != client["burst"]:
+            bucket = TokenBucket(client["rate"], client["burst"])
+            CLIENT_BUCKETS[client["id"]] = bucket
+        metrics = _get_client_metrics(client["id"])
+        metrics["requests"] += 1
+
+    allowed, wait_seconds = bucket.try_acquire()
+    if allowed:
+        return None
+
+    with CLIENT_LOCK:
+        metrics["rate_limited"] += 1
+    retry_after = max(1, int(wait_seconds + 0.999))
+    print(f"🚦 [Rate Limit] 客户端 {client['id']} 超出速率限制，需等待 {retry_after} 秒。")
+    response = jsonify({"error": {"message": f"请求过于频繁，请在 {retry_after} 秒后重试。", "type": "rate_limit_error", "code": "rate_limit_exceeded"}})
+    response.headers["Retry-After"] = str(retry_after)
+    return response, 429
+
+def _record_client_request(client: dict, started_at: float, success: bool):
+    now = time.monotonic()
+    with CLIENT_LOCK:
+        metrics = _get_client_metrics(client["id"])
+        metrics["completed" if success else "failed"] += 1
+        metrics["latencies"].append(now - started_at)
+        metrics["finished_at"].append(now)
+        while metrics["finished_at"] and now - metrics["finished_at"][0] > CLIENT_METRICS_WINDOW_SECONDS:
+            metrics["finished_at"].popleft()
+
+def _track_stream(stream, client: dict, started_at: float):
+    """包装流式响应生成器，在流结束时记录客户端的耗时统计。"""
+    success = False
+    try:
+        yield from stream
+        success = True
+    finally:
+        _record_client_request(client, started_at, success)
+
+
+# --- 截止时间 ---
+
+def _finite_float(value) -> float:
+    """客户端提供的时间值：拒绝 "nan"、"inf" 等非有限数"""
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError(f"非有限数: {value!r}")
+    return number
+
+def _resolve_deadline(request_data: dict = None, default_timeout: float = DEFAULT_REQUEST_TIMEOUT_SECONDS) -> float:
+    """根据请求头或请求体计算本次请求的截止时间 (Unix 时间戳，便于跨进程比较)"""
+    now = time.time()
+    # 批处理请求在后台线程中执行，没有 HTTP 请求上下文
+    headers = request.headers if has_request_context() else {}
+    try:
+        deadline_header = headers.get("X-Request-Deadline")
+        if deadline_header:
+            return min(_finite_float(deadline_header), now + MAX_REQUEST_TIMEOUT_SECONDS)
+        timeout = headers.get("X-Request-Timeout")
+        if timeout is None and request_data:
+            timeout = request_data.get("timeout")
+        if timeout is not None:
+            return now + min(max(_finite_float(timeout), 0), MAX_REQUEST_TIMEOUT_SECONDS)
+    except (TypeError, ValueError):
+        print("⚠️ [Deadline] 无法解析客户端提供的截止时间，使用默认值。")
+    return now + default_timeout
+
+def _remaining_seconds(deadline: float) -> float:
+    return max(deadline - time.time(), 0)
+
+def _cancel_task(task_id: str):
+    """通知内部服务器取消任务：排队中的任务不会再被取走，进行中的生成会被中止"""
+    try:
+        requests.post(f"{INTERNAL_SERVER_URL}/cancel_task/{task_id}", timeout=3, proxies=LOCAL_REQUEST_PROXIES)
+        print(f"🛑 [Cancel] 已取消任务 {task_id[:8]}。")
+    except requests.exceptions.RequestException as e:
+        print(f"🚨 [Cancel] 取消任务 {task_id[:8]} 失败: {e}")
+
+
+# --- 【新】请求时间线 ---
+
+class RequestTrace:
+    """
+    记录单个请求的时间线。时间均为相对请求开始的毫秒数 (基于单调时钟)；
+    来自内部服务器的时间点 (例如任务被浏览器领取) 使用墙上时钟，按请求开始时的墙上时间换算。
+    """
+    def __init__(self, trace_id: str, client_id: str):
+        self.trace_id = trace_id
+        self.client_id = client_id
+        self.started_at = time.monotonic()
+        self.started_wall = time.time()
+        self.events = []
+        self._marked = set()
+        self._lock = threading.Lock()
+
+    def _offset_ms(self) -> float:
+        return round((time.monotonic() - self.started_at) * 1000, 3)
+
+    def mark(self, name: str, once: bool = False, **attrs):
+        """记录一个时间点。once=True 时同名事件只记录第一次 (例如首个数据块)"""
+        self._add({"name": name, "at_ms": self._offset_ms(), **({"attrs": attrs} if attrs else {})}, once)
+
+    def mark_wall(self, name: str, wall_ts: float, once: bool = False, **attrs):
+        """记录一个由其他进程以墙上时钟报告的时间点"""
+        at_ms = round((wall_ts - self.started_wall) * 1000, 3)
+        self._add({"name": name, "at_ms": at_ms, **({"attrs": attrs} if attrs else {})}, once)
+
+    def _add(self, event: dict, once: bool):
+        with self._lock:
+            if once:
+                if event["name"] in self._marked: return
+                self._marked.add(event["name"])
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """记录一段耗时"""
+        start_ms = self._offset_ms()
+        try:
+            yield
+        finally:
+            self._add({"name": name, "at_ms": start_ms, "duration_ms": round(self._offset_ms() - start_ms, 3), **({"attrs": attrs} if attrs else {})}, False)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            events = sorted(self.events, key=lambda event: event["at_ms"])
+        return {"id": self.trace_id, "client_id": self.client_id, "started_at": self.started_wall, "events": events}
+
+    def to_chrome_trace(self) -> dict:
+        """导出为 Chrome Trace Event 格式，可在 chrome://tracing 或 Perfetto 中打开"""
+        trace_events = []
+        for event in self.to_dict()["events"]:
+            entry = {"name": event["name"], "ts": event["at_ms"] * 1000, "pid": 1, "tid": 1, "args": event.get("attrs", {})}
+            if "duration_ms" in event:
+                entry.update(ph="X", dur=event["duration_ms"] * 1000)
+            else:
+                entry.update(ph="i", s="t")
+            trace_events.append(entry)
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms", "otherData": {"id": self.trace_id}}
+
+def _start_trace(client: dict) -> RequestTrace:
+    trace = RequestTrace(f"chatcmpl-{uuid.uuid4()}", client["id"])
+    with TRACE_LOCK:
+        TRACES[trace.trace_id] = trace
+        while len(TRACES) > MAX_TRACES:
+            TRACES.popitem(last=False)
+    return trace
+
+def _mark(trace, name: str, **attrs):
+    """trace 可能为空 (例如直接调用生成函数)，此时忽略"""
+    if trace: trace.mark(name, **attrs)
+
+@contextmanager
+def _null_span():
+    yield
+
+
+# --- 【新】可恢复的流式响应 ---
+
+class StreamBuffer:
+    """
+    保存一次流式请求已生成的 SSE 事件。生成在后台线程中进行，与客户端连接解耦：
+    连接断开后事件仍会继续写入，重连的客户端可以从任意序号开始回放，再继续接收实时事件。
+    """
+    def __init__(self, completion_id: str, client_id: str):
+        self.completion_id = completion_id
+        self.client_id = client_id
+        self.events = [] # 第 n 个事件 (序号从 1 开始) 为 events[n - 1]
+        self.finished_at = None
+        self.readers = 0
+        self.detached_at = None # 最后一个读取者断开的时间
+        self.abandoned = threading.Event() # 宽限期到期时由定时器设置，TaskSupervisor 据此立即取消任务
+        self.cond = threading.Condition()
+
+    def append(self, sse_text: str):
+        # 一次 yield 可能包含多个事件 (例如并行的工具调用)，拆开后分别编号
+        with self.cond:
+            self.events.extend(f"{event}\n\n" for event in sse_text.split("\n\n") if event)
+            self.cond.notify_all()
+
+    def finish(self):
+        with self.cond:
+            self.finished_at = time.time()
+            self.cond.notify_all()
+
+    def is_abandoned(self) -> bool:
+        with self.cond:
+            return self.readers == 0 and self.detached_at is not None and time.time() - self.detached_at >= STREAM_RESUME_GRACE_SECONDS
+
+    def _check_abandoned(self):
+        with self.cond:
+            finished = self.finished_at is not None
+        if not finished and self.is_abandoned():
+            print(f"🔌 [Stream Mode] {self.completion_id} 在 {STREAM_RESUME_GRACE_SECONDS} 秒内无客户端重连。")
+            self.abandoned.set()
+
+    def read_from(self, last_seq: int = 0):
+        """生成 last_seq 之后的所有事件 (带 id)，直到流结束"""
+        with self.cond:
+            self.readers += 1
+        try:
+            seq = last_seq
+            while True:
+                with self.cond:
+                    if seq >= len(self.events) and self.finished_at is None:
+                        self.cond.wait(timeout=STREAM_KEEPALIVE_SECONDS)
+                    pending = self.events[seq:]
+                    finished = self.finished_at is not None
+                if not pending:
+                    if finished: return
+                    yield ": keep-alive\n\n"
+                    continue
+                for event in pending:
+                    seq += 1
+                    yield f"id: {self.completion_id}:{seq}\n{event}"
+        finally:
+            with self.cond:
+                self.readers -= 1
+                if self.readers == 0:
+                    self.detached_at = time.time()
+                    if self.finished_at is None:
+                        # 宽限期到期时检查是否仍无人读取，不必等到上游产出下一个事件
+                        timer = threading.Timer(STREAM_RESUME_GRACE_SECONDS, self._check_abandoned)
+                        timer.daemon = True
+                        timer.start()
+
+def _parse_last_event_id(value: str):
+    """解析 "<chatcmpl-id>:<序号>" 格式的 Last-Event-ID，返回 (completion_id, seq)"""
+    if not value: return None, 0
+    completion_id, _, seq = value.strip().rpartition(":")
+    try:
+        return completion_id, int(seq)
+    except ValueError:
+        return value.strip(), 0
+
+def _register_stream_buffer(completion_id: str, client_id: str) -> StreamBuffer:
+    now = time.time()
+    with STREAM_LOCK:
+        # 顺便清理过期的流
+        for expired_id in [cid for cid, buf in STREAM_BUFFERS.items() if buf.finished_at and now - buf.finished_at > STREAM_RETENTION_SECONDS]:
+            del STREAM_BUFFERS[expired_id]
+        buffer = STREAM_BUFFERS[completion_id] = StreamBuffer(completion_id, client_id)
+    return buffer
+
+def _get_stream_buffer(completion_id: str, client_id: str):
+    with STREAM_LOCK:
+        buffer = STREAM_BUFFERS.get(completion_id)
+    # 只允许发起请求的客户端恢复自己的流
+    if buffer is None or buffer.client_id != client_id: return None
+    return buffer
+
+def _pump_stream(buffer: StreamBuffer, stream):
+    """
+    在后台线程中运行生成器，把事件写入缓冲区。所有读取者断开且超过宽限期后关闭生成器 (取消任务)。
+    上游一直没有新事件时，由 buffer.abandoned 通知生成器中的 TaskSupervisor 提前结束。
+    """
+    try:
+        for sse_text in stream:
+            buffer.append(sse_text)
+            if buffer.abandoned.is_set() or buffer.is_abandoned():
+                break
+    except Exception as e:
+        print(f"🚨 [Stream Mode] 生成 {buffer.completion_id} 时出错: {type(e).__name__}: {e}")
+    finally:
+        stream.close() # 提前退出时触发生成器中的清理逻辑 (取消任务、清空会话缓存)
+        buffer.finish()
+
+def _start_stream(buffer: StreamBuffer, stream):
+    threading.Thread(target=_pump_stream, args=(buffer, stream), daemon=True).start()
 
 
 # --- OpenAI 格式化辅助函数 (升级) ---
@@ -104,37 +558,173 @@ def format_openai_non_stream_response(content: str, tool_calls: list, model: str
 
 # --- Google 响应解析与任务处理 (核心升级) ---
 
-# v5 解析器 (保持不变)
+# 【新】函数参数解码器：按工具的参数 Schema 迭代解码，Schema 缺失或不符时退回 v5 按结构猜测的规则
+# Google 的函数参数是 protobuf Value 的数组形式 (JSPB)：值放在与类型对应的位置上，其余位置为 null。
+# [null_value, number_value, string_value, bool_value, struct_value, list_value]
+GOOGLE_VALUE_SLOTS = {"null": 0, "number": 1, "integer": 1, "string": 2, "boolean": 3, "object": 4, "array": 5}
+MAX_VALUE_WRAPPER_LENGTH = 6 # Value 数组最多 6 个位置 (null_value ... list_value)，末尾的 null 可能被省略
+SCALAR_SCHEMA_TYPES = ("string", "number", "integer", "boolean")
+# 【新】各标量类型在对应位置上允许出现的 Python 类型 (布尔值可能以 0/1 给出)
+SCALAR_VALUE_TYPES = {"string": {str}, "number": {int, float}, "integer": {int, float}, "boolean": {bool, int}}
+
+def _is_field_pair(item) -> bool:
+    return isinstance(item, list) and len(item) == 2 and isinstance(item[0], str)
+
+def _slot_value(wrapper, json_type: str):
+    """若 wrapper 是只在 json_type 对应位置上有值的 Value，返回 (True, 该值)，否则返回 (False, None)"""
+    slot = GOOGLE_VALUE_SLOTS.get(json_type)
+    if slot is None or type(wrapper) is not list or not slot < len(wrapper) <= MAX_VALUE_WRAPPER_LENGTH:
+        return False, None
+    value = wrapper[slot]
+    if value is None or wrapper.count(None) != len(wrapper) - 1:
+        return False, None
+    value_type = type(value)
+    if json_type == "string": matched = value_type is str
+    elif json_type in ("number", "integer"): matched = value_type is int or value_type is float
+    elif json_type == "boolean": matched = value_type is bool or value_type is int
+    else: matched = value_type is list
+    return (True, value) if matched else (False, None)
+
+def _struct_fields(struct: list) -> list:
+    """Struct 为 [fields]，兼容直接给出 [[key, value], ...] 的形式"""
+    if len(struct) == 1 and isinstance(struct[0], list) and (not struct[0] or isinstance(struct[0][0], list)):
+        return struct[0]
+    return struct
+
+def _list_values(list_value: list) -> list:
+    """ListValue 为 [values]，兼容直接给出 [value, ...] 的形式"""
+    if len(list_value) == 1 and isinstance(list_value[0], list) and set(map(type, list_value[0])) <= {list, type(None)}:
+        return list_value[0]
+    return list_value
+
+def _scalar_column(values: list, json_type: str):
+    """
+    【新】Schema 指明为标量数组时的快速通道：把所有元素当作同一形状的 Value ([null, ..., 值]) 按列整体校验并取值，
+    不再逐个检查元素。形状或类型不一致时返回 None，由调用方逐个解码。
+    """
+    slot = GOOGLE_VALUE_SLOTS[json_type]
+    if set(map(type, values)) != {list} or set(map(len, values)) != {slot + 1}:
+        return None
+    columns = list(zip(*values))
+    if any(column.count(None) != len(values) for column in columns[:slot]):
+        return None
+    column = columns[slot]
+    value_types = set(map(type, column))
+    if not value_types <= SCALAR_VALUE_TYPES[json_type]:
+        return None
+    if json_type == "integer" and float in value_types:
+        return [_coerce_scalar(value, json_type) for value in column]
+    if json_type == "boolean" and int in value_types:
+        return list(map(bool, column))
+    return list(column)
+
+def _schema_type(schema):
+    if not isinstance(schema, dict): return None
+    json_type = schema.get("type")
+    if isinstance(json_type, list): # 例如 ["string", "null"]
+        json_type = next((t for t in json_type if t != "null"), None)
+    return json_type.lower() if isinstance(json_type, str) else None
+
+def _coerce_scalar(value, json_type: str):
+    if json_type == "integer": return int(value) if float(value).is_integer() else value
+    if json_type == "boolean": return bool(value)
+    return value
+
+def decode_google_args(args_list: list, parameters_schema: dict = None) -> dict:
+    """
+    把函数调用参数 ([[key, Value], ...]) 解码为字典。
+    使用显式栈迭代处理，嵌套深度不受递归限制。提供了参数的 JSON Schema 时按 Schema 一次性取出对应类型的值
+    (整数、布尔值、单字段对象等不会被误判)；Schema 缺失或与数据不符的部分退回到按结构猜测的旧规则。
+    """
+    result = {}
+    if not isinstance(args_list, list): return result
+    # 栈中的每一项: (待解码的数据, Schema, Schema 类型, 写入的容器, 键/下标)
+    stack = []
+    def push_fields(fields, schema, target):
+        properties = (schema.get("properties") or {}) if isinstance(schema, dict) else {}
+        pairs = [item for item in fields if _is_field_pair(item)]
+        for name, _ in pairs:
+            target[name] = None # 先占位，保持字段原有的顺序
+        for name, value in reversed(pairs):
+            field_schema = properties.get(name)
+            stack.append((value, field_schema, _schema_type(field_schema), target, name))
+    def push_items(values, schema, target):
+        item_schema = schema.get("items") if isinstance(schema, dict) else None
+        item_type = _schema_type(item_schema)
+        if item_type in SCALAR_SCHEMA_TYPES and values:
+            column = _scalar_column(values, item_type)
+            if column is not None:
+                target.extend(column)
+                return
+        target.extend([None] * len(values))
+        for index in range(len(values) - 1, -1, -1):
+            item = values[index]
+            if item_type in SCALAR_SCHEMA_TYPES:
+                # 标量数组 (常见的大数组) 直接解码，不经过栈
+                matched, value = _slot_value(item, item_type)
+                if matched:
+                    target[index] = _coerce_scalar(value, item_type)
+                    continue
+            stack.append((item, item_schema, item_type, target, index))
+
+    push_fields(args_list, parameters_schema, result)
+    while stack:
+        wrapper, schema, json_type, target, key = stack.pop()
+
+        # 1. 按 Schema 解码
+        matched, value = _slot_value(wrapper, json_type) if json_type else (False, None)
+        if matched:
+            if json_type == "object":
+                target[key] = {}
+                push_fields(_struct_fields(value), schema, target[key])
+            elif json_type == "array":
+                target[key] = []
+                push_items(_list_values(value), schema, target[key])
+            else:
+                target[key] = _coerce_scalar(value, json_type)
+            continue
+
+        # 2. 旧规则：去掉只有一个非空元素的外层列表，再按是否为 [key, value] 列表判断是对象还是数组
+        payload = wrapper
+        while isinstance(payload, list):
+            non_null_items = [item for item in payload if item is not None]
+            if len(non_null_items) == 1: payload = non_null_items[0]
+            else: break
+        if not isinstance(payload, list):
+            target[key] = payload
+        elif payload and _is_field_pair(payload[0]):
+            target[key] = {}
+            push_fields(payload, schema, target[key])
+        else:
+            target[key] = []
+            push_items(payload, schema, target[key])
+    return result
+
 def _extract_value(value_wrapper):
-    current_payload = value_wrapper
-    while isinstance(current_payload, list):
-        non_null_items = [item for item in current_payload if item is not None]
-        if len(non_null_items) == 1: current_payload = non_null_items[0]
-        else: break
-    if not isinstance(current_payload, list): return current_payload
-    if not current_payload: return []
-    first_item = current_payload[0]
-    if isinstance(first_item, list) and len(first_item) == 2 and isinstance(first_item[0], str):
-        return convert_google_args_to_dict(current_payload)
-    else:
-        return [_extract_value(item) for item in current_payload]
+    """按旧规则解码单个值 (不使用 Schema)"""
+    return decode_google_args([["value", value_wrapper]])["value"]
+
+def convert_google_args_to_dict(args_list: list, parameters_schema: dict = None) -> dict:
+    return decode_google_args(args_list, parameters_schema)
 
-def convert_google_args_to_dict(args_list: list) -> dict:
-    if not isinstance(args_list, list): return {}
-    params = {}
-    for item in args_list:
-        if isinstance(item, list) and len(item) == 2 and isinstance(item[0], str):
-            key, value_wrapper = item[0], item[1]
-            params[key] = _extract_value(value_wrapper)
-    return params
+def _tool_parameter_schemas(tools: list) -> dict:
+    """请求中的 tools -> {函数名: 参数 JSON Schema}"""
+    schemas = {}
+    for tool in tools or []:
+        function = tool.get("function") if isinstance(tool, dict) else None
+        if isinstance(function, dict) and function.get("name"):
+            schemas[function["name"]] = function.get("parameters")
+    return schemas
 
 # 【【【核心升级：解析所有函数调用】】】
-def parse_final_buffer_for_tool_calls(buffer: str):
+def parse_final_buffer_for_tool_calls(buffer: str, tools: list = None):
     """
     在流结束后，解析整个缓冲区以提取【所有】函数调用。
+    tools 为请求中的工具定义，提供时按其参数 Schema 解码参数。
     返回一个函数调用对象的列表，如果找不到则返回空列表。
     """
     all_tool_calls = []
+    parameter_schemas = _tool_parameter_schemas(tools)
     try:
         # 【【【核心修复 v2：更稳健地处理拼接的JSON】】】
         clean_buffer = buffer.strip()
@@ -172,7 +762,7 @@ def parse_final_buffer_for_tool_calls(buffer: str):
                 raw_calls = find_all_calls_recursive(chunk)
                 for call_data in raw_calls:
                     function_name = call_data[0]
-                    arguments_dict = convert_google_args_to_dict(call_data[1][0])
+                    arguments_dict = convert_google_args_to_dict(call_data[1][0], parameter_schemas.get(function_name))
                     all_tool_calls.append({
                         "id": f"call_{uuid.uuid4()}",
                         "type": "function",
@@ -189,60 +779,343 @@ def parse_final_buffer_for_tool_calls(buffer: str):
     
     return all_tool_calls
 
-def _internal_task_processor(task_id: str):
-    # (此函数无需更改)
-    start_time = time.time()
-    while time.time() - start_time < 120:
-        try:
-            res = requests.get(f"{INTERNAL_SERVER_URL}/get_chunk/{task_id}", timeout=5, proxies=LOCAL_REQUEST_PROXIES)
-            if res.status_code == 200:
-                data = res.json()
-                if data['status'] == 'ok': yield data.get('chunk')
-                elif data['status'] == 'done':
-                    yield END_OF_STREAM_SIGNAL
+# --- 【新】数据块活性监控、重新分派与对冲 ---
+
+def _record_liveness(kind: str, seconds: float):
+    with LIVENESS_LOCK:
+        LIVENESS_SAMPLES[kind].append(max(seconds, 0.0))
+
+def _liveness_quantile(kind: str, quantile: float):
+    """最近样本的分位数，样本不足时返回 None"""
+    with LIVENESS_LOCK:
+        samples = sorted(LIVENESS_SAMPLES[kind])
+    if len(samples) < STALL_MIN_SAMPLES:
+        return None
+    return samples[min(int(len(samples) * quantile), len(samples) - 1)]
+
+def _stall_threshold(kind: str) -> float:
+    observed = _liveness_quantile(kind, STALL_QUANTILE)
+    if observed is None:
+        return STALL_DEFAULT_SECONDS[kind]
+    return min(max(observed * STALL_MULTIPLIER, STALL_MIN_SECONDS[kind]), STALL_DEFAULT_SECONDS[kind])
+
+def _hedge_delay() -> float:
+    observed = _liveness_quantile("first_chunk", HEDGE_QUANTILE)
+    return HEDGE_DEFAULT_SECONDS if observed is None else max(observed, HEDGE_MIN_SECONDS)
+
+def _mark_worker_unhealthy(worker_id: str, reason: str):
+    try:
+        requests.post(f"{INTERNAL_SERVER_URL}/workers/{worker_id}/health", json={"healthy": False, "seconds": WORKER_UNHEALTHY_SECONDS, "reason": reason},
+                      timeout=3, proxies=LOCAL_REQUEST_PROXIES)
+    except requests.exceptions.RequestException as e:
+        print(f"🚨 [Supervisor] 标记 worker {worker_id} 为不健康失败: {e}")
+
+def _healthy_workers(exclude=()) -> list:
+    """在线且健康的 worker (排除 exclude 中的 worker)"""
+    try:
+        res = requests.get(f"{INTERNAL_SERVER_URL}/workers", timeout=3, proxies=LOCAL_REQUEST_PROXIES)
+        res.raise_for_status()
+        workers = res.json().get("workers", {})
+    except (requests.exceptions.RequestException, ValueError):
+        return []
+    return [worker_id for worker_id, info in workers.items() if info.get("alive") and info.get("healthy", True) and worker_id not in exclude]
+
+def _dispatch_elsewhere(request_base: dict, message: dict, client: dict, deadline: float, avoid_workers: list, trace: RequestTrace = None):
+    """
+    在 avoid_workers 之外的健康 worker 上重新注入对话历史 (request_base)，再提交最后一条用户/工具消息。
+    返回 (task_id, worker_id)，没有可用的 worker 或提交失败时返回 (None, None)。
+    """
+    if not _healthy_workers(exclude=avoid_workers):
+        print("⚠️ [Supervisor] 没有其他健康的 worker，无法重新分派。")
+        return None, None
+    payload = {**request_base, **_client_fields(client), "avoid_workers": list(avoid_workers)}
+    injected, worker_id = _inject_history(payload, deadline, trace)
+    if not injected:
+        return None, None
+    if message.get("role") == "tool":
+        task_id = _submit_tool_result(message.get("content", ""), client, deadline, worker_id)
+    else:
+        task_id = _submit_prompt(message.get("content"), client, deadline, worker_id)
+    if not task_id:
+        _discard_conversation_state(worker_id or LEGACY_WORKER_ID)
+        return None, worker_id
+    return task_id, worker_id
+
+
+class TaskSupervisor:
+    """
+    跟踪一次生成的数据块，直到流结束或超过客户端的截止时间。
+    - 任务被领取后迟迟没有首个数据块，或数据块之间的间隔超过自适应阈值时视为卡住：
+      标记该 worker 为不健康、取消任务，并在另一个健康的 worker 上重新分派。
+      已经收到数据块时只有 allow_restart=True (非流式，尚未向客户端输出任何内容) 才会重新分派，并产出 RESTART_SIGNAL。
+      无法重新分派时产出 STALLED_SIGNAL。
+    - hedge=True 时，首个数据块超过 _hedge_delay() 仍未到达则在另一个 worker 上同时发起一份，先产出数据块的一方胜出。
+    - abandoned (threading.Event) 被设置时 (流式客户端断开且超过宽限期) 立即产出 ABANDONED_SIGNAL 并结束。
+    生成结束后，task_id / worker_id 为实际完成生成的任务和 worker。
+    """
+
+    def __init__(self, task_id: str, worker_id: str, request_base: dict, message: dict, client: dict, deadline: float,
+                 hedge: bool = False, allow_restart: bool = False, trace: RequestTrace = None, abandoned: threading.Event = None):
+        self.task_id = task_id
+        self.worker_id = worker_id
+        self.request_base = request_base
+        self.message = message
+        self.client = client
+        self.deadline = deadline
+        self.hedge = hedge
+        self.allow_restart = allow_restart
+        self.trace = trace
+        self.abandoned = abandoned
+        self.redispatches = 0
+        self.avoided_workers = []
+        self._hedge = None # {"task_id", "worker_id", "cancelled", "lock"}
+
+    def _poll(self, task_id: str, offset: int):
+        res = requests.get(f"{INTERNAL_SERVER_URL}/get_chunk/{task_id}", params={"offset": offset}, timeout=min(5, _remaining_seconds(self.deadline) + 0.1), proxies=LOCAL_REQUEST_PROXIES)
+        return res.json() if res.status_code == 200 else None
+
+    # --- 对冲 ---
+
+    def _start_hedge(self):
+        hedge = {"task_id": None, "worker_id": None, "cancelled": False, "lock": threading.Lock()}
+        self._hedge = hedge
+        avoid = [worker for worker in (self.worker_id, *self.avoided_workers) if worker]
+        print(f"🏁 [Hedge] 任务 {self.task_id[:8]} 的首个数据块迟迟未到，在另一个 worker 上同时发起生成。")
+        _mark(self.trace, "hedge_started")
+
+        def run():
+            task_id, worker_id = _dispatch_elsewhere(self.request_base, self.message, self.client, self.deadline, avoid, self.trace)
+            with hedge["lock"]:
+                if not hedge["cancelled"] and task_id:
+                    hedge.update(task_id=task_id, worker_id=worker_id)
                     return
-            time.sleep(0.05)
-        except requests.exceptions.RequestException: time.sleep(1)
-    yield END_OF_STREAM_SIGNAL
+            # 主任务已胜出 (或对冲失败)：对冲 worker 的页面状态已与缓存不一致
+            if task_id: _cancel_task(task_id)
+            if worker_id: _discard_conversation_state(worker_id)
+
+        threading.Thread(target=run, name=f"hedge-{self.task_id[:8]}", daemon=True).start()
+
+    def _cancel_hedge(self):
+        hedge, self._hedge = self._hedge, None
+        if not hedge: return
+        with hedge["lock"]:
+            hedge["cancelled"] = True
+            task_id, worker_id = hedge["task_id"], hedge["worker_id"]
+        if task_id:
+            _cancel_task(task_id)
+            _discard_conversation_state(worker_id or LEGACY_WORKER_ID)
+
+    def _hedge_ready(self):
+        hedge = self._hedge
+        return hedge if hedge and hedge["task_id"] else None
+
+    def _switch_to(self, task_id: str, worker_id: str):
+        """放弃当前任务，改为跟踪另一个任务"""
+        _cancel_task(self.task_id)
+        _discard_conversation_state(self.worker_id or LEGACY_WORKER_ID)
+        self.task_id, self.worker_id = task_id, worker_id
+
+    # --- 主循环 ---
+
+    def chunks(self):
+        offset, pickup_seen_at, last_chunk_at = 0, None, None
+        started_at = time.monotonic()
+        while time.time() < self.deadline:
+            if self.abandoned is not None and self.abandoned.is_set():
+                yield ABANDONED_SIGNAL
+                return
+            now = time.monotonic()
+            if self.hedge and offset == 0 and self._hedge is None and now - started_at > _hedge_delay():
+                self._start_hedge()
+            try:
+                # 对冲任务先产出数据块时切换过去
+                hedge = self._hedge_ready() if offset == 0 else None
+                if hedge:
+                    data = self._poll(hedge["task_id"], 0)
+                    if data and data["status"] == "ok":
+                        print(f"🏁 [Hedge] 对冲任务 {hedge['task_id'][:8]} (Worker: {hedge['worker_id']}) 先产出数据块，取消原任务。")
+                        _mark(self.trace, "hedge_won", worker_id=hedge["worker_id"])
+                        self._hedge = None
+                        self._switch_to(hedge["task_id"], hedge["worker_id"])
+                        pickup_seen_at = None
+                    else:
+                        data = self._poll(self.task_id, offset)
+                else:
+                    data = self._poll(self.task_id, offset)
+            except requests.exceptions.RequestException:
+                time.sleep(min(1, _remaining_seconds(self.deadline)))
+                continue
+
+            now = time.monotonic()
+            if data and data['status'] == 'ok':
+                if offset == 0:
+                    if data.get('picked_at'):
+                        _record_liveness("first_chunk", time.time() - data['picked_at'])
+                        if self.trace: self.trace.mark_wall("job_pickup", data['picked_at'], once=True)
+                    _mark(self.trace, "first_chunk", once=True)
+                    self._cancel_hedge()
+                else:
+                    _record_liveness("gap", now - last_chunk_at)
+                offset, last_chunk_at = data['next_offset'], now
+                yield from data['chunks']
+                continue
+            if data and data['status'] == 'done':
+                self._cancel_hedge()
+                _mark(self.trace, "stream_done", chunks=offset, task_status=data.get('task_status'))
+                yield END_OF_STREAM_SIGNAL
+                return
+            if data and data.get('picked_at') and pickup_seen_at is None:
+                pickup_seen_at = now
+
+            # 卡住检测：只在任务已被领取之后计时，排队等待不算卡住
+            if offset == 0:
+                stalled = pickup_seen_at is not None and now - pickup_seen_at > _stall_threshold("first_chunk")
+            else:
+                stalled = now - last_chunk_at > _stall_threshold("gap")
+            if stalled:
+                restarted = yield from self._handle_stall(offset)
+                if not restarted:
+                    return
+                offset, pickup_seen_at, last_chunk_at = 0, None, None
+                started_at = time.monotonic()
+                continue
+            if self.abandoned is not None:
+                self.abandoned.wait(0.05)
+            else:
+                time.sleep(0.05)
+
+        print(f"⌛ [Deadline] 任务 {self.task_id[:8]} 已超过客户端截止时间。")
+        _mark(self.trace, "deadline_exceeded", chunks=offset)
+        self._cancel_hedge()
+        _cancel_task(self.task_id)
+        yield DEADLINE_EXCEEDED_SIGNAL
+
+    def _handle_stall(self, offset: int):
+        """处理卡住的任务。重新分派成功返回 True，否则产出 STALLED_SIGNAL 并返回 False。"""
+        phase = "首个数据块" if offset == 0 else f"第 {offset} 个数据块之后"
+        print(f"🧊 [Supervisor] 任务 {self.task_id[:8]} 在{phase}卡住 (Worker: {self.worker_id or LEGACY_WORKER_ID})。")
+        _mark(self.trace, "stall", chunks=offset, worker_id=self.worker_id)
+        if self.worker_id:
+            _mark_worker_unhealthy(self.worker_id, f"任务 {self.task_id[:8]} 在{phase}卡住")
+            self.avoided_workers.append(self.worker_id)
+
+        # 已经有对冲任务在运行时直接改用它
+        hedge = self._hedge_ready()
+        if hedge and offset == 0:
+            self._hedge = None
+            self._switch_to(hedge["task_id"], hedge["worker_id"])
+            _mark(self.trace, "hedge_won", worker_id=self.worker_id)
+            return True
+
+        self._cancel_hedge()
+        _cancel_task(self.task_id)
+        _discard_conversation_state(self.worker_id or LEGACY_WORKER_ID)
+        can_redispatch = self.worker_id and self.redispatches < STALL_MAX_REDISPATCHES and (offset == 0 or self.allow_restart)
+        if can_redispatch:
+            self.redispatches += 1
+            task_id, worker_id = _dispatch_elsewhere(self.request_base, self.message, self.client, self.deadline, self.avoided_workers, self.trace)
+            if task_id:
+                print(f"🔀 [Supervisor] 已在 worker {worker_id or LEGACY_WORKER_ID} 上重新分派 (新任务: {task_id[:8]})。")
+                _mark(self.trace, "redispatched", worker_id=worker_id)
+                self.task_id, self.worker_id = task_id, worker_id
+                if offset:
+                    yield RESTART_SIGNAL
+                return True
+        _mark(self.trace, "stalled", chunks=offset)
+        yield STALLED_SIGNAL
+        return False
+
+# --- 会话状态 (保存在任务代理服务器中) ---
+
+def _load_conversation_states(signature: str = None) -> dict:
+    """获取在线 worker 页面中的对话摘要: {worker_id: {model, signature, message_count}}，可只取与 signature 相同的"""
+    try:
+        res = requests.get(f"{INTERNAL_SERVER_URL}/conversation_states", params={"signature": signature} if signature else None,
+                           timeout=3, proxies=LOCAL_REQUEST_PROXIES)
+        res.raise_for_status()
+        return res.json().get("states", {})
+    except requests.exceptions.RequestException as e:
+        print(f"🚨 [Cache] 读取会话状态失败: {e}")
+        return {}
 
-def _update_conversation_state(request_base, new_messages: list):
+def _update_conversation_state(request_base, new_messages: list, worker_id: str):
     """
     通用状态更新函数。
     - request_base: 不包含新消息的基础请求。
     - new_messages: 一个包含 'user'/'tool' 和 'assistant' 消息的列表。
+    - worker_id: 该对话所在的浏览器 worker。
     """
-    global LAST_CONVERSATION_STATE
-    new_state = request_base.copy()
-    new_state["messages"].extend(new_messages)
-    LAST_CONVERSATION_STATE = new_state
-    print(f"✅ [Cache] 会话状态已更新，新增 {len(new_messages)} 条消息。")
+    # 只上传摘要，签名只需要对话末尾的几条消息
+    messages = request_base["messages"]
+    new_state = conversation_summary(messages[-SIGNATURE_MESSAGES:] + new_messages, request_base.get("model"), request_base.get("tools"))
+    new_state["message_count"] = len(messages) + len(new_messages)
+    try:
+        requests.put(f"{INTERNAL_SERVER_URL}/conversation_state/{worker_id or LEGACY_WORKER_ID}", json=new_state, timeout=3, proxies=LOCAL_REQUEST_PROXIES).raise_for_status()
+        print(f"✅ [Cache] 会话状态已更新，新增 {len(new_messages)} 条消息。")
+    except requests.exceptions.RequestException as e:
+        print(f"🚨 [Cache] 保存会话状态失败: {e}")
+
+def _discard_conversation_state(worker_id: str = None):
+    """页面状态已与缓存不一致 (生成被中断或提交失败)，清空缓存以便下次请求重新注入。不指定 worker 时清空全部。"""
+    try:
+        if worker_id is None:
+            requests.delete(f"{INTERNAL_SERVER_URL}/conversation_states", timeout=3, proxies=LOCAL_REQUEST_PROXIES)
+        else:
+            requests.delete(f"{INTERNAL_SERVER_URL}/conversation_state/{worker_id}", timeout=3, proxies=LOCAL_REQUEST_PROXIES)
+        print("🔄 [Cache] 会话缓存已清空。")
+    except requests.exceptions.RequestException as e:
+        print(f"🚨 [Cache] 清空会话状态失败: {e}")
 
 # --- 主处理逻辑 (升级以支持并行) ---
 
-def stream_and_update_state(task_id: str, request_base: dict, user_or_tool_message: dict):
+def stream_and_update_state(task_id: str, request_base: dict, user_or_tool_message: dict, deadline: float, worker_id: str, request_id: str, trace: RequestTrace = None,
+                            client: dict = None, hedge: bool = False, abandoned: threading.Event = None):
     model = request_base.get("model", "gemini-custom")
-    request_id = f"chatcmpl-{uuid.uuid4()}"
     text_pattern = re.compile(r'\[\s*null\s*,\s*\"((?:\\.|[^\"\\])*)\"')
     full_raw_response_buffer = ""
     full_ai_response_text = ""
+    stream_finished = False
 
     print("... 🟢 [Stream Mode] 开始实时传输 ...")
-    for chunk_content in _internal_task_processor(task_id):
-        if chunk_content == END_OF_STREAM_SIGNAL: break
-        full_raw_response_buffer += chunk_content
-        matches = text_pattern.findall(chunk_content)
-        for match_group in matches:
-            try:
-                # findall直接返回捕获组的内容
-                text = json.loads(f'"{match_group}"')
-                if text and not text.startswith("**"):
-                    full_ai_response_text += text
-                    yield format_openai_chunk(text, model, request_id)
-            except json.JSONDecodeError:
-                continue
+    supervisor = TaskSupervisor(task_id, worker_id, request_base, user_or_tool_message, client, deadline, hedge=hedge, trace=trace, abandoned=abandoned)
+    try:
+        for chunk_content in supervisor.chunks():
+            if chunk_content == ABANDONED_SIGNAL:
+                return # 由 finally 取消任务
+            if chunk_content in (DEADLINE_EXCEEDED_SIGNAL, STALLED_SIGNAL):
+                # 截止时间已到或生成卡住：结束响应并标记为截断
+                _discard_conversation_state(supervisor.worker_id or LEGACY_WORKER_ID)
+                stream_finished = True
+                _mark(trace, "finish", finish_reason="length")
+                yield format_openai_finish_chunk(model, request_id, "length")
+                yield "data: [DONE]\n\n"
+                return
+            if chunk_content == END_OF_STREAM_SIGNAL: break
+            full_raw_response_buffer += chunk_content
+            matches = text_pattern.findall(chunk_content)
+            for match_group in matches:
+                try:
+                    # findall直接返回捕获组的内容
+                    text = json.loads(f'"{match_group}"')
+                    if text and not text.startswith("**"):
+                        full_ai_response_text += text
+                        if trace: trace.mark("first_token", once=True)
+                        yield format_openai_chunk(text, model, request_id)
+                except json.JSONDecodeError:
+                    continue
+        stream_finished = True
+    finally:
+        if not stream_finished:
+            # 客户端断开后未在宽限期内重连 (ABANDONED_SIGNAL 或 GeneratorExit)，不必让浏览器继续生成
+            print(f"🔌 [Stream Mode] 客户端已断开，取消任务 {supervisor.task_id[:8]}。")
+            _mark(trace, "client_abandoned")
+            supervisor._cancel_hedge()
+            _cancel_task(supervisor.task_id)
+            _discard_conversation_state(supervisor.worker_id or LEGACY_WORKER_ID)
 
     print("... 🟡 [Stream Mode] 流结束，解析最终结果 ...")
-    final_tool_calls = parse_final_buffer_for_tool_calls(full_raw_response_buffer)
+    with trace.span("parse_tool_calls") if trace else _null_span():
+        final_tool_calls = parse_final_buffer_for_tool_calls(full_raw_response_buffer, request_base.get("tools"))
     finish_reason = "stop"
     assistant_message = {"role": "assistant"}
 
@@ -254,19 +1127,31 @@ def stream_and_update_state(task_id: str, request_base: dict, user_or_tool_messa
     else:
         assistant_message["content"] = full_ai_response_text
     
-    _update_conversation_state(request_base, [user_or_tool_message, assistant_message])
+    _update_conversation_state(request_base, [user_or_tool_message, assistant_message], supervisor.worker_id)
+    _mark(trace, "finish", finish_reason=finish_reason)
     yield format_openai_finish_chunk(model, request_id, finish_reason)
     yield "data: [DONE]\n\n"
 
-def generate_non_streaming_response(task_id: str, request_base: dict, user_or_tool_message: dict):
+def generate_non_streaming_response(task_id: str, request_base: dict, user_or_tool_message: dict, deadline: float, worker_id: str, request_id: str = None, trace: RequestTrace = None,
+                                    client: dict = None, hedge: bool = False):
     model = request_base.get("model", "gemini-custom")
-    request_id = f"chatcmpl-{uuid.uuid4()}"
+    request_id = request_id or f"chatcmpl-{uuid.uuid4()}"
     text_pattern = re.compile(r'\[\s*null\s*,\s*\"((?:\\.|[^\"\\])*)\"')
     full_raw_response_buffer = ""
     full_ai_response_text = ""
 
     print("... 🟢 [Non-Stream Mode] 在后台收集所有数据 ...")
-    for chunk_content in _internal_task_processor(task_id):
+    # 非流式响应在结束前不会向客户端输出任何内容，生成中途卡住也可以换一个 worker 从头生成
+    supervisor = TaskSupervisor(task_id, worker_id, request_base, user_or_tool_message, client, deadline, hedge=hedge, allow_restart=True, trace=trace)
+    for chunk_content in supervisor.chunks():
+        if chunk_content in (DEADLINE_EXCEEDED_SIGNAL, STALLED_SIGNAL):
+            # 截止时间已到或生成卡住：返回已收到的部分文本并标记为截断
+            _discard_conversation_state(supervisor.worker_id or LEGACY_WORKER_ID)
+            _mark(trace, "finish", finish_reason="length")
+            return format_openai_non_stream_response(full_ai_response_text, [], model, request_id, "length")
+        if chunk_content == RESTART_SIGNAL:
+            full_raw_response_buffer, full_ai_response_text = "", ""
+            continue
         if chunk_content == END_OF_STREAM_SIGNAL: break
         full_raw_response_buffer += chunk_content
         matches = text_pattern.findall(chunk_content)
@@ -280,7 +1165,8 @@ def generate_non_streaming_response(task_id: str, request_base: dict, user_or_to
                 continue
     
     print("... 🟡 [Non-Stream Mode] 收集完成，解析最终结果 ...")
-    final_tool_calls = parse_final_buffer_for_tool_calls(full_raw_response_buffer)
+    with trace.span("parse_tool_calls") if trace else _null_span():
+        final_tool_calls = parse_final_buffer_for_tool_calls(full_raw_response_buffer, request_base.get("tools"))
     finish_reason = "stop"
     assistant_message = {"role": "assistant"}
 
@@ -291,7 +1177,7 @@ def generate_non_streaming_response(task_id: str, request_base: dict, user_or_to
     else:
         assistant_message["content"] = full_ai_response_text
     
-    _update_conversation_state(request_base, [user_or_tool_message, assistant_message])
+    _update_conversation_state(request_base, [user_or_tool_message, assistant_message], supervisor.worker_id)
     
     final_json_response = format_openai_non_stream_response(
         full_ai_response_text,
@@ -300,18 +1186,33 @@ def generate_non_streaming_response(task_id: str, request_base: dict, user_or_to
         request_id,
         finish_reason
     )
+    _mark(trace, "finish", finish_reason=finish_reason)
     return final_json_response
 
 # --- 服务器路由与主逻辑 (保持不变) ---
-def check_internal_server():
-    print("...正在检查内部服务器状态...")
+def _fetch_internal_readiness(timeout: float = 2):
+    """查询内部服务器的 /readyz，返回 (是否就绪, 响应内容)"""
     try:
-        response = requests.get(INTERNAL_SERVER_URL, timeout=3, proxies=LOCAL_REQUEST_PROXIES)
-        if response.status_code == 200:
-            print(f"✅ 内部服务器 (在 {INTERNAL_SERVER_URL}) 连接成功！")
+        response = requests.get(f"{INTERNAL_SERVER_URL}/readyz", timeout=timeout, proxies=LOCAL_REQUEST_PROXIES)
+        return response.status_code == 200, response.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        return False, {"status": "unreachable", "error": str(e)}
+
+def check_internal_server(timeout: float = STARTUP_TIMEOUT_SECONDS):
+    """以指数退避轮询内部服务器的就绪探针，就绪后立即返回，超时则报错"""
+    print("...正在等待内部服务器就绪...")
+    started_at = time.monotonic()
+    delay = 0.02
+    while True:
+        ready, status = _fetch_internal_readiness()
+        if ready:
+            print(f"✅ 内部服务器 (在 {INTERNAL_SERVER_URL}) 已就绪 (等待 {time.monotonic() - started_at:.2f} 秒，在线 worker: {status.get('workers', 0)})。")
             return True
-    except requests.exceptions.RequestException:
-        print("\n" + "!"*60); print("!! 致命错误：无法连接到内部服务器！"); print(f"!! 请确保 `local_history_server.py` 已经启动并且正在 {INTERNAL_SERVER_URL} 上运行。"); print("!"*60); return False
+        if time.monotonic() - started_at + delay > timeout:
+            break
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+    print("\n" + "!"*60); print(f"!! 致命错误：内部服务器在 {timeout:.0f} 秒内未就绪！"); print(f"!! 最后一次检查结果: {status}"); print(f"!! 请确保 `local_history_server.py` 已经启动并且正在 {INTERNAL_SERVER_URL} 上运行。"); print("!"*60); return False
 
 def _normalize_message_content(message: dict) -> dict:
     content = message.get("content");
@@ -319,49 +1220,117 @@ def _normalize_message_content(message: dict) -> dict:
         message["content"] = "\n\n".join([p.get("text", "") for p in content if isinstance(p, dict) and p.get("type") == "text"])
     return message
 
-def _inject_history(job_payload: dict, timeout: int = 30):
+def _externalize_text(text):
+    """
+    超过 BLOB_THRESHOLD_BYTES 的文本上传为内容寻址的负载并返回引用，否则原样返回。
+    内部服务器已有相同内容时只做一次 HEAD 检查。上传失败时退回内联传输。
+    """
+    # UTF-8 字节数不少于字符数，字符数未超过阈值的四分之一时一定不需要计算摘要
+    if not BLOB_THRESHOLD_BYTES or not isinstance(text, str) or len(text) * 4 < BLOB_THRESHOLD_BYTES:
+        return text
+    digest, size = digest_text(text)
+    if size < BLOB_THRESHOLD_BYTES:
+        return text
+    blob_url = f"{INTERNAL_SERVER_URL}/blobs/{digest}"
+    try:
+        res = requests.head(blob_url, timeout=3, proxies=LOCAL_REQUEST_PROXIES)
+        if res.status_code == 200:
+            print(f"♻️ [Blob] 负载 {digest[:12]} 已存在 ({size} 字节)，跳过上传。")
+            return blob_reference(digest, size, int(res.headers.get("Content-Length", 0)))
+        # 生成器作为请求体时使用分块传输，边压缩边发送
+        res = requests.put(blob_url, data=gzip_chunks(text), headers={"Content-Type": "application/gzip"},
+                           timeout=BLOB_UPLOAD_TIMEOUT_SECONDS, proxies=LOCAL_REQUEST_PROXIES)
+        res.raise_for_status()
+        compressed_size = res.json()["compressed_bytes"]
+        print(f"📦 [Blob] 已上传负载 {digest[:12]}: {size} -> {compressed_size} 字节 (gzip)。")
+        return blob_reference(digest, size, compressed_size)
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        print(f"⚠️ [Blob] 上传负载失败，改为内联传输: {e}")
+        return text
+
+def _externalize_messages(messages: list) -> list:
+    """把消息列表中的大段内容替换为负载引用 (返回新的列表，不修改原消息)"""
+    externalized = []
+    for message in messages or []:
+        content = _externalize_text(message.get("content"))
+        externalized.append(message if content is message.get("content") else {**message, "content": content})
+    return externalized
+
+def _inject_history(job_payload: dict, deadline: float, trace: RequestTrace = None):
     """
     提交注入任务并智能等待其完成，而不是固定等待。
-    返回 True 表示成功，False 表示失败或超时。
+    等待时间不超过 INJECTION_TIMEOUT_SECONDS，也不超过客户端剩余的时间。
+    返回 (是否成功, 完成注入的 worker_id)。后续的对话任务必须交给同一个 worker。
     """
     try:
-        # 1. 重置事件标志
+        # 1. 重置事件标志 (兼容旧版脚本)
         INJECTION_COMPLETE_EVENT.clear()
         
-        # 2. 提交任务
+        # 2. 提交任务 (附带截止时间，过期的注入任务会在被取走前丢弃)
         print("🔄 [Injection] 提交注入任务到内部服务器...")
-        requests.post(f"{INTERNAL_SERVER_URL}/submit_injection_job", json=job_payload, proxies=LOCAL_REQUEST_PROXIES).raise_for_status()
-
-        # 3. 等待事件被设置 (最多等待 timeout 秒)
-        print(f"...[Injection] 开始等待 History Forger 完成注入 (最长 {timeout} 秒)...")
-        completed_in_time = INJECTION_COMPLETE_EVENT.wait(timeout=timeout)
-
-        if completed_in_time:
-            print("✅ [Injection] 已收到注入完成信号！")
-            return True
-        else:
-            print("🚨 [Injection] 等待注入完成超时！")
-            return False
+        timeout = min(INJECTION_TIMEOUT_SECONDS, _remaining_seconds(deadline))
+        injection_task_id = str(uuid.uuid4())
+        job_payload = {**job_payload, "task_id": injection_task_id, "deadline": time.time() + timeout,
+                       "messages": _externalize_messages(job_payload.get("messages"))}
+        requests.post(f"{INTERNAL_SERVER_URL}/submit_injection_job", json=job_payload, timeout=max(timeout, 1), proxies=LOCAL_REQUEST_PROXIES).raise_for_status()
+        _mark(trace, "inject_submitted", task_id=injection_task_id)
+
+        # 3. 轮询注入任务状态 (最多等待 timeout 秒)
+        print(f"...[Injection] 开始等待 History Forger 完成注入 (最长 {timeout:.1f} 秒)...")
+        wait_until = time.time() + timeout
+        while time.time() < wait_until:
+            if INJECTION_COMPLETE_EVENT.is_set():
+                print("✅ [Injection] 已收到 (旧版) 注入完成信号！")
+                return True, None
+            try:
+                res = requests.get(f"{INTERNAL_SERVER_URL}/task/{injection_task_id}", timeout=3, proxies=LOCAL_REQUEST_PROXIES)
+                task = res.json().get("task") if res.status_code == 200 else None
+                if trace and task and task.get("picked_at"):
+                    trace.mark_wall("inject_pickup", task["picked_at"], once=True, worker_id=task.get("worker_id"))
+                if task and task["status"] == "completed":
+                    print(f"✅ [Injection] 已收到注入完成信号！(Worker: {task['worker_id'] or LEGACY_WORKER_ID})")
+                    _mark(trace, "inject_complete", worker_id=task["worker_id"])
+                    return True, task["worker_id"]
+                if task and task["status"] in ("failed", "expired", "cancelled"):
+                    print(f"🚨 [Injection] 注入任务结束，状态: {task['status']}。")
+                    return False, None
+            except requests.exceptions.RequestException:
+                pass
+            INJECTION_COMPLETE_EVENT.wait(timeout=0.1)
+
+        print("🚨 [Injection] 等待注入完成超时！")
+        return False, None
 
     except requests.exceptions.RequestException as e:
         print(f"🚨 [Injection] 提交注入任务失败: {e}")
-        return False
+        return False, None
 
 
-def _submit_prompt(prompt: str):
+def _client_fields(client: dict) -> dict:
+    """内部任务中携带的客户端信息，供任务服务器做公平调度"""
+    if not client: return {}
+    return {"client_id": client["id"], "client_weight": client["weight"]}
+
+def _worker_fields(worker_id: str) -> dict:
+    """对话必须在已有页面状态的那个 worker 中继续，因此使用强制亲和"""
+    if not worker_id: return {}
+    return {"worker_id": worker_id, "strict_affinity": True}
+
+def _submit_prompt(prompt: str, client: dict = None, deadline: float = None, worker_id: str = None):
     try:
-        response = requests.post(f"{INTERNAL_SERVER_URL}/submit_prompt", json={"prompt": prompt}, proxies=LOCAL_REQUEST_PROXIES)
+        payload = {"prompt": _externalize_text(prompt), "deadline": deadline, **_client_fields(client), **_worker_fields(worker_id)}
+        response = requests.post(f"{INTERNAL_SERVER_URL}/submit_prompt", json=payload, proxies=LOCAL_REQUEST_PROXIES)
         response.raise_for_status(); return response.json()['task_id']
     except requests.exceptions.RequestException: return None
 
-def _submit_tool_result(result: str):
+def _submit_tool_result(result: str, client: dict = None, deadline: float = None, worker_id: str = None):
     """
     为工具函数返回结果创建一个新的任务，并将其提交到内部服务器。
     返回一个新的 task_id 用于跟踪 AI 的后续响应。
     """
     try:
         new_task_id = str(uuid.uuid4())
-        payload = {"task_id": new_task_id, "result": result}
+        payload = {"task_id": new_task_id, "result": _externalize_text(result), "deadline": deadline, **_client_fields(client), **_worker_fields(worker_id)}
         response = requests.post(f"{INTERNAL_SERVER_URL}/submit_tool_result", json=payload, proxies=LOCAL_REQUEST_PROXIES)
         response.raise_for_status()
         print(f"✅ [API Gateway] 已为工具返回结果创建并提交新任务 (ID: {new_task_id[:8]})。")
@@ -373,7 +1342,7 @@ def _submit_tool_result(result: str):
 
 @app.route('/report_injection_complete', methods=['POST'])
 def report_injection_complete():
-    """由 historyforger.js 调用，以设置注入完成的事件"""
+    """由旧版 historyforger.js 调用，以设置注入完成的事件。新版脚本直接向内部服务器报告。"""
     print("✔️ [Injection] 收到来自 History Forger 的完成报告。")
     INJECTION_COMPLETE_EVENT.set()
     return jsonify({"status": "success"}), 200
@@ -381,34 +1350,80 @@ def report_injection_complete():
 
 @app.route('/reset_state', methods=['POST'])
 def reset_state():
-    global LAST_CONVERSATION_STATE; LAST_CONVERSATION_STATE = None
-    print("🔄 [Cache] 会话缓存已被手动重置。")
+    """由 Automator 在成为主标签页时调用。携带 worker_id 时只重置该 worker 的会话。"""
+    worker_id = (request.get_json(silent=True) or {}).get("worker_id")
+    _discard_conversation_state(worker_id)
+    print(f"🔄 [Cache] 会话缓存已被手动重置 (Worker: {worker_id or '全部'})。")
     return jsonify({"status": "success", "message": "Conversation cache has been reset."})
 
 @app.route('/v1/chat/completions', methods=['POST', 'OPTIONS'])
 def chat_completions():
     if request.method == 'OPTIONS': return '', 200
-    global LAST_CONVERSATION_STATE
     print(f"\n[{time.strftime('%Y-%m-%d %H:%M:%S')}] 接收到新的 /v1/chat/completions 请求...")
-    request_data = request.json
+    client, error_response = _identify_client()
+    if error_response: return error_response
+    print(f"客户端: {client['id']}")
+
+    # 【新】携带 Last-Event-ID 的重连请求：从断点回放，不重新生成
+    completion_id, last_seq = _parse_last_event_id(request.headers.get("Last-Event-ID"))
+    if completion_id:
+        buffer = _get_stream_buffer(completion_id, client["id"])
+        if buffer:
+            print(f"🔁 [Stream Mode] 客户端重连 {completion_id}，从事件 {last_seq} 之后继续。")
+            return Response(buffer.read_from(last_seq), mimetype='text/event-stream')
+        print(f"⚠️ [Stream Mode] 未找到可恢复的流 {completion_id}，按新请求处理。")
+
+    rate_limited_response = _admit_client(client)
+    if rate_limited_response: return rate_limited_response
+
+    started_at = time.monotonic()
+    trace = _start_trace(client)
+    result = _process_chat_completion(request.json, client, started_at, trace)
+    # 流式响应在生成器结束时自行记录统计，其余响应在此记录
+    if not (isinstance(result, Response) and result.is_streamed):
+        status_code = result[1] if isinstance(result, tuple) else 200
+        _record_client_request(client, started_at, status_code < 400)
+        trace.mark("response", status_code=status_code)
+    response = make_response(result)
+    response.headers["X-Request-Id"] = trace.trace_id
+    if request.headers.get("X-Debug-Timeline") == "1" and not response.is_streamed:
+        response.headers["X-Request-Timeline"] = json.dumps(trace.to_dict()["events"], ensure_ascii=True, separators=(",", ":"))
+    return response
+
+def _process_chat_completion(request_data: dict, client: dict, started_at: float, trace: RequestTrace):
     try:
-        messages = [_normalize_message_content(msg) for msg in request_data.get("messages", [])]
-        request_data["messages"] = messages
+        with trace.span("normalize"):
+            messages = [_normalize_message_content(msg) for msg in request_data.get("messages", [])]
+            request_data["messages"] = messages
     except Exception as e: return jsonify({"error": f"处理消息内容时失败: {e}"}), 400
     if not messages: return jsonify({"error": "'messages' 列表不能为空。"}), 400
+    deadline = _resolve_deadline(request_data)
+    request_data.pop("timeout", None)
+    hedge = bool(request_data.pop("hedge", HEDGE_BY_DEFAULT))
+
+    # 【新】未知模型直接拒绝，避免浏览器白白注入一次
+    requested_model = request_data.get("model")
+    if requested_model:
+        known, _ = _lookup_model(requested_model)
+        if not known:
+            print(f"🚫 [Model] 未知的模型: {requested_model}")
+            return jsonify({"error": {"message": f"The model '{requested_model}' does not exist.", "type": "invalid_request_error", "param": "model", "code": "model_not_found"}}), 404
 
     use_stream = request_data.get('stream', False)
     print(f"模式检测: stream={use_stream}")
-    is_continuation = False
-    if LAST_CONVERSATION_STATE:
-        cached_messages, new_messages_base = LAST_CONVERSATION_STATE.get("messages", []), messages[:-1]
-        # 检查是否是连续对话（用户或工具）
+    is_continuation, worker_id = False, None
+    if messages[-1].get("role") in ["user", "tool"]:
+        # 检查是否是某个 worker 页面中对话的延续（用户或工具）
         # 【【【优化：只比较最后5条消息以提高效率和容错性】】】
-        # 取每个列表的最后5个元素进行比较
-        if json.dumps(cached_messages[-5:], sort_keys=True) == json.dumps(new_messages_base[-5:], sort_keys=True):
-            last_message_role = messages[-1].get("role")
-            if last_message_role in ["user", "tool"]:
-                 is_continuation = True
+        # 【新】页面中的模型和工具定义也必须一致，否则需要重新注入 (预热后的空对话页面同样按此匹配)
+        # 【新】只比较摘要 (conversation_signature)，代理服务器只返回摘要相同的 worker，不再下载完整历史
+        with trace.span("fast_path_check"):
+            base_signature = conversation_signature(messages[:-1], request_data.get("model"), request_data.get("tools"))
+            for state_worker_id, state in _load_conversation_states(base_signature).items():
+                if state.get("signature") == base_signature:
+                    is_continuation = True
+                    worker_id = None if state_worker_id == LEGACY_WORKER_ID else state_worker_id
+                    break
 
     task_id, last_message, request_base_for_update = None, None, None
     
@@ -418,24 +1433,26 @@ def chat_completions():
         request_base_for_update["messages"] = messages[:-1] # 更新状态时只用基础部分
 
         if last_message.get("role") == "user":
-            print("⚡️ [Fast Path] 检测到连续【用户对话】，跳过页面刷新。")
-            task_id = _submit_prompt(last_message.get("content"))
+            print(f"⚡️ [Fast Path] 检测到连续【用户对话】，跳过页面刷新。(Worker: {worker_id or LEGACY_WORKER_ID})")
+            task_id = _submit_prompt(last_message.get("content"), client, deadline, worker_id)
+            _mark(trace, "prompt_submitted", path="fast", worker_id=worker_id)
             if not task_id:
-                LAST_CONVERSATION_STATE = None
+                _discard_conversation_state(worker_id or LEGACY_WORKER_ID)
                 return jsonify({"error": "快速通道提交Prompt失败"}), 500
         
         elif last_message.get("role") == "tool":
-            print("️️️⚡️ [Fast Path] 检测到【工具结果返回】，准备提交。")
+            print(f"️️️⚡️ [Fast Path] 检测到【工具结果返回】，准备提交。(Worker: {worker_id or LEGACY_WORKER_ID})")
             tool_result_content = last_message.get("content", "")
-            task_id = _submit_tool_result(tool_result_content)
+            task_id = _submit_tool_result(tool_result_content, client, deadline, worker_id)
+            _mark(trace, "tool_result_submitted", path="fast", worker_id=worker_id)
             if not task_id:
-                LAST_CONVERSATION_STATE = None
+                _discard_conversation_state(worker_id or LEGACY_WORKER_ID)
                 return jsonify({"error": "提交工具结果失败"}), 500
 
     else: # 新对话或状态不一致
         print("🔄 [Full Injection] 检测到新对话或状态不一致，执行完整页面注入。")
-        LAST_CONVERSATION_STATE = None
         injection_payload = request_data.copy()
+        injection_payload.update(_client_fields(client))
         last_message = messages[-1] if messages else None
 
         if last_message and last_message.get("role") == "user":
@@ -445,15 +1462,18 @@ def chat_completions():
 
         request_base_for_update = injection_payload
         
-        if not _inject_history(injection_payload):
+        with trace.span("inject_history"):
+            injected, worker_id = _inject_history(injection_payload, deadline, trace)
+        if not injected:
             return jsonify({"error": "注入历史记录失败。"}), 500
         
         if last_message:
-            task_id = _submit_prompt(last_message.get("content"))
+            task_id = _submit_prompt(last_message.get("content"), client, deadline, worker_id)
+            _mark(trace, "prompt_submitted", path="full", worker_id=worker_id)
         else:
-            _update_conversation_state(request_base_for_update, [])
+            _update_conversation_state(request_base_for_update, [], worker_id)
             model = request_data.get("model", "gemini-custom")
-            req_id = f"chatcmpl-{uuid.uuid4()}"
+            req_id = trace.trace_id
             if use_stream:
                 return Response(f"{format_openai_finish_chunk(model, req_id, 'stop')}data: [DONE]\n\n", mimetype='text/event-stream')
             else:
@@ -463,9 +1483,279 @@ def chat_completions():
         return jsonify({"error": "未能获取任务ID"}), 500
 
     if use_stream:
-        return Response(stream_and_update_state(task_id, request_base_for_update, last_message), mimetype='text/event-stream')
+        buffer = _register_stream_buffer(trace.trace_id, client["id"])
+        stream = stream_and_update_state(task_id, request_base_for_update, last_message, deadline, worker_id, trace.trace_id, trace, client, hedge, buffer.abandoned)
+        _start_stream(buffer, stream)
+        return Response(_track_stream(buffer.read_from(), client, started_at), mimetype='text/event-stream')
     else:
-        return jsonify(generate_non_streaming_response(task_id, request_base_for_update, last_message))
+        return jsonify(generate_non_streaming_response(task_id, request_base_for_update, last_message, deadline, worker_id, trace.trace_id, trace, client, hedge))
+
+@app.route('/v1/chat/completions/<completion_id>/stream', methods=['GET'])
+def resume_chat_completion_stream(completion_id):
+    """【新】按 chatcmpl-id 恢复流式响应。从 Last-Event-ID 请求头 (或 last_event_id 参数) 之后开始回放。"""
+    client, error_response = _identify_client()
+    if error_response: return error_response
+    buffer = _get_stream_buffer(completion_id, client["id"])
+    if not buffer:
+        return jsonify({"error": {"message": f"Stream '{completion_id}' not found or expired.", "type": "invalid_request_error", "code": "stream_not_found"}}), 404
+    _, last_seq = _parse_last_event_id(request.headers.get("Last-Event-ID") or request.args.get("last_event_id"))
+    print(f"🔁 [Stream Mode] 客户端重连 {completion_id}，从事件 {last_seq} 之后继续。")
+    return Response(buffer.read_from(last_seq), mimetype='text/event-stream')
+
+# --- 【新】离线批处理 API ---
+
+def _batch_store() -> BatchStore:
+    global BATCH_STORE
+    with BATCH_LOCK:
+        if BATCH_STORE is None:
+            BATCH_STORE = BatchStore(BATCH_DATA_DIR)
+        return BATCH_STORE
+
+def _public(obj: dict) -> dict:
+    """去掉内部字段后返回给客户端"""
+    return {key: value for key, value in obj.items() if key != "owner"}
+
+def _batch_error(message: str, code: str, status_code: int = 400):
+    return jsonify({"error": {"message": message, "type": "invalid_request_error", "code": code}}), status_code
+
+def _batch_client(owner: str) -> dict:
+    """批处理以独立的低权重客户端身份参与调度，不占用所有者的交互限额"""
+    return {"id": f"batch:{owner}", "rate": 0, "burst": 0, "weight": BATCH_CLIENT_WEIGHT}
+
+def _validate_batch_line(record) -> str:
+    if not isinstance(record, dict): return "无法解析为 JSON 对象。"
+    if record.get("custom_id") is None: return "缺少 custom_id。"
+    if record.get("method", "POST") != "POST" or record.get("url") != "/v1/chat/completions":
+        return "仅支持 POST /v1/chat/completions。"
+    body = record.get("body")
+    if not isinstance(body, dict) or not body.get("messages"): return "body.messages 不能为空。"
+    return None
+
+def _sort_batch_requests(records: list) -> list:
+    """按 (模型, 工具) 排序批处理请求 (同一键内保持文件中的顺序)，使同一模型的请求连续执行，减少浏览器切换模型"""
+    return sorted(records, key=lambda record: (str(record["body"].get("model")), json.dumps(record["body"].get("tools"), sort_keys=True)))
+
+def _execute_batch_request(record: dict, client: dict):
+    """在后台线程中执行一个批处理请求，返回 (结果行, 是否成功)"""
+    body = {**record["body"], "stream": False}
+    body.setdefault("timeout", BATCH_REQUEST_TIMEOUT_SECONDS)
+    started_at = time.monotonic()
+    trace = _start_trace(client)
+    with app.app_context():
+        try:
+            result = _process_chat_completion(body, client, started_at, trace)
+        except Exception as e:
+            print(f"🚨 [Batch] 请求 {record['custom_id']} 执行失败: {type(e).__name__}: {e}")
+            result = (jsonify({"error": {"message": str(e), "type": "server_error"}}), 500)
+        response = make_response(result)
+        status_code, payload = response.status_code, response.get_json(silent=True)
+    success = status_code < 400
+    _record_client_request(client, started_at, success)
+    trace.mark("response", status_code=status_code)
+    line = {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": record["custom_id"],
+            "response": {"status_code": status_code, "request_id": trace.trace_id, "body": payload}, "error": None}
+    if not success:
+        error = (payload or {}).get("error")
+        line["error"] = {"code": str(status_code), "message": error.get("message") if isinstance(error, dict) else str(error)}
+    return line, success
+
+def _run_batch(batch_id: str):
+    """执行 (或从断点继续执行) 一个批处理任务"""
+    store = _batch_store()
+    cancel_event = BATCH_CANCEL_EVENTS.setdefault(batch_id, threading.Event())
+    batch = store.get_batch(batch_id)
+    progress_lock = threading.Lock()
+    try:
+        # 等待内部服务器就绪 (网关启动时恢复的批处理可能先于内部服务器运行)
+        while not _fetch_internal_readiness()[0]:
+            if cancel_event.wait(timeout=1): break
+
+        # 进度以结果文件为准 (进程可能在写入结果之后、保存进度之前退出)
+        completed_ids = store.result_custom_ids(batch["output_file_id"])
+        failed_ids = store.result_custom_ids(batch["error_file_id"])
+        batch["request_counts"].update(completed=len(completed_ids), failed=len(failed_ids))
+        finished = completed_ids | failed_ids
+        pending = [record for _, record in store.read_lines(batch["input_file_id"]) if record and record["custom_id"] not in finished]
+        queue = deque(_sort_batch_requests(pending))
+        _, broker_status = _fetch_internal_readiness()
+        lanes = max(1, min(BATCH_MAX_CONCURRENCY, broker_status.get("workers") or 1, len(queue) or 1))
+        client = _batch_client(batch["owner"])
+        if finished:
+            print(f"🔁 [Batch] {batch_id} 从断点继续: 已完成 {len(finished)} 个，剩余 {len(pending)} 个。")
+        print(f"📦 [Batch] {batch_id} 开始执行: {len(pending)} 个请求，{lanes} 条执行线。")
+
+        def lane():
+            while not cancel_event.is_set():
+                with progress_lock:
+                    if not queue: return
+                    record = queue.popleft()
+                line, success = _execute_batch_request(record, client)
+                with progress_lock, store.batch_lock(batch_id):
+                    store.append_line(batch["output_file_id"] if success else batch["error_file_id"], line)
+                    counts = batch["request_counts"]
+                    counts["completed" if success else "failed"] += 1
+                    if cancel_event.is_set() and batch["status"] == "in_progress":
+                        # 取消接口写入的状态不能被进度覆盖
+                        batch.update(status="cancelling", cancelling_at=int(time.time()))
+                    store.save_batch(batch)
+                    done = counts["completed"] + counts["failed"]
+                print(f"📦 [Batch] {batch_id[:14]} 进度: {done}/{counts['total']} (失败 {counts['failed']})。")
+
+        threads = [threading.Thread(target=lane, name=f"batch-{batch_id[:14]}-{i}", daemon=True) for i in range(lanes)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+    except Exception as e:
+        print(f"🚨 [Batch] {batch_id} 执行出错: {type(e).__name__}: {e}")
+        batch["status"] = "failed"
+        batch["failed_at"] = int(time.time())
+        batch["errors"] = {"object": "list", "data": [{"code": "internal_error", "message": str(e)}]}
+    finally:
+        # 在批处理锁内决定最终状态，与取消接口的读-改-写互斥
+        with store.batch_lock(batch_id):
+            if batch["status"] != "failed":
+                batch["status"] = "cancelled" if cancel_event.is_set() else "completed"
+                batch[f"{batch['status']}_at"] = int(time.time())
+            store.save_batch(batch)
+            BATCH_CANCEL_EVENTS.pop(batch_id, None)
+        print(f"📦 [Batch] {batch_id} 已结束，状态: {batch['status']}。")
+
+def _start_batch_runner(batch_id: str):
+    BATCH_CANCEL_EVENTS.setdefault(batch_id, threading.Event())
+    threading.Thread(target=_run_batch, args=(batch_id,), name=f"batch-{batch_id[:14]}", daemon=True).start()
+
+def resume_batches():
+    """网关启动时调用：继续执行重启前未完成的批处理"""
+    store = _batch_store()
+    for batch in store.list_batches():
+        if batch["status"] not in ACTIVE_BATCH_STATUSES:
+            continue
+        if batch["status"] == "cancelling":
+            with store.batch_lock(batch["id"]):
+                batch.update(status="cancelled", cancelled_at=int(time.time()))
+                store.save_batch(batch)
+            continue
+        print(f"🔁 [Batch] 恢复未完成的批处理 {batch['id']}。")
+        _start_batch_runner(batch["id"])
+
+@app.route('/v1/files', methods=['POST'])
+def upload_file():
+    client, error_response = _identify_client()
+    if error_response: return error_response
+    uploaded = request.files.get("file")
+    purpose = request.form.get("purpose")
+    if uploaded is None: return _batch_error("缺少 file 字段。", "missing_file")
+    if purpose != "batch": return _batch_error("目前只支持 purpose=batch。", "invalid_purpose")
+    try:
+        file_obj = _batch_store().create_file(uploaded.stream, uploaded.filename or "batch.jsonl", purpose, client["id"],
+                                              max_bytes=BATCH_MAX_FILE_BYTES)
+    except FileTooLargeError as e:
+        return _batch_error(str(e), "file_too_large", 413)
+    print(f"📁 [Files] 客户端 {client['id']} 上传了文件 {file_obj['id']} ({file_obj['bytes']} 字节)。")
+    return jsonify(_public(file_obj))
+
+def _owned_file(file_id: str, client: dict):
+    file_obj = _batch_store().get_file(file_id)
+    return file_obj if file_obj and file_obj["owner"] == client["id"] else None
+
+@app.route('/v1/files/<file_id>', methods=['GET'])
+def get_file(file_id):
+    client, error_response = _identify_client()
+    if error_response: return error_response
+    file_obj = _owned_file(file_id, client)
+    if not file_obj: return _batch_error(f"No such File object: {file_id}", "file_not_found", 404)
+    return jsonify(_public(file_obj))
+
+@app.route('/v1/files/<file_id>/content', methods=['GET'])
+def get_file_content(file_id):
+    client, error_response = _identify_client()
+    if error_response: return error_response
+    file_obj = _owned_file(file_id, client)
+    if not file_obj: return _batch_error(f"No such File object: {file_id}", "file_not_found", 404)
+    return send_file(os.path.abspath(_batch_store().file_path(file_id)), mimetype="application/jsonl", download_name=file_obj["filename"])
+
+@app.route('/v1/batches', methods=['POST'])
+def create_batch():
+    client, error_response = _identify_client()
+    if error_response: return error_response
+    data = request.get_json(silent=True) or {}
+    store = _batch_store()
+    if data.get("endpoint", "/v1/chat/completions") != "/v1/chat/completions":
+        return _batch_error("目前只支持 /v1/chat/completions。", "invalid_endpoint")
+    input_file = _owned_file(data.get("input_file_id") or "", client)
+    if not input_file: return _batch_error(f"No such File object: {data.get('input_file_id')}", "file_not_found", 404)
+
+    # 校验输入文件
+    errors, custom_ids, total = [], set(), 0
+    for line_number, record in store.read_lines(input_file["id"]):
+        total += 1
+        message = _validate_batch_line(record)
+        if message is None and record["custom_id"] in custom_ids:
+            message = f"custom_id 重复: {record['custom_id']}"
+        if message:
+            errors.append({"code": "invalid_request", "line": line_number, "message": message})
+        else:
+            custom_ids.add(record["custom_id"])
+    now = int(time.time())
+    batch = {
+        "endpoint": "/v1/chat/completions",
+        "input_file_id": input_file["id"],
+        "completion_window": data.get("completion_window", BATCH_COMPLETION_WINDOW),
+        "metadata": data.get("metadata"),
+        "owner": client["id"],
+        "request_counts": {"total": total, "completed": 0, "failed": 0},
+        "errors": None
+    }
+    if errors or not total:
+        batch.update(status="failed", failed_at=now, errors={"object": "list", "data": errors[:100] or [{"code": "empty_file", "message": "输入文件为空。"}]})
+        return jsonify(_public(store.create_batch(batch)))
+
+    batch.update(status="in_progress", in_progress_at=now,
+                 output_file_id=store.create_empty_file("batch_output.jsonl", "batch_output", client["id"])["id"],
+                 error_file_id=store.create_empty_file("batch_errors.jsonl", "batch_output", client["id"])["id"])
+    batch = store.create_batch(batch)
+    print(f"📦 [Batch] 客户端 {client['id']} 创建了批处理 {batch['id']} ({total} 个请求)。")
+    _start_batch_runner(batch["id"])
+    return jsonify(_public(batch))
+
+def _owned_batch(batch_id: str, client: dict):
+    batch = _batch_store().get_batch(batch_id)
+    return batch if batch and batch["owner"] == client["id"] else None
+
+@app.route('/v1/batches', methods=['GET'])
+def list_batches():
+    client, error_response = _identify_client()
+    if error_response: return error_response
+    limit = request.args.get("limit", 20, type=int)
+    batches = [_public(batch) for batch in _batch_store().list_batches(client["id"])]
+    return jsonify({"object": "list", "data": batches[:limit], "has_more": len(batches) > limit})
+
+@app.route('/v1/batches/<batch_id>', methods=['GET'])
+def get_batch(batch_id):
+    client, error_response = _identify_client()
+    if error_response: return error_response
+    batch = _owned_batch(batch_id, client)
+    if not batch: return _batch_error(f"No such Batch object: {batch_id}", "batch_not_found", 404)
+    return jsonify(_public(batch))
+
+@app.route('/v1/batches/<batch_id>/cancel', methods=['POST'])
+def cancel_batch(batch_id):
+    """停止领取新的请求，正在执行的请求完成后批处理变为 cancelled"""
+    client, error_response = _identify_client()
+    if error_response: return error_response
+    store = _batch_store()
+    with store.batch_lock(batch_id):
+        batch = _owned_batch(batch_id, client)
+        if not batch: return _batch_error(f"No such Batch object: {batch_id}", "batch_not_found", 404)
+        if batch["status"] not in ACTIVE_BATCH_STATUSES:
+            return _batch_error(f"Batch 状态为 {batch['status']}，无法取消。", "batch_not_cancellable", 409)
+        cancel_event = BATCH_CANCEL_EVENTS.get(batch_id)
+        if cancel_event:
+            cancel_event.set()
+            batch.update(status="cancelling", cancelling_at=int(time.time()))
+        else:
+            batch.update(status="cancelled", cancelled_at=int(time.time()))
+        store.save_batch(batch)
+    return jsonify(_public(batch))
 
 # --- 【【【新】】】模型列表 API ---
 
@@ -516,7 +1806,7 @@ def parse_google_models_to_openai_format(google_models_json: str) -> list:
         print(f"🚨 [Model Parser] 解析整个模型列表时发生严重错误: {e}")
         return []
 
-def fetch_and_cache_models():
+def fetch_and_cache_models(deadline: float = None):
     """获取并缓存模型列表。如果缓存有效则直接返回，否则触发新的获取流程。"""
     global MODEL_LIST_CACHE
     
@@ -533,9 +1823,10 @@ def fetch_and_cache_models():
         res_submit = requests.post(f"{INTERNAL_SERVER_URL}/submit_model_fetch_job", timeout=5, proxies=LOCAL_REQUEST_PROXIES)
         res_submit.raise_for_status()
 
-        # 2. 等待油猴脚本返回数据
-        print("...[Model Fetcher] 2/3 - 等待油猴脚本返回模型数据 (最长60秒)...")
-        res_get = requests.get(f"{INTERNAL_SERVER_URL}/get_reported_models", timeout=65, proxies=LOCAL_REQUEST_PROXIES)
+        # 2. 等待油猴脚本返回数据 (不超过客户端剩余的时间)
+        wait_seconds = MODEL_FETCH_TIMEOUT_SECONDS if deadline is None else min(MODEL_FETCH_TIMEOUT_SECONDS, _remaining_seconds(deadline))
+        print(f"...[Model Fetcher] 2/3 - 等待油猴脚本返回模型数据 (最长{wait_seconds:.0f}秒)...")
+        res_get = requests.get(f"{INTERNAL_SERVER_URL}/get_reported_models", params={"timeout": wait_seconds}, timeout=wait_seconds + 5, proxies=LOCAL_REQUEST_PROXIES)
         res_get.raise_for_status()
         
         response_data = res_get.json()
@@ -550,6 +1841,7 @@ def fetch_and_cache_models():
         
         MODEL_LIST_CACHE['data'] = formatted_models
         MODEL_LIST_CACHE['timestamp'] = time.time()
+        _index_models(formatted_models)
 
         return formatted_models
 
@@ -560,12 +1852,45 @@ def fetch_and_cache_models():
         print(f"🚨 [Model Fetcher] 获取模型列表过程中发生未知错误: {e}")
         return None
 
+def _index_models(models: list):
+    if not models: return
+    index = {}
+    for model in models:
+        index[model["id"]] = model
+        index[model.get("internal_id") or f"models/{model['id']}"] = model
+    MODEL_LIST_CACHE['index'] = index
+
+def _lookup_model(model_id: str):
+    """
+    在已缓存的模型列表中查找模型。返回 (是否已知, 模型条目)。
+    本网关尚未获取过模型列表时，先尝试读取内部服务器已缓存的数据 (不触发浏览器获取)；
+    仍然没有可用列表时无法校验，视为已知。
+    """
+    if not MODEL_LIST_CACHE['index'] and time.time() - MODEL_LIST_CACHE['index_checked_at'] > 60:
+        MODEL_LIST_CACHE['index_checked_at'] = time.time()
+        try:
+            res = requests.get(f"{INTERNAL_SERVER_URL}/get_reported_models", params={"timeout": 0}, timeout=3, proxies=LOCAL_REQUEST_PROXIES)
+            if res.status_code == 200:
+                _index_models(parse_google_models_to_openai_format(res.json().get('data') or ""))
+        except (requests.exceptions.RequestException, ValueError):
+            pass
+    if not MODEL_LIST_CACHE['index']:
+        return True, None
+    model = MODEL_LIST_CACHE['index'].get(model_id)
+    return model is not None, model
+
 @app.route('/v1/models', methods=['GET'])
 def list_models():
     """实现 OpenAI 的 /v1/models 接口。"""
     print(f"\n[{time.strftime('%Y-%m-%d %H:%M:%S')}] 接收到新的 /v1/models 请求...")
-    
-    models = fetch_and_cache_models()
+    client, error_response = _identify_client()
+    if error_response: return error_response
+    rate_limited_response = _admit_client(client)
+    if rate_limited_response: return rate_limited_response
+
+    started_at = time.monotonic()
+    models = fetch_and_cache_models(_resolve_deadline(default_timeout=MODEL_FETCH_TIMEOUT_SECONDS))
+    _record_client_request(client, started_at, models is not None)
     
     if models is None:
         return jsonify({"error": "无法从内部服务器获取模型列表。"}), 500
@@ -578,8 +1903,139 @@ def list_models():
     return jsonify(response_data)
 
 
+# --- 【新】健康检查 ---
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """存活探针：进程能响应请求即可"""
+    return jsonify({"status": "ok"}), 200
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """就绪探针：内部服务器就绪且在线 worker 数达到 READY_MIN_WORKERS 时返回 200"""
+    broker_ready, broker_status = _fetch_internal_readiness()
+    workers = broker_status.get("workers", 0) if broker_ready else 0
+    ready = broker_ready and workers >= READY_MIN_WORKERS
+    return jsonify({
+        "status": "ready" if ready else "not_ready",
+        "broker": broker_status,
+        "workers": workers,
+        "min_workers": READY_MIN_WORKERS
+    }), 200 if ready else 503
+
+
+# --- 【新】诊断 API ---
+
+def _is_loopback(address: str) -> bool:
+    try:
+        return ipaddress.ip_address(address or "").is_loopback
+    except ValueError:
+        return False
+
+def _is_admin() -> bool:
+    """设置了 ADMIN_TOKEN 时需要在 X-Admin-Token 头中提供该口令；未设置时只有本机发来的请求算作管理员"""
+    if ADMIN_TOKEN:
+        return request.headers.get("X-Admin-Token") == ADMIN_TOKEN
+    return _is_loopback(request.remote_addr)
+
+def _check_admin():
+    if not _is_admin():
+        return jsonify({"error": {"message": "Invalid admin token.", "type": "invalid_request_error", "code": "invalid_admin_token"}}), 403
+    return None
+
+@app.route('/debug/traces/<trace_id>', methods=['GET'])
+def get_trace(trace_id):
+    """按 chatcmpl-id 查询请求时间线。format=chrome 时导出为 Chrome Trace Event 格式。"""
+    client, error_response = _identify_client()
+    if error_response: return error_response
+    with TRACE_LOCK:
+        trace = TRACES.get(trace_id)
+    # 只允许发起请求的客户端 (或管理员) 查看。匿名客户端共用同一个身份，只有管理员可以查看其时间线
+    is_owner = trace is not None and trace.client_id == client["id"] and client["id"] != "anonymous"
+    if not trace or not (is_owner or _is_admin()):
+        return jsonify({"error": {"message": f"Trace '{trace_id}' not found.", "type": "invalid_request_error", "code": "trace_not_found"}}), 404
+    if request.args.get("format") == "chrome":
+        return jsonify(trace.to_chrome_trace())
+    return jsonify(trace.to_dict())
+
+@app.route('/debug/profile', methods=['GET', 'POST'])
+def debug_profile():
+    """同时在网关和内部服务器上开启采样分析器 seconds 秒，返回合并后的调用栈 (format=folded 时返回折叠栈文本)"""
+    admin_error = _check_admin()
+    if admin_error: return admin_error
+    seconds = min(request.args.get("seconds", 5, type=float), MAX_PROFILE_SECONDS)
+    interval = request.args.get("interval", DEFAULT_INTERVAL_SECONDS, type=float)
+
+    broker_result = {}
+    # start_all.py 在同一进程中运行两个服务器，此时网关的采样已经包含内部服务器的线程
+    _, broker_status = _fetch_internal_readiness()
+    shared_process = broker_status.get("pid") == os.getpid()
+    def profile_broker():
+        if shared_process: return
+        try:
+            res = requests.get(f"{INTERNAL_SERVER_URL}/debug/profile", params={"seconds": seconds, "interval": interval},
+                               headers={"X-Admin-Token": ADMIN_TOKEN} if ADMIN_TOKEN else None, timeout=seconds + 10, proxies=LOCAL_REQUEST_PROXIES)
+            res.raise_for_status()
+            broker_result.update(res.json())
+        except (requests.exceptions.RequestException, ValueError) as e:
+            broker_result["error"] = str(e)
+    broker_thread = threading.Thread(target=profile_broker, daemon=True)
+    broker_thread.start()
+    try:
+        gateway_result = sample_stacks(seconds, interval)
+    except ProfilerBusy:
+        broker_thread.join()
+        return jsonify({"error": {"message": "A profiling session is already running.", "type": "conflict", "code": "profiler_busy"}}), 409
+    broker_thread.join()
+
+    # 以服务器名称作为栈的根节点，合并两边的结果
+    stacks = {f"gateway;{stack}": count for stack, count in gateway_result["stacks"].items()}
+    stacks.update({f"broker;{stack}": count for stack, count in broker_result.get("stacks", {}).items()})
+    if request.args.get("format") == "folded":
+        return format_folded(stacks), 200, {"Content-Type": "text/plain; charset=utf-8"}
+    return jsonify({
+        "seconds": seconds,
+        "interval": interval,
+        "samples": {"gateway": gateway_result["samples"], "broker": broker_result.get("samples", 0)},
+        "broker_error": broker_result.get("error"),
+        "shared_process": shared_process,
+        "stacks": stacks
+    })
+
+
+# --- 【新】客户端统计 API ---
+
+@app.route('/metrics/clients', methods=['GET'])
+def client_metrics():
+    """返回每个客户端的请求数、限流次数、耗时分位数和吞吐量。管理员可以看到所有客户端，其他调用方只能看到自己。"""
+    client, error_response = _identify_client()
+    if error_response: return error_response
+    is_admin = _is_admin()
+    now = time.monotonic()
+    report = {}
+    with CLIENT_LOCK:
+        for client_id, metrics in CLIENT_METRICS.items():
+            if not is_admin and client_id != client["id"]:
+                continue
+            latencies = sorted(metrics["latencies"])
+            percentile = lambda p: round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 3) if latencies else None
+            finished_in_window = sum(1 for t in metrics["finished_at"] if now - t <= CLIENT_METRICS_WINDOW_SECONDS)
+            bucket = CLIENT_BUCKETS.get(client_id)
+            report[client_id] = {
+                "requests": metrics["requests"],
+                "rate_limited": metrics["rate_limited"],
+                "completed": metrics["completed"],
+                "failed": metrics["failed"],
+                "latency_seconds": {"p50": percentile(0.5), "p90": percentile(0.9), "p99": percentile(0.99)},
+                "throughput_per_minute": round(finished_in_window * 60 / CLIENT_METRICS_WINDOW_SECONDS, 3),
+                "available_tokens": round(bucket.tokens, 2) if bucket else None
+            }
+    return jsonify({"object": "list", "window_seconds": CLIENT_METRICS_WINDOW_SECONDS, "data": report})
+
+
 if __name__ == "__main__":
     if not check_internal_server(): sys.exit(1)
+    resume_batches()
     print("="*60); print("  OpenAI 兼容 API 网关 v6.0 (Model Fetcher Ready)"); print("="*60)
     print("  ✨ 新功能: 支持通过 /v1/models 动态获取模型列表。")
     print("  ✨ 新功能: 支持通过 'role: tool' 消息返回函数执行结果。")
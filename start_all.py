@@ -4,6 +4,39 @@ import threading
 import time
 import sys
 import os
+import urllib.error
+import urllib.request
+
+# 【新】不再固定等待，而是轮询内部服务器的就绪探针 (/readyz) 和网关的存活探针 (/healthz)。
+# 网关的 /readyz 还要求 READY_MIN_WORKERS 个浏览器在线，留给负载均衡器使用，启动时不等待浏览器连接。
+LOCAL_SERVER_READY_URL = "http://127.0.0.1:5101/readyz"
+OPENAI_SERVER_READY_URL = "http://127.0.0.1:5100/healthz"
+STARTUP_TIMEOUT_SECONDS = float(os.environ.get("STARTUP_TIMEOUT_SECONDS", "30"))
+# 本地探针不走系统代理
+LOCAL_OPENER = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+def wait_until_ready(name: str, url: str, thread: threading.Thread, timeout: float = STARTUP_TIMEOUT_SECONDS) -> bool:
+    """以指数退避轮询就绪探针。服务器线程提前退出或超时都视为启动失败。"""
+    started_at = time.monotonic()
+    delay = 0.02
+    last_status = "尚未响应"
+    while True:
+        try:
+            with LOCAL_OPENER.open(url, timeout=2) as response:
+                print(f"✅ {name}已就绪 (等待 {time.monotonic() - started_at:.2f} 秒): {response.read().decode('utf-8')}")
+                return True
+        except urllib.error.HTTPError as e:
+            last_status = f"HTTP {e.code}: {e.read().decode('utf-8', 'replace')}"
+        except (urllib.error.URLError, OSError) as e:
+            last_status = str(e)
+        if not thread.is_alive():
+            print(f"❌ {name}线程已退出，启动失败。最后一次检查结果: {last_status}")
+            return False
+        if time.monotonic() - started_at + delay > timeout:
+            print(f"❌ {name}在 {timeout:.0f} 秒内未就绪。最后一次检查结果: {last_status}")
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
 
 def run_local_history_server():
     """启动本地历史服务器"""
@@ -13,7 +46,8 @@ def run_local_history_server():
     sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
     
     try:
-        from local_history_server import app as local_app
+        from local_history_server import app as local_app, start_backend
+        start_backend()
         print("======================================================================")
         print("  历史编辑代理服务器 v6.0 (Model Fetcher Ready)")
         print("  - /submit_injection_job, /get_injection_job (用于初始注入)")
@@ -35,26 +69,20 @@ def run_openai_server():
     sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
     
     try:
-        from openai_compatible_server import app as openai_app, check_internal_server, PUBLIC_PORT
-        
-        # 等待本地历史服务器启动
-        print("等待本地历史服务器启动...")
-        time.sleep(3)
-        
-        if not check_internal_server():
-            print("❌ 无法连接到内部服务器，OpenAI服务器启动失败")
-            sys.exit(1)
-            
+        from openai_compatible_server import app as openai_app, PUBLIC_PORT, resume_batches
+
+        # 网关本身不依赖内部服务器即可开始监听，由 main() 通过就绪探针确认两者都已可用
         print("="*60)
         print("  OpenAI 兼容 API 网关 v6.0 (Model Fetcher Ready)")
         print("="*60)
         print("  ✨ 新功能: 支持通过 /v1/models 动态获取模型列表。")
         print("  ✨ 新功能: 支持通过 'role: tool' 消息返回函数执行结果。")
         print("\n  运行指南:")
-        print("  1. ✅ `local_history_server.py` 已成功连接。")
+        print("  1. ✅ `local_history_server.py` 就绪后 /readyz 将返回 200。")
         print("  2. ✅ 确保浏览器和油猴脚本已就绪。")
         print(f"  3. 🚀 本 API 服务器正在 http://127.0.0.1:{PUBLIC_PORT} 上运行。")
         print("="*60)
+        resume_batches() # 批处理执行线程会自行等待内部服务器就绪
         openai_app.run(host='0.0.0.0', port=PUBLIC_PORT, threaded=True)
     except Exception as e:
         print(f"❌ OpenAI兼容服务器启动失败: {e}")
@@ -69,17 +97,17 @@ def main():
     openai_thread = threading.Thread(target=run_openai_server, daemon=True)
     
     try:
-        # 启动本地历史服务器线程
+        # 两个服务器同时启动，网关在内部服务器就绪之前就可以开始监听
         local_thread.start()
         print("✅ 本地历史服务器线程已启动")
-        
-        # 稍等片刻再启动OpenAI服务器
-        time.sleep(2)
-        
-        # 启动OpenAI兼容服务器线程
         openai_thread.start()
         print("✅ OpenAI兼容服务器线程已启动")
-        
+
+        if not wait_until_ready("本地历史服务器", LOCAL_SERVER_READY_URL, local_thread):
+            sys.exit(1)
+        if not wait_until_ready("OpenAI兼容服务器", OPENAI_SERVER_READY_URL, openai_thread):
+            sys.exit(1)
+
         print("\n🎉 所有服务器已启动！")
         print("按 Ctrl+C 停止所有服务")
         
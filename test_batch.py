@@ -0,0 +1,137 @@
+# test_batch.py - 离线批处理 (/v1/files + /v1/batches)
+
+import io
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import openai_compatible_server as gateway
+from batch_store import BatchStore
+
+
+@pytest.fixture
+def client(broker, tmp_path, monkeypatch):
+    monkeypatch.setattr(gateway, "BATCH_STORE", BatchStore(str(tmp_path)))
+    return gateway.app.test_client()
+
+
+def _request(custom_id, content="hi", model=None):
+    body = {"messages": [{"role": "user", "content": content}]}
+    if model: body["model"] = model
+    return {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}
+
+
+def _upload(client, lines, purpose="batch"):
+    content = "\n".join(line if isinstance(line, str) else json.dumps(line) for line in lines).encode()
+    return client.post("/v1/files", data={"purpose": purpose, "file": (io.BytesIO(content), "input.jsonl")}, content_type="multipart/form-data")
+
+
+def _wait_for_batch(client, batch_id, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        batch = client.get(f"/v1/batches/{batch_id}").json
+        if batch["status"] in ("completed", "failed", "cancelled"):
+            return batch
+        time.sleep(0.1)
+    raise AssertionError(f"批处理 {batch_id} 未在 {timeout} 秒内结束")
+
+
+def _content_lines(client, file_id):
+    return [json.loads(line) for line in client.get(f"/v1/files/{file_id}/content").get_data(as_text=True).splitlines()]
+
+
+def test_validate_batch_line():
+    assert gateway._validate_batch_line(_request("a")) is None
+    assert gateway._validate_batch_line(None)
+    assert gateway._validate_batch_line({**_request("a"), "custom_id": None})
+    assert gateway._validate_batch_line({**_request("a"), "url": "/v1/embeddings"})
+    assert gateway._validate_batch_line({**_request("a"), "method": "GET"})
+    assert gateway._validate_batch_line({**_request("a"), "body": {"messages": []}})
+
+
+def test_requests_are_grouped_by_model_in_file_order():
+    records = [_request("1", model="b"), _request("2", model="a"), _request("3", model="b"), _request("4")]
+    assert [record["custom_id"] for record in gateway._sort_batch_requests(records)] == ["4", "2", "1", "3"]
+
+
+def test_upload_requires_batch_purpose(client):
+    assert _upload(client, [_request("a")], purpose="fine-tune").status_code == 400
+    file_obj = _upload(client, [_request("a")]).json
+    assert file_obj["purpose"] == "batch" and "owner" not in file_obj
+    assert client.get(f"/v1/files/{file_obj['id']}").json["id"] == file_obj["id"]
+    # 文件只对上传者可见
+    assert client.get(f"/v1/files/{file_obj['id']}", headers={"Authorization": "Bearer sk-other"}).status_code == 404
+
+
+def test_oversized_uploads_are_rejected(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(gateway, "BATCH_MAX_FILE_BYTES", 300)
+    response = _upload(client, [_request(f"req-{i}") for i in range(10)])
+    assert response.status_code == 413
+    assert response.json["error"]["code"] == "file_too_large"
+    # 已写入的部分被删除
+    assert os.listdir(tmp_path / "files") == []
+    assert _upload(client, [_request("a")]).status_code == 200
+
+
+def test_concurrent_batch_saves_do_not_collide(tmp_path):
+    store = BatchStore(str(tmp_path))
+    batch = store.create_batch({"status": "in_progress", "owner": "alice"})
+    errors = []
+
+    def save(n):
+        try:
+            for i in range(200):
+                store.save_batch({**batch, "writer": n, "i": i})
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=save, args=(n,)) for n in range(4)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert errors == []
+    assert store.get_batch(batch["id"])["i"] == 199
+    assert os.listdir(tmp_path / "batches") == [f"{batch['id']}.json"]
+
+
+def test_invalid_lines_fail_the_batch(client):
+    file_id = _upload(client, [_request("a"), "{not json", _request("a"), {**_request("c"), "url": "/v1/embeddings"}]).json["id"]
+    batch = client.post("/v1/batches", json={"input_file_id": file_id}).json
+    assert batch["status"] == "failed"
+    assert [error["line"] for error in batch["errors"]["data"]] == [2, 3, 4]
+    assert batch["request_counts"]["total"] == 4
+
+    assert client.post("/v1/batches", json={"input_file_id": "file-missing"}).status_code == 404
+    assert client.post("/v1/batches", json={"input_file_id": file_id, "endpoint": "/v1/embeddings"}).status_code == 400
+
+
+def test_batch_runs_to_completion(client, workers):
+    workers("w1")
+    workers("w2")
+    file_id = _upload(client, [_request(f"req-{i}", f"q{i}") for i in range(4)]).json["id"]
+    batch = client.post("/v1/batches", json={"input_file_id": file_id}).json
+    assert batch["status"] == "in_progress"
+
+    batch = _wait_for_batch(client, batch["id"])
+    assert batch["status"] == "completed"
+    assert batch["request_counts"] == {"total": 4, "completed": 4, "failed": 0}
+    results = _content_lines(client, batch["output_file_id"])
+    assert sorted(line["custom_id"] for line in results) == [f"req-{i}" for i in range(4)]
+    assert all(line["response"]["status_code"] == 200 and line["error"] is None for line in results)
+    assert results[0]["response"]["body"]["choices"][0]["message"]["content"] == "Hello world"
+    assert _content_lines(client, batch["error_file_id"]) == []
+    assert [item["id"] for item in client.get("/v1/batches").json["data"]] == [batch["id"]]
+
+
+def test_cancelled_batch_stops_taking_requests(client, workers):
+    workers("w1", delay=0.3)
+    file_id = _upload(client, [_request(f"req-{i}") for i in range(5)]).json["id"]
+    batch = client.post("/v1/batches", json={"input_file_id": file_id}).json
+    assert client.post(f"/v1/batches/{batch['id']}/cancel").json["status"] == "cancelling"
+
+    batch = _wait_for_batch(client, batch["id"])
+    assert batch["status"] == "cancelled"
+    assert batch["request_counts"]["completed"] < 5
+    assert client.post(f"/v1/batches/{batch['id']}/cancel").status_code == 409
@@ -0,0 +1,116 @@
+# test_blob_store.py - 大负载的内容寻址存储
+
+import gzip
+import hashlib
+import io
+import os
+import time
+
+import pytest
+
+import blob_store
+import openai_compatible_server as gateway
+from blob_store import BlobError, BlobStore, digest_text, gzip_chunks, is_blob_reference
+
+
+def _gzip(text: str) -> bytes:
+    return b"".join(gzip_chunks(text))
+
+
+def test_digest_and_gzip_match_the_content():
+    text = "héllo " * 1000
+    digest, size = digest_text(text)
+    assert digest == hashlib.sha256(text.encode()).hexdigest() and size == len(text.encode())
+    assert gzip.decompress(_gzip(text)).decode() == text
+    # 跨越分块边界时结果一致
+    long_text = "ab" * (blob_store.BLOB_CHUNK_BYTES // 2 + 7)
+    assert digest_text(long_text)[0] == hashlib.sha256(long_text.encode()).hexdigest()
+
+
+def test_put_stream_verifies_the_digest(tmp_path):
+    store = BlobStore(str(tmp_path))
+    text = "payload " * 500
+    digest, _ = digest_text(text)
+    data = _gzip(text)
+    assert store.put_stream(digest, io.BytesIO(data)) == len(data)
+    assert store.stat(digest) == len(data)
+    with open(store.path(digest), "rb") as f:
+        assert gzip.decompress(f.read()).decode() == text
+
+    other = hashlib.sha256(b"other").hexdigest()
+    with pytest.raises(BlobError):
+        store.put_stream(other, io.BytesIO(data))
+    assert store.stat(other) is None
+    # 校验失败时不留下临时文件
+    assert os.listdir(os.path.dirname(store.path(other))) == []
+
+
+def test_put_stream_rejects_bad_input(tmp_path, monkeypatch):
+    store = BlobStore(str(tmp_path))
+    digest, _ = digest_text("x" * 4096)
+    with pytest.raises(BlobError):
+        store.path("../../etc/passwd")
+    with pytest.raises(BlobError):
+        store.put_stream(digest, io.BytesIO(b"not gzip"))
+    with pytest.raises(BlobError):
+        store.put_stream(digest, io.BytesIO(_gzip("x" * 4096)[:-8]))
+    monkeypatch.setattr(blob_store, "MAX_BLOB_BYTES", 1024)
+    with pytest.raises(BlobError):
+        store.put_stream(digest, io.BytesIO(_gzip("x" * 4096)))
+    assert store.stat(digest) is None
+
+
+def test_cleanup_removes_stale_blobs(tmp_path):
+    store = BlobStore(str(tmp_path))
+    old, _ = digest_text("old")
+    new, _ = digest_text("new")
+    store.put_stream(old, io.BytesIO(_gzip("old")))
+    store.put_stream(new, io.BytesIO(_gzip("new")))
+    stale = time.time() - 3600
+    os.utime(store.path(old), (stale, stale))
+    assert store.cleanup(ttl=60) == 1
+    assert store.stat(old) is None and store.stat(new) is not None
+
+
+def test_broker_blob_endpoints(broker):
+    client = broker.app.test_client()
+    text = "broker " * 2000
+    digest, _ = digest_text(text)
+    data = _gzip(text)
+
+    assert client.put(f"/blobs/{hashlib.sha256(b'x').hexdigest()}", data=data).status_code == 400
+    assert client.get("/blobs/not-a-digest").status_code == 400
+    assert client.get(f"/blobs/{digest}").status_code == 404
+    assert client.put(f"/blobs/{digest}", data=data).status_code == 201
+    assert client.put(f"/blobs/{digest}", data=data).json["deduplicated"]
+
+    assert client.get(f"/blobs/{digest}").data == data
+    partial = client.get(f"/blobs/{digest}", headers={"Range": "bytes=0-9"})
+    assert partial.status_code == 206 and partial.data == data[:10]
+
+
+def test_gateway_externalizes_large_text(broker, monkeypatch):
+    monkeypatch.setattr(gateway, "BLOB_THRESHOLD_BYTES", 1024)
+    assert gateway._externalize_text("short") == "short"
+    assert gateway._externalize_text(None) is None
+
+    text = "large " * 1000
+    reference = gateway._externalize_text(text)
+    assert is_blob_reference(reference)
+    assert reference["$blob"] == digest_text(text)[0] and reference["bytes"] == len(text)
+    with open(broker.BLOBS.path(reference["$blob"]), "rb") as f:
+        assert gzip.decompress(f.read()).decode() == text
+    # 已存在的内容不再上传
+    assert gateway._externalize_text(text) == reference
+
+    messages = [{"role": "user", "content": "hi"}, {"role": "tool", "content": text}]
+    externalized = gateway._externalize_messages(messages)
+    assert externalized[0] is messages[0] and externalized[1]["content"] == reference
+    assert messages[1]["content"] == text
+
+
+def test_gateway_falls_back_to_inline_when_the_upload_fails(monkeypatch):
+    monkeypatch.setattr(gateway, "BLOB_THRESHOLD_BYTES", 1024)
+    monkeypatch.setattr(gateway, "INTERNAL_SERVER_URL", "http://127.0.0.1:9")
+    text = "inline " * 1000
+    assert gateway._externalize_text(text) == text
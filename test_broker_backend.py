@@ -0,0 +1,164 @@
+# test_broker_backend.py - 可插拔存储后端、worker 亲和性与共享的会话状态
+
+import json
+import time
+
+import pytest
+
+import broker_backend
+import openai_compatible_server as gateway
+from broker_backend import (BrokerBackend, MemoryBrokerBackend, SQLiteBrokerBackend, conversation_signature,
+                            conversation_summary, job_is_eligible)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return MemoryBrokerBackend()
+    return SQLiteBrokerBackend(str(tmp_path / "broker.sqlite3"))
+
+
+def test_backend_interface_is_abstract():
+    with pytest.raises(TypeError):
+        BrokerBackend()
+
+
+def test_jobs_tasks_and_chunks(backend):
+    backend.create_task("t1", kind="prompt")
+    backend.put_job("prompt", {"task_id": "t1", "client_id": "a"})
+    assert backend.queue_size("prompt") == 1
+    assert backend.take_job("prompt", "w1")["task_id"] == "t1"
+    assert backend.take_job("prompt", "w1") is None
+
+    assert backend.append_chunk("t1", "a") == 1
+    assert backend.append_chunk("t1", "b") == 2
+    assert backend.read_chunks("t1", 1) == ["b"]
+    assert backend.update_task("t1", status="completed")
+    task = backend.get_task("t1")
+    assert task["status"] == "completed" and task["chunk_count"] == 2 and task["kind"] == "prompt"
+    assert not backend.update_task("missing", status="completed")
+
+
+def test_chunks_for_unknown_tasks_are_rejected(backend):
+    with pytest.raises(KeyError):
+        backend.append_chunk("missing", "a")
+    assert backend.read_chunks("missing", 0) == []
+
+
+def test_failed_sqlite_transaction_is_rolled_back(tmp_path):
+    path = str(tmp_path / "broker.sqlite3")
+    backend = SQLiteBrokerBackend(path)
+    with pytest.raises(TypeError):
+        backend.touch_worker("w1", info=object()) # 无法序列化
+    assert not backend._conn().in_transaction
+
+    # 其他进程 (连接) 仍然可以写入
+    other = SQLiteBrokerBackend(path)
+    other.touch_worker("w2")
+    assert list(backend.list_workers()) == ["w2"]
+
+
+def test_sqlite_adds_the_task_id_column_to_old_databases(tmp_path):
+    import sqlite3
+    path = str(tmp_path / "old.sqlite3")
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, queue TEXT NOT NULL, client_id TEXT NOT NULL, payload TEXT NOT NULL)")
+        conn.execute("INSERT INTO jobs (queue, client_id, payload) VALUES ('prompt', 'a', ?)", (json.dumps({"task_id": "old"}),))
+    backend = SQLiteBrokerBackend(path)
+    backend.create_task("old")
+    backend.update_task("old", status="cancelled")
+    assert backend.take_job("prompt", "w1") is None
+    assert backend.queue_size("prompt") == 0
+
+
+def test_cancelled_jobs_are_skipped(backend):
+    backend.create_task("t1")
+    backend.put_job("prompt", {"task_id": "t1"})
+    backend.update_task("t1", status="cancelled")
+    assert backend.take_job("prompt", "w1") is None
+
+
+def test_worker_affinity_and_failover(backend, monkeypatch):
+    backend.touch_worker("w1")
+    backend.touch_worker("w2")
+    backend.put_job("prompt", {"task_id": "soft", "worker_id": "w1"})
+    backend.put_job("prompt", {"task_id": "strict", "worker_id": "w1", "strict_affinity": True})
+    assert backend.take_job("prompt", "w2") is None
+    assert backend.take_job("prompt", "w1")["task_id"] == "soft"
+
+    # w1 离线后，非强制绑定的任务可由其他 worker 接管，强制绑定的不行
+    backend.put_job("prompt", {"task_id": "soft2", "worker_id": "w1"})
+    monkeypatch.setattr(broker_backend, "WORKER_TIMEOUT_SECONDS", 0.05)
+    time.sleep(0.1)
+    backend.touch_worker("w2")
+    assert backend.take_job("prompt", "w2")["task_id"] == "soft2"
+    assert backend.take_job("prompt", "w2") is None
+    assert backend.take_job("prompt", "w1")["task_id"] == "strict"
+
+
+def test_sessions(backend):
+    backend.set_session("conversation:w1", {"model": "m"})
+    backend.set_session("other", 1)
+    assert backend.get_session("conversation:w1") == {"model": "m"}
+    assert set(backend.list_sessions("conversation:")) == {"conversation:w1"}
+    backend.delete_session("conversation:w1")
+    assert backend.get_session("conversation:w1") is None
+
+
+def test_sqlite_backend_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / "shared.sqlite3")
+    first, second = SQLiteBrokerBackend(path), SQLiteBrokerBackend(path)
+    first.create_task("t1")
+    first.put_job("prompt", {"task_id": "t1"})
+    assert second.take_job("prompt", "w1")["task_id"] == "t1"
+    second.append_chunk("t1", "hello")
+    assert first.read_chunks("t1", 0) == ["hello"]
+
+
+def test_job_is_eligible_without_preference():
+    live = {"w1": {"last_seen": time.time()}}
+    assert job_is_eligible({}, "w1", live)
+    assert job_is_eligible({"worker_id": "w1"}, "w1", live)
+    assert not job_is_eligible({"worker_id": "w1"}, "w2", live)
+
+
+def test_conversation_signature_covers_tail_model_and_tools():
+    messages = [{"role": "user", "content": str(i)} for i in range(8)]
+    signature = conversation_signature(messages, "m")
+    assert signature == conversation_signature(messages[-5:], "m")
+    assert signature != conversation_signature(messages, "other")
+    assert signature != conversation_signature(messages, "m", [{"type": "function"}])
+    assert signature != conversation_signature(messages[:-1], "m")
+    assert conversation_summary(messages, "m") == {"model": "m", "signature": signature, "message_count": 8}
+
+
+def test_broker_serves_signatures_not_histories(broker):
+    client = broker.app.test_client()
+    broker.BACKEND.touch_worker("w1")
+    broker.BACKEND.touch_worker("w2")
+    history = [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}]
+    # 旧版网关上传的完整状态会被转换为摘要
+    client.put("/conversation_state/w1", json={"model": "m", "messages": history})
+    client.put("/conversation_state/w2", json=conversation_summary([], "m"))
+
+    states = client.get("/conversation_states").json["states"]
+    assert "messages" not in json.dumps(states)
+    assert states["w1"]["message_count"] == 2
+    signature = conversation_signature(history, "m")
+    assert list(client.get(f"/conversation_states?signature={signature}").json["states"]) == ["w1"]
+
+
+def test_follow_up_turn_uses_the_fast_path_on_the_same_worker(broker, workers):
+    worker = workers("w1")
+    client = gateway.app.test_client()
+    first = [{"role": "user", "content": "hi"}]
+    res = client.post("/v1/chat/completions", json={"messages": first})
+    assert res.json["choices"][0]["message"]["content"] == "Hello world"
+
+    follow_up = first + [{"role": "assistant", "content": "Hello world"}, {"role": "user", "content": "again"}]
+    res = client.post("/v1/chat/completions", headers={"X-Debug-Timeline": "1"}, json={"messages": follow_up})
+    assert res.status_code == 200
+    events = json.loads(res.headers["X-Request-Timeline"])
+    submitted = next(event for event in events if event["name"] == "prompt_submitted")
+    assert submitted["attrs"] == {"path": "fast", "worker_id": "w1"}
+    assert len(worker.taken) == 2
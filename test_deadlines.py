@@ -0,0 +1,69 @@
+# test_deadlines.py - 截止时间的解析与传递
+
+import time
+
+import pytest
+
+import openai_compatible_server as gateway
+
+
+def _deadline(headers=None, body=None):
+    with gateway.app.test_request_context("/", headers=headers or {}):
+        return gateway._resolve_deadline(body) - time.time()
+
+
+def test_default_deadline():
+    assert _deadline() == pytest.approx(gateway.DEFAULT_REQUEST_TIMEOUT_SECONDS, abs=1)
+
+
+def test_timeout_header_and_body():
+    assert _deadline({"X-Request-Timeout": "12"}) == pytest.approx(12, abs=1)
+    assert _deadline(body={"timeout": 7}) == pytest.approx(7, abs=1)
+    # 请求头优先于请求体
+    assert _deadline({"X-Request-Timeout": "3"}, {"timeout": 50}) == pytest.approx(3, abs=1)
+
+
+def test_absolute_deadline_header():
+    assert _deadline({"X-Request-Deadline": str(time.time() + 20)}) == pytest.approx(20, abs=1)
+
+
+def test_deadline_is_capped_and_invalid_values_fall_back():
+    assert _deadline({"X-Request-Timeout": "100000"}) == pytest.approx(gateway.MAX_REQUEST_TIMEOUT_SECONDS, abs=1)
+    assert _deadline({"X-Request-Timeout": "soon"}) == pytest.approx(gateway.DEFAULT_REQUEST_TIMEOUT_SECONDS, abs=1)
+
+
+@pytest.mark.parametrize("value", ["nan", "inf", "-inf", "Infinity"])
+def test_non_finite_values_fall_back_to_the_default(value):
+    default = pytest.approx(gateway.DEFAULT_REQUEST_TIMEOUT_SECONDS, abs=1)
+    assert _deadline({"X-Request-Deadline": value}) == default
+    assert _deadline({"X-Request-Timeout": value}) == default
+    assert _deadline(body={"timeout": float(value)}) == default
+
+
+def test_resolve_deadline_without_request_context():
+    # 批处理在后台线程中执行，只能从请求体读取
+    assert gateway._resolve_deadline({"timeout": 5}) - time.time() == pytest.approx(5, abs=1)
+
+
+def test_broker_expires_jobs_past_their_deadline(broker):
+    client = broker.app.test_client()
+    task_id = client.post("/submit_injection_job", json={"messages": [], "deadline": time.time() - 1}).json["task_id"]
+    assert client.get("/get_injection_job?worker_id=w1").json["status"] == "empty"
+    assert client.get(f"/task/{task_id}").json["task"]["status"] == "expired"
+
+
+def test_request_fails_fast_when_no_worker_picks_up_the_injection(broker):
+    started = time.monotonic()
+    res = gateway.app.test_client().post("/v1/chat/completions", headers={"X-Request-Timeout": "1"},
+                                         json={"messages": [{"role": "user", "content": "hi"}]})
+    assert res.status_code == 500
+    assert time.monotonic() - started < 5
+
+
+def test_slow_generation_is_truncated_at_the_deadline(broker, workers):
+    workers("w1", chunks=('[[null,"partial "]]', '[[null,"never"]]'), delay=3)
+    res = gateway.app.test_client().post("/v1/chat/completions", headers={"X-Request-Timeout": "2.5"},
+                                         json={"messages": [{"role": "user", "content": "hi"}]})
+    choice = res.json["choices"][0]
+    assert choice["finish_reason"] == "length"
+    assert choice["message"]["content"] == "partial "
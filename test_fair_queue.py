@@ -0,0 +1,154 @@
+# test_fair_queue.py - 按客户端公平调度 (DRR) 与令牌桶限流
+
+import json
+import time
+from queue import Empty
+
+import pytest
+
+import openai_compatible_server as gateway
+from fair_queue import FairQueue
+
+
+def _drain(queue, accept=None):
+    jobs = []
+    while True:
+        try:
+            jobs.append(queue.get_nowait(accept))
+        except Empty:
+            return jobs
+
+
+def test_round_robin_between_clients():
+    queue = FairQueue()
+    for i in range(4):
+        queue.put({"client_id": "batch", "n": i})
+    queue.put({"client_id": "interactive", "n": 0})
+    order = [job["client_id"] for job in _drain(queue)]
+    # 批量客户端先入队 4 个任务，交互客户端的任务仍在第二个被取出
+    assert order[:2] == ["batch", "interactive"]
+    assert queue.empty()
+
+
+def test_weights_share_the_queue_proportionally():
+    queue = FairQueue()
+    for i in range(30):
+        queue.put({"client_id": "heavy", "client_weight": 2.0, "n": i})
+        queue.put({"client_id": "light", "client_weight": 1.0, "n": i})
+    first = [job["client_id"] for job in _drain(queue)][:30]
+    assert first.count("heavy") == 20
+    assert first.count("light") == 10
+
+
+def test_jobs_keep_fifo_order_within_a_client():
+    queue = FairQueue()
+    for i in range(5):
+        queue.put({"client_id": "a", "n": i})
+    assert [job["n"] for job in _drain(queue)] == list(range(5))
+
+
+def test_accept_filter_leaves_other_jobs_queued():
+    queue = FairQueue()
+    queue.put({"client_id": "a", "worker_id": "w1"})
+    queue.put({"client_id": "b", "worker_id": "w2"})
+    job = queue.get_nowait(lambda job: job["worker_id"] == "w2")
+    assert job["client_id"] == "b"
+    with pytest.raises(Empty):
+        queue.get_nowait(lambda job: job["worker_id"] == "w2")
+    assert queue.qsize() == 1
+
+
+def test_expired_jobs_are_dropped_and_reported():
+    expired = []
+    queue = FairQueue(on_expired=expired.append)
+    queue.put({"client_id": "a", "task_id": "old", "deadline": time.time() - 1})
+    queue.put({"client_id": "a", "task_id": "new", "deadline": time.time() + 60})
+    assert queue.get_nowait()["task_id"] == "new"
+    assert [job["task_id"] for job in expired] == ["old"]
+
+
+def test_stats_and_jobs_snapshot():
+    queue = FairQueue()
+    queue.put({"client_id": "a", "n": 1})
+    queue.put({"client_id": "a", "n": 2})
+    queue.put({"client_id": "b", "n": 3, "client_weight": 3})
+    assert queue.stats()["a"]["queued"] == 2
+    assert queue.stats()["b"]["weight"] == 3.0
+    assert [job["n"] for job in queue.jobs()] == [1, 2, 3]
+
+
+def test_drained_clients_are_forgotten():
+    queue = FairQueue()
+    queue.put({"client_id": "a", "client_weight": 2})
+    queue.get_nowait()
+    assert queue._queues == {} and queue._deficits == {} and queue._weights == {}
+
+
+def test_token_bucket_refills_over_time():
+    bucket = gateway.TokenBucket(rate=100, burst=2)
+    assert bucket.try_acquire()[0]
+    assert bucket.try_acquire()[0]
+    allowed, wait_seconds = bucket.try_acquire()
+    assert not allowed and 0 < wait_seconds <= 0.01
+    time.sleep(0.02)
+    assert bucket.try_acquire()[0]
+
+
+def test_rate_limiting_is_off_by_default(monkeypatch):
+    monkeypatch.setattr(gateway, "CLIENT_BUCKETS", {})
+    with gateway.app.test_request_context("/"):
+        client, error = gateway._identify_client()
+        assert error is None and client["id"] == "anonymous" and client["rate"] == 0
+        assert all(gateway._admit_client(client) is None for _ in range(50))
+
+
+def test_configured_rate_limit_returns_429(monkeypatch):
+    monkeypatch.setattr(gateway, "CLIENT_BUCKETS", {})
+    monkeypatch.setitem(gateway.DEFAULT_CLIENT_LIMITS, "rate", 0.01)
+    monkeypatch.setitem(gateway.DEFAULT_CLIENT_LIMITS, "burst", 2)
+    with gateway.app.test_request_context("/", headers={"Authorization": "Bearer sk-test"}):
+        client, _ = gateway._identify_client()
+        assert client["id"].startswith("key-")
+        assert gateway._admit_client(client) is None
+        assert gateway._admit_client(client) is None
+        response, status = gateway._admit_client(client)
+        assert status == 429 and int(response.headers["Retry-After"]) >= 1
+
+
+def test_unknown_api_key_is_rejected_when_keys_are_configured(monkeypatch):
+    monkeypatch.setattr(gateway, "API_KEYS", {"sk-team": {"name": "team", "rate": 1.0, "burst": 3, "weight": 2.0}})
+    with gateway.app.test_request_context("/", headers={"Authorization": "Bearer sk-other"}):
+        client, (_, status) = gateway._identify_client()
+        assert client is None and status == 401
+    with gateway.app.test_request_context("/", headers={"x-api-key": "sk-team"}):
+        client, error = gateway._identify_client()
+        assert error is None and client == {"id": "team", "rate": 1.0, "burst": 3, "weight": 2.0}
+
+
+def test_api_keys_are_loaded_from_the_environment(tmp_path, monkeypatch):
+    keys = {"sk-team": {"name": "team", "weight": 2.0}}
+    monkeypatch.delenv("API_KEYS_FILE", raising=False)
+    monkeypatch.setenv("API_KEYS", json.dumps(keys))
+    assert gateway._load_api_keys() == keys
+    path = tmp_path / "keys.json"
+    path.write_text(json.dumps({"sk-file": {"name": "file"}}))
+    monkeypatch.setenv("API_KEYS_FILE", str(path))
+    assert gateway._load_api_keys() == {"sk-file": {"name": "file"}}
+    monkeypatch.delenv("API_KEYS_FILE")
+    monkeypatch.setenv("API_KEYS", '["sk-team"]')
+    with pytest.raises(ValueError):
+        gateway._load_api_keys()
+
+
+def test_client_metrics_are_scoped_to_the_caller(monkeypatch):
+    monkeypatch.setattr(gateway, "CLIENT_METRICS", {})
+    monkeypatch.setattr(gateway, "ADMIN_TOKEN", "secret")
+    monkeypatch.setattr(gateway, "API_KEYS", {"sk-a": {"name": "team-a"}, "sk-b": {"name": "team-b"}})
+    for name in ("team-a", "team-b"):
+        gateway._admit_client({"id": name, "rate": 0, "burst": 0, "weight": 1.0})
+    client = gateway.app.test_client()
+    own = client.get("/metrics/clients", headers={"Authorization": "Bearer sk-a"}).json["data"]
+    assert list(own) == ["team-a"]
+    admin = client.get("/metrics/clients", headers={"Authorization": "Bearer sk-a", "X-Admin-Token": "secret"}).json["data"]
+    assert sorted(admin) == ["team-a", "team-b"]
+    assert client.get("/metrics/clients").status_code == 401
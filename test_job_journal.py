@@ -0,0 +1,160 @@
+# test_job_journal.py - 任务日志的组提交、重放与快照压缩
+
+import threading
+import time
+
+import pytest
+
+import job_journal
+from broker_backend import JournaledMemoryBackend
+from job_journal import JobJournal, JournalError
+
+
+def _ops(path):
+    return [event["op"] for event in JobJournal.read_events(path)]
+
+
+def test_append_and_wait_for_commit(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = JobJournal(path)
+    journal.append({"op": "a"})
+    journal.append({"op": "b"}, wait=True)
+    assert _ops(path) == ["a", "b"]
+    journal.close()
+
+
+def test_truncated_last_line_is_ignored(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    path.write_text('{"op":"a"}\n{"op":"b"', encoding="utf-8")
+    assert _ops(str(path)) == ["a"]
+
+
+def test_replay_restores_queue_tasks_chunks_and_sessions(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    backend = JournaledMemoryBackend(path)
+    backend.create_task("t1", kind="prompt")
+    backend.put_job("prompt", {"task_id": "t1", "client_id": "a"})
+    backend.create_task("t2", kind="prompt")
+    backend.put_job("prompt", {"task_id": "t2", "client_id": "a"})
+    assert backend.take_job("prompt", "w1")["task_id"] == "t1"
+    backend.append_chunk("t1", "hello")
+    backend.update_task("t1", status="running")
+    backend.set_session("conversation:w1", {"model": "m"})
+    backend._journal.close()
+
+    restored = JournaledMemoryBackend(path)
+    assert restored.get_task("t1")["status"] == "running"
+    assert restored.read_chunks("t1", 0) == ["hello"]
+    assert restored.get_session("conversation:w1") == {"model": "m"}
+    assert restored.queue_size("prompt") == 1
+    assert restored.take_job("prompt", "w1")["task_id"] == "t2"
+    # 启动时的重放会把日志替换为快照
+    assert "take_job" not in _ops(path)
+    restored._journal.close()
+
+
+def test_dropped_jobs_are_not_resurrected(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    backend = JournaledMemoryBackend(path)
+    backend.create_task("expired")
+    backend.put_job("prompt", {"task_id": "expired", "deadline": time.time() - 1})
+    backend.create_task("cancelled")
+    backend.put_job("prompt", {"task_id": "cancelled"})
+    backend.update_task("cancelled", status="cancelled")
+    assert backend.take_job("prompt", "w1") is None
+    backend._journal.close()
+    assert _ops(path).count("drop_job") == 2
+
+    restored = JournaledMemoryBackend(path)
+    assert restored.queue_size("prompt") == 0
+    assert restored.get_task("expired")["status"] == "expired"
+    restored._journal.close()
+
+
+def _wait_for_compaction(backend):
+    compactor = backend._compactor
+    if compactor:
+        compactor.join(timeout=5)
+
+
+def test_runtime_compaction_keeps_the_state(tmp_path, monkeypatch):
+    monkeypatch.setattr(job_journal, "COMPACT_MAX_EVENTS", 20)
+    path = str(tmp_path / "journal.jsonl")
+    backend = JournaledMemoryBackend(path)
+    backend.create_task("t1")
+    backend.put_job("prompt", {"task_id": "t1"})
+    for i in range(50):
+        backend.set_session("counter", i)
+    _wait_for_compaction(backend)
+    backend._journal.close()
+
+    ops = _ops(path)
+    assert len(ops) < 50
+    restored = JournaledMemoryBackend(path)
+    assert restored.get_session("counter") == 49
+    assert restored.take_job("prompt", "w1")["task_id"] == "t1"
+    restored._journal.close()
+
+
+def test_compaction_writes_the_snapshot_outside_the_backend_lock(tmp_path, monkeypatch):
+    monkeypatch.setattr(job_journal, "COMPACT_MAX_EVENTS", 5)
+    path = str(tmp_path / "journal.jsonl")
+    backend = JournaledMemoryBackend(path)
+    writing, release = threading.Event(), threading.Event()
+    finish_compaction = JobJournal.finish_compaction
+
+    def slow_finish(journal, events):
+        writing.set()
+        release.wait(timeout=5)
+        finish_compaction(journal, events)
+    monkeypatch.setattr(JobJournal, "finish_compaction", slow_finish)
+
+    for i in range(6):
+        backend.set_session("before", i)
+    assert writing.wait(timeout=5)
+    # 快照写入期间后端照常工作，期间的变更写在快照之后
+    started = time.monotonic()
+    backend.create_task("during")
+    backend.set_session("after", 1)
+    assert time.monotonic() - started < 1
+    release.set()
+    _wait_for_compaction(backend)
+    backend._journal.close()
+
+    restored = JournaledMemoryBackend(path)
+    assert restored.get_session("before") == 5 and restored.get_session("after") == 1
+    assert restored.get_task("during") is not None
+    restored._journal.close()
+
+
+def test_replayed_tasks_nobody_reads_are_abandoned(broker, tmp_path, monkeypatch):
+    path = str(tmp_path / "journal.jsonl")
+    backend = JournaledMemoryBackend(path)
+    for task_id in ("orphan", "claimed", "done"):
+        backend.create_task(task_id)
+        backend.put_job("prompt", {"task_id": task_id})
+    backend.update_task("done", status="completed")
+    backend._journal.close()
+
+    restored = JournaledMemoryBackend(path)
+    assert sorted(restored.replayed_task_ids) == ["claimed", "orphan"]
+    monkeypatch.setattr(broker, "BACKEND", restored)
+    monkeypatch.setattr(broker, "UNCLAIMED_TASKS", set(restored.replayed_task_ids))
+    # 网关仍在读取的任务保留
+    broker.app.test_client().get("/get_chunk/claimed?offset=0")
+    broker._abandon_unclaimed_tasks()
+    assert restored.get_task("orphan")["status"] == "cancelled"
+    assert restored.get_task("claimed")["status"] == "pending"
+    assert restored.take_job("prompt", "w1")["task_id"] == "claimed"
+    assert restored.take_job("prompt", "w1") is None
+    restored._journal.close()
+
+
+def test_waiters_fail_once_the_writer_has_died(tmp_path):
+    journal = JobJournal(str(tmp_path / "journal.jsonl"))
+    journal._file.close() # 让写入线程的下一次写盘失败
+    seq = journal.append({"op": "a"})
+    with pytest.raises(JournalError):
+        journal.wait_for(seq)
+    with pytest.raises(JournalError):
+        journal.append({"op": "b"})
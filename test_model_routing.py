@@ -0,0 +1,105 @@
+# test_model_routing.py - 按模型分配 worker 与空闲 worker 的预热
+
+import time
+from collections import Counter
+
+import openai_compatible_server as gateway
+from broker_backend import conversation_summary, job_is_eligible, MODEL_AFFINITY_WAIT_SECONDS
+
+
+def test_warm_targets_follow_demand():
+    from local_history_server import _warm_targets
+    assert _warm_targets(4, Counter({"a": 30, "b": 10})) == {"a": 3, "b": 1}
+    # worker 足够时每个有需求的模型至少一个
+    assert _warm_targets(3, Counter({"a": 100, "b": 1, "c": 1})) == {"a": 1, "b": 1, "c": 1}
+    assert _warm_targets(0, Counter({"a": 1})) == {}
+
+
+def test_jobs_prefer_workers_already_on_the_model():
+    now = time.time()
+    live = {"w1": {"last_seen": now, "model": "a"}, "w2": {"last_seen": now, "model": "b"}}
+    job = {"model": "b", "submitted_at": now}
+    assert not job_is_eligible(job, "w1", live)
+    assert job_is_eligible(job, "w2", live)
+    # 等待超过 MODEL_AFFINITY_WAIT_SECONDS 后任何 worker 都可领取
+    assert job_is_eligible({**job, "submitted_at": now - MODEL_AFFINITY_WAIT_SECONDS - 1}, "w1", live)
+    # 没有 worker 在使用该模型时不必等待
+    assert job_is_eligible({"model": "c", "submitted_at": now}, "w1", live)
+
+
+def _idle_workers(broker, *worker_ids, model="a"):
+    for worker_id in worker_ids:
+        broker.BACKEND.touch_worker(worker_id, model=model, last_job_at=0)
+
+
+def test_idle_worker_is_warmed_to_the_model_in_demand(broker):
+    _idle_workers(broker, "w1", "w2")
+    for _ in range(5):
+        broker._record_model_demand("b")
+    broker.BACKEND.set_session("conversation:w1", conversation_summary([], "a"))
+
+    job = broker._warmup_job_for("w1")
+    assert job["warmup"] and job["model"] == "b" and job["messages"] == []
+    assert broker.BACKEND.get_session("conversation:w1") is None
+    assert broker.BACKEND.list_workers()["w1"]["warming_model"] == "b"
+    # 预热中的 worker 不会出现在快速通道的候选中
+    assert "w1" not in broker.app.test_client().get("/conversation_states").json["states"]
+
+
+def test_worker_holding_a_conversation_is_not_warmed(broker):
+    _idle_workers(broker, "w1")
+    for _ in range(5):
+        broker._record_model_demand("b")
+    history = [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}]
+    broker.BACKEND.set_session("conversation:w1", conversation_summary(history, "a"))
+    assert broker._warmup_job_for("w1") is None
+    assert broker.BACKEND.get_session("conversation:w1")["message_count"] == 2
+
+
+def test_busy_worker_is_not_warmed(broker):
+    broker.BACKEND.touch_worker("w1", model="a", last_job_at=time.time())
+    broker._record_model_demand("b")
+    assert broker._warmup_job_for("w1") is None
+
+
+def test_worker_in_a_long_generation_is_not_warmed(broker):
+    client = broker.app.test_client()
+    broker.BACKEND.touch_worker("w1", model="a")
+    task_id = client.post("/submit_prompt", json={"prompt": "hi"}).json["task_id"]
+    assert client.get("/get_prompt_job?worker_id=w1").json["job"]["task_id"] == task_id
+    # 首轮生成已持续超过 WARMUP_IDLE_SECONDS，页面中还没有对话摘要
+    broker.BACKEND.touch_worker("w1", last_job_at=time.time() - broker.WARMUP_IDLE_SECONDS - 5)
+    for _ in range(5):
+        broker._record_model_demand("b")
+    assert broker._warmup_job_for("w1") is None
+
+    client.post("/report_result", json={"task_id": task_id, "status": "completed"})
+    # 空闲时间从生成结束时重新计算
+    assert broker._warmup_job_for("w1") is None
+    broker.BACKEND.touch_worker("w1", last_job_at=0)
+    assert broker._warmup_job_for("w1")["model"] == "b"
+
+
+def test_warm_up_completion_and_failure(broker):
+    client = broker.app.test_client()
+    _idle_workers(broker, "w1", "w2")
+    for _ in range(5):
+        broker._record_model_demand("b")
+
+    job = broker._warmup_job_for("w1")
+    client.post("/report_injection_complete", json={"task_id": job["task_id"], "worker_id": "w1", "status": "completed"})
+    worker = broker.BACKEND.list_workers()["w1"]
+    assert worker["model"] == "b" and worker["warming_model"] is None
+    assert broker.BACKEND.get_session("conversation:w1") == conversation_summary([], "b")
+
+    job = broker._warmup_job_for("w2")
+    client.post("/report_injection_complete", json={"task_id": job["task_id"], "worker_id": "w2", "status": "failed"})
+    assert broker.BACKEND.list_workers()["w2"]["warming_model"] is None
+
+
+def test_unknown_models_are_rejected(broker, monkeypatch):
+    monkeypatch.setitem(gateway.MODEL_LIST_CACHE, "index", {})
+    gateway._index_models([{"id": "gemini-a"}])
+    res = gateway.app.test_client().post("/v1/chat/completions", json={"model": "nope", "messages": [{"role": "user", "content": "hi"}]})
+    assert res.status_code == 404
+    assert res.json["error"]["code"] == "model_not_found"
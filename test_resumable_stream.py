@@ -0,0 +1,80 @@
+# test_resumable_stream.py - 可恢复的流式响应 (Last-Event-ID)
+
+import time
+
+import openai_compatible_server as gateway
+
+
+def _event_ids(body: str) -> list:
+    return [int(line.rpartition(":")[2]) for line in body.splitlines() if line.startswith("id: ")]
+
+
+def _read_events(response, count: int) -> list:
+    events = []
+    for part in response.response:
+        events.append(part.decode() if isinstance(part, bytes) else part)
+        if len(events) == count:
+            break
+    response.close()
+    return events
+
+
+def test_parse_last_event_id():
+    assert gateway._parse_last_event_id("chatcmpl-abc:12") == ("chatcmpl-abc", 12)
+    assert gateway._parse_last_event_id(None) == (None, 0)
+    assert gateway._parse_last_event_id("garbage") == ("garbage", 0)
+
+
+def test_buffer_replays_from_any_sequence_number():
+    buffer = gateway.StreamBuffer("chatcmpl-x", "anonymous")
+    buffer.append("data: 1\n\ndata: 2\n\n")
+    buffer.append("data: 3\n\n")
+    buffer.finish()
+    assert list(buffer.read_from(1)) == ["id: chatcmpl-x:2\ndata: 2\n\n", "id: chatcmpl-x:3\ndata: 3\n\n"]
+    assert list(buffer.read_from(3)) == []
+
+
+def test_buffer_is_abandoned_after_the_grace_period(monkeypatch):
+    monkeypatch.setattr(gateway, "STREAM_RESUME_GRACE_SECONDS", 0.2)
+    buffer = gateway.StreamBuffer("chatcmpl-x", "anonymous")
+    buffer.append("data: 1\n\n")
+    reader = buffer.read_from(0)
+    next(reader)
+    reader.close()
+    assert not buffer.abandoned.is_set()
+    # 上游没有新事件时也由定时器发现
+    assert buffer.abandoned.wait(timeout=2)
+
+
+def test_client_resumes_after_disconnect(broker, workers):
+    workers("w1", chunks=[f'[[null,"t{i} "]]' for i in range(6)], delay=0.1)
+    client = gateway.app.test_client()
+    body = {"stream": True, "messages": [{"role": "user", "content": "hi"}]}
+    first = _read_events(client.post("/v1/chat/completions", json=body, buffered=False), 2)
+    last_event_id = first[-1].splitlines()[0][len("id: "):]
+    completion_id = last_event_id.rpartition(":")[0]
+
+    resumed = client.post("/v1/chat/completions", headers={"Last-Event-ID": last_event_id}, json=body).get_data(as_text=True)
+    ids = _event_ids(resumed)
+    assert ids[0] == 3 and ids == list(range(3, 3 + len(ids)))
+    assert "data: [DONE]" in resumed
+    assert "t5" in resumed
+
+    replay = client.get(f"/v1/chat/completions/{completion_id}/stream?last_event_id=0").get_data(as_text=True)
+    assert _event_ids(replay)[0] == 1
+    assert client.get("/v1/chat/completions/chatcmpl-missing/stream").status_code == 404
+
+
+def test_abandoned_stream_cancels_the_task_without_waiting_for_upstream(broker, workers, monkeypatch):
+    monkeypatch.setattr(gateway, "STREAM_RESUME_GRACE_SECONDS", 0.5)
+    workers("w1", chunks=('[[null,"a "]]', '[[null,"b"]]'), delay=5)
+    client = gateway.app.test_client()
+    response = client.post("/v1/chat/completions", json={"stream": True, "messages": [{"role": "user", "content": "hi"}]}, buffered=False)
+    _read_events(response, 1)
+    disconnected_at = time.monotonic()
+
+    cancelled = lambda: any(task["status"] == "cancelled" for task in broker.BACKEND._tasks.values())
+    while time.monotonic() - disconnected_at < 4 and not cancelled():
+        time.sleep(0.05)
+    assert cancelled()
+    assert time.monotonic() - disconnected_at < 2
@@ -0,0 +1,81 @@
+# test_stall_redispatch.py - 卡住的生成的检测与重新分派
+
+import threading
+import time
+
+import pytest
+
+import openai_compatible_server as gateway
+from broker_backend import job_is_eligible
+
+
+@pytest.fixture
+def short_stalls(broker, monkeypatch):
+    monkeypatch.setattr(gateway, "STALL_DEFAULT_SECONDS", {"first_chunk": 1, "gap": 1})
+    monkeypatch.setattr(gateway, "STALL_MIN_SECONDS", {"first_chunk": 0.5, "gap": 0.5})
+
+
+def test_stall_threshold_adapts_to_observed_latency(broker):
+    assert gateway._stall_threshold("first_chunk") == gateway.STALL_DEFAULT_SECONDS["first_chunk"]
+    for _ in range(gateway.STALL_MIN_SAMPLES - 1):
+        gateway._record_liveness("first_chunk", 2.0)
+    # 样本不足时仍使用默认值
+    assert gateway._liveness_quantile("first_chunk", 0.5) is None
+    gateway._record_liveness("first_chunk", 2.0)
+    assert gateway._stall_threshold("first_chunk") == 2.0 * gateway.STALL_MULTIPLIER
+
+    # 阈值限制在 [STALL_MIN_SECONDS, STALL_DEFAULT_SECONDS] 之间
+    for _ in range(100):
+        gateway._record_liveness("gap", 0.01)
+    assert gateway._stall_threshold("gap") == gateway.STALL_MIN_SECONDS["gap"]
+    for _ in range(100):
+        gateway._record_liveness("first_chunk", 100)
+    assert gateway._stall_threshold("first_chunk") == gateway.STALL_DEFAULT_SECONDS["first_chunk"]
+
+
+def test_avoided_and_unhealthy_workers_do_not_take_jobs():
+    now = time.time()
+    live = {"w1": {"last_seen": now, "unhealthy_until": now + 60}, "w2": {"last_seen": now}}
+    assert not job_is_eligible({"avoid_workers": ["w2"]}, "w2", live)
+    assert not job_is_eligible({}, "w1", live)
+    assert job_is_eligible({}, "w2", live)
+    # 明确指定给不健康 worker 的任务可以由其他健康的 worker 接管
+    assert job_is_eligible({"worker_id": "w1"}, "w2", live)
+    assert job_is_eligible({"worker_id": "w1"}, "w1", live)
+
+
+def test_worker_health_endpoint(broker):
+    client = broker.app.test_client()
+    broker.BACKEND.touch_worker("w1")
+    client.post("/workers/w1/health", json={"healthy": False, "seconds": 60, "reason": "stall"})
+    assert client.get("/workers").json["workers"]["w1"]["healthy"] is False
+    client.post("/workers/w1/health", json={"healthy": True})
+    assert client.get("/workers").json["workers"]["w1"]["healthy"] is True
+
+
+def test_stalled_generation_is_redispatched(short_stalls, broker, workers):
+    frozen = workers("w1", chunks=None)
+    # w1 先完成注入并领取对话任务，之后才有健康的 w2 可以接管
+    threading.Timer(0.3, workers, args=("w2",)).start()
+    started = time.monotonic()
+    res = gateway.app.test_client().post("/v1/chat/completions", headers={"X-Debug-Timeline": "1"},
+                                         json={"messages": [{"role": "user", "content": "hi"}]})
+    assert res.status_code == 200
+    assert res.json["choices"][0]["message"]["content"] == "Hello world"
+    assert time.monotonic() - started < 5
+    assert len(frozen.taken) == 1
+    assert '"redispatched"' in res.headers["X-Request-Timeline"]
+
+    workers_info = broker.app.test_client().get("/workers").json["workers"]
+    assert workers_info["w1"]["healthy"] is False and workers_info["w2"]["healthy"] is True
+    assert broker.BACKEND.get_session("conversation:w1") is None
+
+
+def test_stall_without_another_worker_ends_the_request(short_stalls, broker, workers):
+    workers("w1", chunks=None)
+    started = time.monotonic()
+    res = gateway.app.test_client().post("/v1/chat/completions", json={"messages": [{"role": "user", "content": "hi"}]})
+    assert time.monotonic() - started < 5
+    # 与超过截止时间一样按截断处理，卡住的任务被取消
+    assert res.json["choices"][0]["finish_reason"] == "length"
+    assert any(task["status"] == "cancelled" for task in broker.BACKEND._tasks.values())
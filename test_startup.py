@@ -0,0 +1,88 @@
+# test_startup.py - 就绪探针与 start_all.py 的启动等待
+
+import os
+import socket
+import threading
+import time
+
+import openai_compatible_server as gateway
+import start_all
+
+
+def _unused_url():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    return f"http://127.0.0.1:{port}/readyz"
+
+
+def _alive_thread():
+    stop = threading.Event()
+    thread = threading.Thread(target=stop.wait, daemon=True)
+    thread.start()
+    return thread, stop
+
+
+def test_wait_until_ready_returns_as_soon_as_the_probe_passes(broker):
+    thread, stop = _alive_thread()
+    started = time.monotonic()
+    assert start_all.wait_until_ready("内部服务器", f"{gateway.INTERNAL_SERVER_URL}/readyz", thread, timeout=5)
+    assert time.monotonic() - started < 1
+    stop.set()
+
+
+def test_wait_until_ready_fails_when_the_server_thread_exits():
+    thread = threading.Thread(target=lambda: None)
+    thread.start()
+    thread.join()
+    started = time.monotonic()
+    assert not start_all.wait_until_ready("网关", _unused_url(), thread, timeout=10)
+    assert time.monotonic() - started < 1
+
+
+def test_wait_until_ready_times_out():
+    thread, stop = _alive_thread()
+    started = time.monotonic()
+    assert not start_all.wait_until_ready("网关", _unused_url(), thread, timeout=0.5)
+    assert time.monotonic() - started < 1.5
+    stop.set()
+
+
+def test_broker_probes(broker):
+    client = broker.app.test_client()
+    assert client.get("/healthz").status_code == 200
+    broker.BACKEND.touch_worker("w1")
+    ready = client.get("/readyz")
+    assert ready.status_code == 200
+    assert ready.json["workers"] == 1 and ready.json["backend"] == "MemoryBrokerBackend"
+
+
+def test_broker_is_not_ready_until_the_backend_is(broker, monkeypatch):
+    monkeypatch.setattr(broker, "BACKEND_READY", threading.Event())
+    monkeypatch.setattr(broker, "BACKEND_STARTUP_WAIT_SECONDS", 0.1)
+    client = broker.app.test_client()
+    assert client.get("/readyz").status_code == 503
+    assert client.get("/healthz").status_code == 200
+    assert client.get("/scheduler_stats").status_code == 503
+
+
+def test_gateway_waits_for_the_minimum_number_of_workers(broker, monkeypatch):
+    monkeypatch.setattr(gateway, "READY_MIN_WORKERS", 1)
+    client = gateway.app.test_client()
+    assert client.get("/readyz").status_code == 503
+    broker.BACKEND.touch_worker("w1")
+    res = client.get("/readyz")
+    assert res.status_code == 200 and res.json["workers"] == 1
+
+
+def test_importing_the_broker_has_no_side_effects(tmp_path):
+    import subprocess
+    import sys
+    code = ("import threading, local_history_server as broker; "
+            "assert broker.BACKEND is None and broker.BACKEND_STATUS['started_at'] is None; "
+            "assert [t.name for t in threading.enumerate()] == ['MainThread']")
+    env = {**os.environ, "PYTHONPATH": os.path.dirname(os.path.abspath(start_all.__file__))}
+    env.pop("BROKER_JOURNAL_PATH", None)
+    env.pop("BROKER_BLOB_DIR", None)
+    subprocess.run([sys.executable, "-c", code], cwd=tmp_path, env=env, check=True)
+    assert list(tmp_path.iterdir()) == []
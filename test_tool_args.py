@@ -0,0 +1,89 @@
+# test_tool_args.py - 按 Schema 解码函数调用参数
+
+import json
+
+import openai_compatible_server as gateway
+from benchmark_tool_args import _string, _number, _bool, _struct, _list, deep_nesting_case
+from openai_compatible_server import decode_google_args
+
+
+def _schema(**properties):
+    return {"type": "object", "properties": properties}
+
+
+def test_schema_decodes_ambiguous_scalars():
+    args = [["count", _number(3.0)], ["ratio", _number(0.5)], ["enabled", _bool(0)], ["name", _string("x")]]
+    schema = _schema(count={"type": "integer"}, ratio={"type": "number"}, enabled={"type": "boolean"}, name={"type": ["string", "null"]})
+    decoded = decode_google_args(args, schema)
+    assert decoded == {"count": 3, "ratio": 0.5, "enabled": False, "name": "x"}
+    assert type(decoded["count"]) is int and decoded["enabled"] is False
+
+
+def test_single_field_object_is_not_mistaken_for_a_list():
+    args = [["options", _struct([["mode", _string("fast")]])]]
+    assert decode_google_args(args, _schema(options={"type": "object"})) == {"options": {"mode": "fast"}}
+    # 无 Schema 时沿用旧规则，单字段对象会被当作 [key, value] 列表
+    assert decode_google_args(args) == {"options": ["mode", "fast"]}
+
+
+def test_value_wrappers_longer_than_six_slots_are_not_scalars():
+    assert gateway._slot_value([None, None, "x"], "string") == (True, "x")
+    assert gateway._slot_value([None, None, "x", None, None, None], "string") == (True, "x")
+    assert gateway._slot_value([None, None, "x", None, None, None, None], "string") == (False, None)
+
+
+def test_field_order_is_preserved():
+    args = [["b", _string("1")], ["a", _string("2")], ["c", _struct([["z", _number(1)], ["y", _number(2)]])]]
+    decoded = decode_google_args(args, _schema(c={"type": "object"}))
+    assert list(decoded) == ["b", "a", "c"] and list(decoded["c"]) == ["z", "y"]
+
+
+def test_homogeneous_scalar_arrays_take_the_fast_path():
+    assert gateway._scalar_column([_number(i) for i in range(5)], "integer") == [0, 1, 2, 3, 4]
+    assert gateway._scalar_column([_number(1.0), _number(2)], "integer") == [1, 2]
+    assert gateway._scalar_column([_bool(1), _bool(False)], "boolean") == [True, False]
+    assert gateway._scalar_column([_string("a"), _string("b")], "string") == ["a", "b"]
+
+    args = [["values", _list([_number(i) for i in range(1000)])]]
+    schema = _schema(values={"type": "array", "items": {"type": "integer"}})
+    assert decode_google_args(args, schema) == {"values": list(range(1000))}
+
+
+def test_mixed_arrays_fall_back_to_per_item_decoding():
+    # 形状不同或类型不符时快速通道放弃，逐个解码
+    assert gateway._scalar_column([_number(1), _string("2")], "integer") is None
+    assert gateway._scalar_column([_number(1), [None, None]], "integer") is None
+    assert gateway._scalar_column([_string("a"), None], "string") is None
+
+    args = [["values", _list([_number(1), _string("two"), _number(3)])]]
+    schema = _schema(values={"type": "array", "items": {"type": "integer"}})
+    assert decode_google_args(args, schema) == {"values": [1, "two", 3]}
+
+
+def test_deep_nesting_does_not_hit_the_recursion_limit():
+    args, schema = deep_nesting_case(5000)
+    node = decode_google_args(args, schema)["tree"]
+    depth = 0
+    while isinstance(node, dict):
+        assert node["depth"] == 1
+        node, depth = node["child"], depth + 1
+    assert depth == 5000 and node == "leaf"
+
+
+def test_legacy_decoding_without_a_schema():
+    assert gateway._extract_value(_string("hi")) == "hi"
+    assert gateway._extract_value(_number(2)) == 2
+    assert gateway._extract_value(_list([_string("a"), _string("b")])) == ["a", "b"]
+    assert gateway._extract_value(_struct([["a", _number(1)], ["b", _number(2)]])) == {"a": 1, "b": 2}
+    assert decode_google_args("not a list") == {}
+
+
+def test_tool_calls_are_decoded_with_the_request_schema():
+    call = ["set_flag", [[["enabled", _bool(1)], ["level", _number(2.0)]]]]
+    buffer = json.dumps([[None, "Model generated function call(s)."], call]) + "\n" + json.dumps([[None, "tail"]])
+    tools = [{"type": "function", "function": {"name": "set_flag", "parameters": _schema(enabled={"type": "boolean"}, level={"type": "integer"})}}]
+
+    (tool_call,) = gateway.parse_final_buffer_for_tool_calls(buffer, tools)
+    assert tool_call["function"]["name"] == "set_flag"
+    assert json.loads(tool_call["function"]["arguments"]) == {"enabled": True, "level": 2}
+    assert gateway.parse_final_buffer_for_tool_calls("") == []
@@ -0,0 +1,101 @@
+# test_tracing.py - 请求时间线与采样分析器
+
+import json
+import threading
+import time
+
+import pytest
+
+import openai_compatible_server as gateway
+from sampling_profiler import ProfilerBusy, format_folded, sample_stacks, PROFILE_LOCK
+
+
+def test_trace_marks_spans_and_wall_clock_events():
+    trace = gateway.RequestTrace("chatcmpl-t", "anonymous")
+    trace.mark("first_chunk", once=True)
+    trace.mark("first_chunk", once=True)
+    with trace.span("inject_history", worker_id="w1"):
+        time.sleep(0.01)
+    trace.mark_wall("job_pickup", trace.started_wall - 0.5)
+
+    events = trace.to_dict()["events"]
+    assert [event["name"] for event in events] == ["job_pickup", "first_chunk", "inject_history"]
+    assert events[0]["at_ms"] == pytest.approx(-500, abs=5)
+    assert events[2]["duration_ms"] >= 10 and events[2]["attrs"] == {"worker_id": "w1"}
+
+    chrome = trace.to_chrome_trace()["traceEvents"]
+    span = next(event for event in chrome if event["name"] == "inject_history")
+    assert span["ph"] == "X" and span["dur"] >= 10000
+
+
+REMOTE_ADDR = "203.0.113.7"
+
+
+def test_trace_is_returned_and_only_visible_to_its_client(broker, workers):
+    workers("w1")
+    client = gateway.app.test_client()
+    res = client.post("/v1/chat/completions", headers={"X-Debug-Timeline": "1", "Authorization": "Bearer sk-owner"},
+                      json={"messages": [{"role": "user", "content": "hi"}]})
+    trace_id = res.headers["X-Request-Id"]
+    names = [event["name"] for event in json.loads(res.headers["X-Request-Timeline"])]
+    for name in ("normalize", "fast_path_check", "inject_history", "prompt_submitted", "first_chunk", "finish"):
+        assert name in names
+
+    remote = {"REMOTE_ADDR": REMOTE_ADDR}
+    assert client.get(f"/debug/traces/{trace_id}", headers={"Authorization": "Bearer sk-owner"}, environ_base=remote).json["id"] == trace_id
+    assert client.get(f"/debug/traces/{trace_id}", headers={"Authorization": "Bearer sk-other"}, environ_base=remote).status_code == 404
+    # 未设置 ADMIN_TOKEN 时本机请求视为管理员
+    assert client.get(f"/debug/traces/{trace_id}", headers={"Authorization": "Bearer sk-other"}).status_code == 200
+    chrome = client.get(f"/debug/traces/{trace_id}?format=chrome", headers={"Authorization": "Bearer sk-owner"}).json
+    assert chrome["traceEvents"]
+
+
+def test_sampling_profiler_collects_folded_stacks():
+    stop = threading.Event()
+
+    def busy_loop():
+        while not stop.is_set():
+            sum(range(1000))
+
+    thread = threading.Thread(target=busy_loop, name="busy-worker", daemon=True)
+    thread.start()
+    try:
+        result = sample_stacks(0.2, 0.005)
+    finally:
+        stop.set()
+    assert result["samples"] > 0
+    assert any(stack.startswith("busy-worker;") and "busy_loop" in stack for stack in result["stacks"])
+    folded = format_folded({"a;b": 2, "a": 1})
+    assert folded.splitlines()[0] == "a;b 2"
+
+
+def test_only_one_profiling_session_at_a_time():
+    with PROFILE_LOCK:
+        with pytest.raises(ProfilerBusy):
+            sample_stacks(0.01)
+
+
+def test_profile_endpoints_require_the_admin_token(broker, monkeypatch):
+    monkeypatch.setattr(gateway, "ADMIN_TOKEN", "secret")
+    monkeypatch.setattr(broker, "ADMIN_TOKEN", "secret")
+    assert gateway.app.test_client().get("/debug/profile?seconds=0.05").status_code == 403
+    broker_client = broker.app.test_client()
+    assert broker_client.get("/debug/profile?seconds=0.05").status_code == 403
+    res = broker_client.get("/debug/profile?seconds=0.05", headers={"X-Admin-Token": "secret"})
+    assert res.status_code == 200 and res.json["samples"] > 0
+
+
+def test_debug_endpoints_are_loopback_only_without_an_admin_token(broker, workers, monkeypatch):
+    monkeypatch.setattr(gateway, "ADMIN_TOKEN", None)
+    monkeypatch.setattr(broker, "ADMIN_TOKEN", None)
+    remote = {"REMOTE_ADDR": REMOTE_ADDR}
+    assert gateway.app.test_client().get("/debug/profile?seconds=0.05", environ_base=remote).status_code == 403
+    assert broker.app.test_client().get("/debug/profile?seconds=0.05", environ_base=remote).status_code == 403
+    assert broker.app.test_client().get("/debug/profile?seconds=0.05").status_code == 200
+
+    # 匿名客户端共用同一个身份，远程的匿名调用方看不到时间线
+    workers("w1")
+    client = gateway.app.test_client()
+    trace_id = client.post("/v1/chat/completions", json={"messages": [{"role": "user", "content": "hi"}]}).headers["X-Request-Id"]
+    assert client.get(f"/debug/traces/{trace_id}", environ_base=remote).status_code == 404
+    assert client.get(f"/debug/traces/{trace_id}").status_code == 200